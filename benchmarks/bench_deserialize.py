@@ -0,0 +1,39 @@
+"""
+Compare the inbound ActivityPub deserialization paths on the test fixture payloads.
+
+Usage: python benchmarks/bench_deserialize.py [rounds]
+"""
+import copy
+import os
+import sys
+import timeit
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "federation.tests.django.settings")
+
+from federation.entities.activitypub import fastpath, models  # noqa: E402
+from federation.tests.fixtures.payloads import activitypub as payloads  # noqa: E402
+
+
+def full_path(model, payload):
+    return model.schema().load(payload)
+
+
+def main(rounds=200):
+    print(f"{'payload':45} {'full (ms)':>10} {'fast (ms)':>10} {'speedup':>8}")
+    for name in sorted(dir(payloads)):
+        payload = getattr(payloads, name)
+        if not name.startswith("ACTIVITYPUB") or payload.get("type") not in fastpath.FAST_PATH_TYPES:
+            continue
+        model = getattr(models, models.MODEL_NAMES[payload["type"].lower()])
+        results = []
+        for func in (full_path, models.load_payload):
+            # warm up the context caches
+            func(model, copy.deepcopy(payload))
+            copies = [copy.deepcopy(payload) for _ in range(rounds)]
+            it = iter(copies)
+            results.append(timeit.timeit(lambda: func(model, next(it)), number=rounds) / rounds * 1000)
+        print(f"{name:45} {results[0]:10.3f} {results[1]:10.3f} {results[0] / results[1]:7.2f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,84 @@
+"""
+Compare the throughput of the RsaSignature2017 and the eddsa-jcs-2022 LD signatures on the test fixture payloads.
+
+The RSA verifications are measured with a cold digest cache, each payload being seen once.
+
+Usage: python benchmarks/bench_signatures.py [rounds]
+"""
+import copy
+import os
+import sys
+import timeit
+from unittest.mock import patch
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "federation.tests.django.settings")
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey  # noqa: E402
+
+from federation.entities.activitypub import ldsigning  # noqa: E402
+from federation.tests.fixtures.keys import get_dummy_private_key  # noqa: E402
+from federation.tests.fixtures.payloads import activitypub as payloads  # noqa: E402
+from federation.types import PublicKeyType, UserType  # noqa: E402
+from federation.utils.keys import encode_multikey  # noqa: E402
+
+AUTHOR_ID = "https://example.com/u/bob"
+
+
+def rsa_sign(author, document):
+    ldsigning.create_ld_signature(document, author)
+
+
+def rsa_verify(author, document):
+    ldsigning.hash_cache.clear()
+    assert ldsigning.verify_ld_signature(document) == AUTHOR_ID
+
+
+def eddsa_sign(author, document):
+    ldsigning.create_data_integrity_proof(document, author)
+
+
+def eddsa_verify(author, document):
+    assert ldsigning.verify_ld_signature(document) == AUTHOR_ID
+
+
+def measure(func, author, documents):
+    it = iter(documents)
+    rounds = len(documents)
+    return rounds / timeit.timeit(lambda: func(author, next(it)), number=rounds)
+
+
+def main(rounds=50):
+    rsa_key = get_dummy_private_key()
+    ed25519_key = Ed25519PrivateKey.generate()
+    author = UserType(id=AUTHOR_ID, private_key=rsa_key, ed25519_private_key=ed25519_key)
+    public_keys = {
+        f"{AUTHOR_ID}#main-key": PublicKeyType(id=f"{AUTHOR_ID}#main-key", owner=AUTHOR_ID, pem="",
+                                               key=rsa_key.publickey()),
+        f"{AUTHOR_ID}#ed25519-key": PublicKeyType(id=f"{AUTHOR_ID}#ed25519-key", owner=AUTHOR_ID,
+                                                  pem=encode_multikey(ed25519_key), key=ed25519_key.public_key()),
+    }
+
+    print(f"{'payload':45} {'RSA sign/s':>11} {'EdDSA sign/s':>13} {'RSA verify/s':>13} {'EdDSA verify/s':>15}")
+    with patch.object(ldsigning, "get_profile", return_value=None), \
+            patch.object(ldsigning, "retrieve_public_key", side_effect=public_keys.get):
+        for name in sorted(dir(payloads)):
+            payload = getattr(payloads, name)
+            if not name.startswith("ACTIVITYPUB") or not isinstance(payload, dict) or "@context" not in payload:
+                continue
+            payload = {key: value for key, value in payload.items() if key not in ("signature", "proof")}
+            try:
+                rsa_sign(author, copy.deepcopy(payload))
+            except Exception as ex:
+                print(f"{name:45} skipped, not normalizable: {type(ex).__name__}")
+                continue
+            results = []
+            for sign, verify in ((rsa_sign, rsa_verify), (eddsa_sign, eddsa_verify)):
+                documents = [copy.deepcopy(payload) for _ in range(rounds)]
+                results.append(measure(sign, author, documents))
+                # verify the signed documents, unaltered
+                results.append(measure(verify, author, documents))
+            print(f"{name:45} {results[0]:11.1f} {results[2]:13.1f} {results[1]:13.1f} {results[3]:15.1f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
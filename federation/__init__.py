@@ -1,6 +1,8 @@
 import importlib
+import threading
 from types import ModuleType
-from typing import Union, TYPE_CHECKING
+from typing import Dict, Optional, Union, TYPE_CHECKING
+from urllib.parse import urlsplit
 
 from federation.exceptions import NoSuitableProtocolFoundError
 
@@ -15,24 +17,83 @@ PROTOCOLS = (
     "matrix",
 )
 
+_protocol_modules = {}
+_content_types = None
+_registry_lock = threading.Lock()
+
+
+def get_protocol(protocol_name: str) -> ModuleType:
+    """
+    Get the protocol module, imported on first use.
+    """
+    protocol = _protocol_modules.get(protocol_name)
+    if protocol is None:
+        protocol = _protocol_modules[protocol_name] = importlib.import_module(
+            f"federation.protocols.{protocol_name}.protocol")
+    return protocol
+
+
+def get_content_types() -> Dict[str, ModuleType]:
+    """
+    Get the registry of the request content types identifying a protocol, declared
+    by the protocol modules in ``CONTENT_TYPES``.
+    """
+    global _content_types
+    if _content_types is None:
+        with _registry_lock:
+            if _content_types is None:
+                _content_types = {
+                    content_type: get_protocol(protocol_name)
+                    for protocol_name in PROTOCOLS
+                    for content_type in getattr(get_protocol(protocol_name), "CONTENT_TYPES", ())
+                }
+    return _content_types
+
 
 def identify_protocol(method, value):
     # type: (str, Union[str, RequestType]) -> ModuleType
     """
-    Loop through protocols, import the protocol module and try to identify the id or request.
+    Loop through protocols and try to identify the id or request.
     """
     for protocol_name in PROTOCOLS:
-        protocol = importlib.import_module(f"federation.protocols.{protocol_name}.protocol")
+        protocol = get_protocol(protocol_name)
         if getattr(protocol, f"identify_{method}")(value):
             return protocol
     else:
         raise NoSuitableProtocolFoundError()
 
 
+def identify_protocol_by_headers(request):
+    # type: (RequestType) -> Optional[ModuleType]
+    """
+    Identify the protocol of a request from its ``Content-Type`` header, or its path
+    for the protocols declaring a ``REQUEST_PATH``, without looking at the body.
+    """
+    from federation.utils.request import parse_request  # Circulars
+    request = parse_request(request)
+    protocol = get_content_types().get(request.content_type)
+    if protocol:
+        return protocol
+    path = getattr(request, "path", None) or urlsplit(getattr(request, "url", None) or "").path
+    if path:
+        for protocol_name in PROTOCOLS:
+            request_path = getattr(get_protocol(protocol_name), "REQUEST_PATH", None)
+            if request_path and request_path.search(path):
+                return get_protocol(protocol_name)
+    return None
+
+
 def identify_protocol_by_id(identifier: str) -> ModuleType:
     return identify_protocol('id', identifier)
 
 
 def identify_protocol_by_request(request):
     # type: (RequestType) -> ModuleType
-    return identify_protocol('request', request)
+    """
+    Identify the protocol from the request headers, then from the body.
+
+    The request body is parsed once for all the protocols, pass a ``ParsedRequest`` to reuse it afterwards.
+    """
+    from federation.utils.request import parse_request  # Circulars
+    request = parse_request(request)
+    return identify_protocol_by_headers(request) or identify_protocol('request', request)
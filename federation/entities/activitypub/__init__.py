@@ -1,7 +1,18 @@
+import copy
 import json
+import logging
+import os
 from datetime import timedelta
+from urllib.parse import urlsplit
+
 from pyld import jsonld
 
+from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_LITEPUB, CONTEXT_SECURITY
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_setting
+
+logger = logging.getLogger("federation")
+
 try:
     from federation.utils.django import get_redis
     cache = get_redis() or {}
@@ -9,6 +20,79 @@ try:
 except:
     cache = {}
 
+# In-process tier in front of the dict or redis cache, holding parsed context documents
+context_cache = TTLCache(
+    maxsize=get_setting("jsonld_context_cache_size", 256),
+    ttl=get_setting("jsonld_context_cache_ttl", int(timedelta(hours=1).total_seconds())),
+)
+
+CONTEXTS_PATH = os.path.join(os.path.dirname(__file__), "contexts")
+
+# Context documents shipped with the package, resolved without network access
+BUNDLED_CONTEXTS = {
+    CONTEXT_ACTIVITYSTREAMS: "activitystreams.jsonld",
+    "http://www.w3.org/ns/activitystreams": "activitystreams.jsonld",
+    "https://www.w3.org/ns/activitystreams.jsonld": "activitystreams.jsonld",
+    CONTEXT_SECURITY: "security-v1.jsonld",
+    "http://w3id.org/security/v1": "security-v1.jsonld",
+    CONTEXT_LITEPUB: "litepub-0.1.jsonld",
+}
+
+_bundled_documents = {}
+
+
+def get_bundled_context(url):
+    """
+    Return the pyld remote document for a context shipped with the package, if any.
+
+    Only the known context URLs are resolved locally. The contexts served by each instance, ie the
+    ``/schemas/litepub-0.1.jsonld`` of Pleroma and Akkoma, differ between versions and are fetched.
+    """
+    name = BUNDLED_CONTEXTS.get(url.rstrip("#"))
+    if not name:
+        return None
+    if name not in _bundled_documents:
+        with open(os.path.join(CONTEXTS_PATH, name)) as f:
+            _bundled_documents[name] = json.load(f)
+    return {
+        "contentType": "application/ld+json",
+        "contextUrl": None,
+        "documentUrl": url,
+        "document": copy.deepcopy(_bundled_documents[name]),
+        "tag": "static",
+    }
+
+
+def _get_origin(parts):
+    try:
+        return parts.scheme.lower(), parts.hostname, parts.port
+    except ValueError:
+        return None
+
+
+def is_context_allowed(url):
+    """
+    Check a remote context URL against the ``jsonld_context_allowlist`` setting.
+
+    The scheme and host must be the ones of an allowlist entry, and the path must be the entry path or
+    below it. None allows any remote context.
+    """
+    allowlist = get_setting("jsonld_context_allowlist")
+    if allowlist is None:
+        return True
+    parts = urlsplit(url)
+    origin = _get_origin(parts)
+    if not origin or not origin[1]:
+        return False
+    for entry in allowlist:
+        entry_parts = urlsplit(entry)
+        if _get_origin(entry_parts) != origin:
+            continue
+        path = entry_parts.path.rstrip("/")
+        if not path or parts.path == path or parts.path.startswith(path + "/"):
+            return True
+    return False
+
 
 # This is required to workaround a bug in pyld that has the Accept header
 # accept other content types. From what I understand, precedence handling
@@ -16,20 +100,34 @@ except:
 # from https://github.com/digitalbazaar/pyld/issues/133
 # cacheing loosely inspired by https://github.com/digitalbazaar/pyld/issues/70
 def get_loader(*args, **kwargs):
+    kwargs.setdefault("timeout", get_setting("jsonld_context_timeout", 5))
     requests_loader = jsonld.requests_document_loader(*args, **kwargs)
 
     def loader(url, options={}):
-        key = f'ld_cache:{url}'
-        try:
-            return json.loads(cache[key])
-        except KeyError:
-            options['headers']['Accept'] = 'application/ld+json'
-            doc = requests_loader(url, options)
-            if isinstance(cache, dict):
-                cache[key] = json.dumps(doc)
-            else:
-                cache.set(key, json.dumps(doc), ex=EXPIRATION)
+        doc = get_bundled_context(url)
+        if doc:
             return doc
+        if not is_context_allowed(url):
+            # Same as invalid context references, drop it
+            logger.warning("jsonld loader - context %s is not allowed, using an empty context", url)
+            return {"contentType": "application/ld+json", "contextUrl": None, "documentUrl": url,
+                    "document": {"@context": {}}}
+        doc = context_cache.get(url)
+        if doc is None:
+            key = f'ld_cache:{url}'
+            try:
+                doc = json.loads(cache[key])
+            except KeyError:
+                options['headers']['Accept'] = 'application/ld+json'
+                doc = requests_loader(url, options)
+                if isinstance(cache, dict):
+                    cache[key] = json.dumps(doc)
+                else:
+                    cache.set(key, json.dumps(doc), ex=EXPIRATION)
+            context_cache.set(url, doc)
+        # pyld keeps the processed contexts tagged as static for the life of the process. Remote contexts
+        # are left untagged so that they expire with context_cache, only the bundled ones are static.
+        return copy.deepcopy(doc)
 
     return loader
 
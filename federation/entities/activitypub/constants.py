@@ -1,4 +1,5 @@
 CONTEXT_ACTIVITYSTREAMS = "https://www.w3.org/ns/activitystreams"
+CONTEXT_LITEPUB = "https://litepub.social/litepub/context.jsonld"
 CONTEXT_SECURITY = "https://w3id.org/security/v1"
 
 NAMESPACE_PUBLIC = "https://www.w3.org/ns/activitystreams#Public"
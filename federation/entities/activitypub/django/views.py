@@ -1,10 +1,17 @@
+import json
+
 from cryptography.exceptions import InvalidSignature
+from django.core.serializers.json import DjangoJSONEncoder
 from django.http import JsonResponse, HttpResponse, HttpResponseNotFound
 
 from federation.entities.activitypub.mappers import get_outbound_entity
 from federation.protocols.activitypub.protocol import Protocol
 from federation.types import RequestType
-from federation.utils.django import get_function_from_config
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_configuration, get_function_from_config, get_redis
+
+# Rendered AS2 documents, used when redis is not configured
+object_cache = TTLCache(maxsize=1024)
 
 
 def get_and_verify_signer(request):
@@ -31,6 +38,42 @@ def get_and_verify_signer(request):
         return None
 
 
+def get_object_cache_key(obj):
+    """
+    Cache key for the rendered AS2 document of an object, changing when the object is updated.
+
+    Returns None for objects without an update time, their edits could not be told apart.
+    """
+    times = getattr(obj, 'times', None) or {}
+    updated = getattr(obj, 'updated', None) or times.get('modified') or times.get('updated')
+    if not updated:
+        return None
+    updated = updated.isoformat() if hasattr(updated, 'isoformat') else updated
+    return f'as2:{obj.id}:{updated}'
+
+
+def render_as2(obj):
+    """
+    Render the AS2 document of an object.
+
+    If the ``activitypub_object_cache_ttl`` setting is set, the rendered document of the objects
+    with an update time is shared through redis (or an in-process cache) for that many seconds.
+    """
+    ttl = get_configuration().get('activitypub_object_cache_ttl')
+    key = get_object_cache_key(obj) if ttl else None
+    if not key:
+        return json.dumps(get_outbound_entity(obj, None).to_as2(), cls=DjangoJSONEncoder)
+    redis = get_redis()
+    content = redis.get(key) if redis else object_cache.get(key)
+    if content is None:
+        content = json.dumps(get_outbound_entity(obj, None).to_as2(), cls=DjangoJSONEncoder)
+        if redis:
+            redis.set(key, content, ex=ttl)
+        else:
+            object_cache.set(key, content, ttl=ttl)
+    return content
+
+
 def activitypub_object_view(func):
     """
     Generic ActivityPub object view decorator.
@@ -58,9 +101,8 @@ def activitypub_object_view(func):
             obj = get_object_function(request, get_and_verify_signer(request))
             if not obj:
                 return HttpResponseNotFound()
-            
-            as2_obj = get_outbound_entity(obj, None)
-            return JsonResponse(as2_obj.to_as2(), content_type='application/activity+json')
+
+            return HttpResponse(render_as2(obj), content_type='application/activity+json')
 
         def post(request, *args, **kwargs):
             process_payload_function = get_function_from_config('process_payload_function')
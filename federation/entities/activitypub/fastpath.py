@@ -0,0 +1,410 @@
+"""
+Native JSON-LD expansion of the common inbound activity shapes, and native
+compaction of the small structures stored as plain dicts on the models.
+
+Most inbound payloads (Create, Like, Announce, Follow, Delete, Undo) only use the
+activitystreams, security and litepub contexts, plus a handful of inline extension
+terms. For those, the context is compiled once into plain lookup tables and the
+payload keys are expanded straight to the IRIs the calamus schemas are bound to,
+without going through pyld for every payload. The output is the same as
+``jsonld.expand``.
+
+Anything outside of this subset (remote contexts that are not bundled, inline
+redefinitions of standard terms, scoped contexts, unusual containers, value
+objects...) raises ``UnsupportedPayload`` and the caller falls back to the full
+JSON-LD processor.
+
+``compact`` and ``expand_node`` do the same for the flat structures handled by the
+``CompactedDict`` fields (``source``, ``endpoints``, ``publicKey``, language maps...).
+"""
+import json
+import logging
+import re
+from hashlib import sha256
+from typing import Dict, Optional
+
+from pyld import jsonld
+from pyld.jsonld import KEYWORD_PATTERN, _is_absolute_iri, _is_keyword
+
+from federation.entities.activitypub import get_bundled_context
+from federation.utils.cache import TTLCache
+
+logger = logging.getLogger("federation")
+
+# Top level types handled by the fast path
+FAST_PATH_TYPES = ("Create", "Like", "Announce", "Follow", "Delete", "Undo")
+
+# Term definition entries the fast path knows how to apply
+SUPPORTED_DEFINITION_KEYS = {
+    "@id", "@type", "@container", "@language", "reverse", "protected", "_prefix", "_term_has_colon",
+}
+SUPPORTED_CONTAINERS = {"@set", "@list", "@language"}
+
+
+class UnsupportedPayload(Exception):
+    pass
+
+
+class Term:
+    __slots__ = ("iri", "type", "container", "language")
+
+    def __init__(self, iri, type_=None, container=(), language=False):
+        self.iri = iri
+        self.type = type_
+        self.container = container
+        # False when no language is set for the term, the language (possibly None) otherwise
+        self.language = language
+
+
+class CompiledContext:
+    """
+    Lookup tables derived from a processed active context.
+
+    :arg active_ctx: pyld active context.
+    :arg base_ctx: pyld active context of the standard contexts alone. Terms of the
+        standard contexts redefined differently in ``active_ctx`` make it unsupported.
+    """
+    def __init__(self, active_ctx: Dict, base_ctx: Dict):
+        if "@language" in active_ctx or "@direction" in active_ctx:
+            raise UnsupportedPayload("default language or direction")
+        base_mappings = base_ctx["mappings"]
+        self.mappings = active_ctx["mappings"]
+        self.vocab = active_ctx.get("@vocab")
+        self.terms = {}
+        self.prefixes = {}
+        # IRI to terms, in the order pyld prefers them (shortest then least)
+        self.inverse = {}
+        for name in sorted(self.mappings, key=lambda name: (len(name), name)):
+            if self.mappings[name] and self.mappings[name].get("@id"):
+                self.inverse.setdefault(self.mappings[name]["@id"], []).append(name)
+        for name, mapping in active_ctx["mappings"].items():
+            if name in base_mappings and base_mappings[name] != mapping:
+                raise UnsupportedPayload(f"redefinition of term {name}")
+            if mapping is None:
+                self.terms[name] = None
+                continue
+            if mapping.get("_prefix"):
+                self.prefixes[name] = mapping["@id"]
+            container = frozenset(mapping.get("@container", ()))
+            if (
+                    mapping.keys() - SUPPORTED_DEFINITION_KEYS or mapping.get("reverse")
+                    or container - SUPPORTED_CONTAINERS or mapping.get("@type") == "@json"
+            ):
+                # only rejected if the payload actually uses it
+                self.terms[name] = UNSUPPORTED
+                continue
+            self.terms[name] = Term(
+                mapping["@id"], mapping.get("@type"), container, mapping.get("@language", False),
+            )
+
+    def term(self, key: str) -> Optional[Term]:
+        term = self.terms.get(key)
+        if term is UNSUPPORTED:
+            raise UnsupportedPayload(f"term {key}")
+        return term
+
+    def expand_iri(self, value, vocab=False):
+        """
+        Same as pyld's ``_expand_iri`` with an empty document base.
+        """
+        if not isinstance(value, str) or _is_keyword(value):
+            return value
+        if re.match(KEYWORD_PATTERN, value):
+            return None
+        if vocab and value in self.terms:
+            term = self.term(value)
+            return term.iri if term else None
+        prefix, colon, suffix = value.partition(":")
+        if colon and prefix:
+            if prefix == "_" or suffix.startswith("//"):
+                return value
+            if prefix in self.prefixes:
+                return self.prefixes[prefix] + suffix
+            if _is_absolute_iri(value):
+                return value
+        if vocab and self.vocab is not None:
+            return self.vocab + value
+        return value
+
+    def compact_iri(self, iri, kind=None, vocab=False):
+        """
+        Same as pyld's ``_compact_iri`` for the values handled by ``compact``.
+
+        :arg kind: "@value" for a plain literal, "@id" for a node reference, "@type" for a type.
+        """
+        if _is_keyword(iri):
+            return self.inverse.get(iri, [iri])[0]
+        if vocab and iri in self.inverse:
+            return self._select_term(iri, kind)
+        if vocab and self.vocab and iri.startswith(self.vocab) and iri != self.vocab:
+            suffix = iri[len(self.vocab):]
+            if suffix not in self.mappings:
+                return suffix
+        candidate = None
+        for prefix, prefix_iri in self.prefixes.items():
+            if ":" in prefix or prefix_iri == iri or not iri.startswith(prefix_iri):
+                continue
+            curie = f"{prefix}:{iri[len(prefix_iri):]}"
+            if curie in self.mappings:
+                raise UnsupportedPayload(f"compact IRI {curie}")
+            if candidate is None or (len(curie), curie) < (len(candidate), candidate):
+                candidate = curie
+        if candidate:
+            return candidate
+        if any(iri.startswith(f"{prefix}:") for prefix in self.prefixes):
+            raise UnsupportedPayload(f"IRI confused with prefix {iri}")
+        return iri
+
+    def _select_term(self, iri, kind):
+        plain = []
+        typed = []
+        for name in self.inverse[iri]:
+            mapping = self.mappings[name]
+            container = set(mapping.get("@container", ()))
+            if container - {"@list", "@language"} or mapping.get("reverse") or "@context" in mapping:
+                raise UnsupportedPayload(f"term {name}")
+            if container:
+                continue
+            if mapping.get("@type") == "@id":
+                typed.append(name)
+            elif mapping.get("@type") == "@vocab" and kind == "@id":
+                raise UnsupportedPayload(f"term {name}")
+            elif "@type" not in mapping and "@language" not in mapping:
+                plain.append(name)
+        if kind == "@value" and plain:
+            return plain[0]
+        if kind in ("@id", "@type") and typed:
+            return typed[0]
+        if kind == "@type" and plain:
+            return plain[0]
+        raise UnsupportedPayload(f"no term for {iri}")
+
+
+UNSUPPORTED = Term(None)
+UNDEFINED = Term(None)
+
+# Compiled contexts by fingerprint of the merged context. None marks an unsupported context.
+compiled_contexts = TTLCache(maxsize=256)
+
+
+def _process_context(ctx):
+    processor = jsonld.JsonLdProcessor()
+    initial = processor._get_initial_context({"processingMode": "json-ld-1.1"})
+    return processor.process_context(initial, ctx, {})
+
+
+def compile_context(ctx) -> Optional[CompiledContext]:
+    """
+    Return the compiled form of a (merged) payload context, None if it can't be compiled.
+    """
+    if isinstance(ctx, str):
+        ctx = [ctx]
+    canonical = json.dumps(ctx, sort_keys=True, separators=(",", ":"))
+    fingerprint = sha256(canonical.encode("utf-8")).hexdigest()
+    if fingerprint in compiled_contexts:
+        return compiled_contexts.get(fingerprint)
+    compiled = None
+    try:
+        urls = [item for item in ctx if isinstance(item, str)]
+        for item in ctx:
+            if isinstance(item, str):
+                if not get_bundled_context(item):
+                    raise UnsupportedPayload(f"remote context {item}")
+            elif not isinstance(item, dict) or any(key.startswith("@") for key in item):
+                raise UnsupportedPayload("context keywords")
+        compiled = CompiledContext(_process_context(ctx), _process_context(urls))
+    except (UnsupportedPayload, jsonld.JsonLdError) as ex:
+        logger.debug("fastpath - context not compiled: %s", ex)
+    compiled_contexts.set(fingerprint, compiled)
+    return compiled
+
+
+def _add_value(node, prop, value):
+    if isinstance(value, list):
+        node.setdefault(prop, []).extend(value)
+    else:
+        node.setdefault(prop, []).append(value)
+
+
+def _expand_value(ctx, term, value):
+    # undefined terms are expanded with the default vocabulary, without coercion
+    term = term or UNDEFINED
+    if isinstance(value, str):
+        if term.type == "@id":
+            return {"@id": ctx.expand_iri(value)}
+        if term.type == "@vocab":
+            return {"@id": ctx.expand_iri(value, vocab=True)}
+    rval = {}
+    if term.type not in (None, "@id", "@vocab", "@none"):
+        rval["@type"] = term.type
+    elif isinstance(value, str) and term.language is not False and term.language is not None:
+        rval["@language"] = term.language
+    if not isinstance(value, (bool, int, float, str)):
+        value = str(value)
+    rval["@value"] = value
+    return rval
+
+
+def _expand_language_map(ctx, value):
+    rval = []
+    for key, values in sorted(value.items()):
+        expanded_key = ctx.expand_iri(key, vocab=True)
+        for item in values if isinstance(values, list) else [values]:
+            if item is None:
+                continue
+            if not isinstance(item, str):
+                raise UnsupportedPayload("language map value")
+            val = {"@value": item}
+            if expanded_key != "@none":
+                val["@language"] = key.lower()
+            rval.append(val)
+    return rval
+
+
+def _expand(ctx, key, element, inside_list=False):
+    if element is None:
+        return None
+    if isinstance(element, list):
+        term = ctx.term(key) if key else None
+        inside_list = inside_list or bool(term and "@list" in term.container)
+        rval = []
+        for item in element:
+            item = _expand(ctx, key, item, inside_list)
+            if inside_list and isinstance(item, list):
+                raise UnsupportedPayload("list of lists")
+            if item is None:
+                continue
+            if isinstance(item, list):
+                rval.extend(item)
+            else:
+                rval.append(item)
+        return rval
+    if not isinstance(element, dict):
+        if key is None and not inside_list:
+            return None
+        return _expand_value(ctx, ctx.term(key), element)
+    return _expand_node(ctx, key, element, inside_list)
+
+
+def _expand_node(ctx, key, element, inside_list=False):
+    if key is not None and "@context" in element:
+        raise UnsupportedPayload("embedded context")
+    node = {}
+    for prop, value in sorted(element.items()):
+        if prop == "@context":
+            continue
+        expanded = ctx.expand_iri(prop, vocab=True)
+        if expanded is None:
+            continue
+        if _is_keyword(expanded):
+            if expanded == "@id":
+                if not isinstance(value, str) or "@id" in node:
+                    raise UnsupportedPayload("@id value")
+                node["@id"] = ctx.expand_iri(value)
+            elif expanded == "@type":
+                for type_ in value if isinstance(value, list) else [value]:
+                    if not isinstance(type_, str):
+                        raise UnsupportedPayload("@type value")
+                    node.setdefault("@type", []).append(ctx.expand_iri(type_, vocab=True))
+            else:
+                raise UnsupportedPayload(f"keyword {expanded}")
+            continue
+        if not _is_absolute_iri(expanded):
+            continue
+        term = ctx.term(prop)
+        container = term.container if term else ()
+        if "@language" in container and isinstance(value, dict):
+            expanded_value = _expand_language_map(ctx, value)
+        else:
+            expanded_value = _expand(ctx, prop, value)
+        if expanded_value is None:
+            continue
+        if "@list" in container and not (isinstance(expanded_value, dict) and "@list" in expanded_value):
+            expanded_value = {"@list": expanded_value if isinstance(expanded_value, list) else [expanded_value]}
+        _add_value(node, expanded, expanded_value)
+    # pyld drops top level nodes without properties
+    if key is None and not inside_list and (not node or list(node) == ["@id"]):
+        return None
+    return node
+
+
+def expand_node(document: Dict) -> Dict:
+    """
+    Same as ``jsonld.expand(document)[0]``.
+
+    :raises UnsupportedPayload: when the document must go through the full JSON-LD processor.
+    """
+    ctx = compile_context(document.get("@context") or [])
+    if not ctx:
+        raise UnsupportedPayload("context")
+    expanded = _expand_node(ctx, None, document)
+    if expanded is None:
+        raise UnsupportedPayload("empty document")
+    return expanded
+
+
+def expand(payload: Dict) -> Dict:
+    """
+    Expand a compacted payload of one of the ``FAST_PATH_TYPES``.
+
+    The payload context is expected to have been merged by the ``LdContextManager``.
+
+    :raises UnsupportedPayload: when the payload must go through the full JSON-LD processor.
+    """
+    if payload.get("type") not in FAST_PATH_TYPES:
+        raise UnsupportedPayload(f"type {payload.get('type')}")
+    return expand_node(payload)
+
+
+def compact(node: Dict, context) -> Dict:
+    """
+    Same as ``jsonld.compact(node, context)``, without the ``@context`` entry, for a flat
+    expanded node: plain literals and node references only.
+
+    :raises UnsupportedPayload: when the node must go through the full JSON-LD processor.
+    """
+    ctx = compile_context(context)
+    if not ctx:
+        raise UnsupportedPayload("context")
+    if not isinstance(node, dict) or not node.keys() - {"@id"}:
+        raise UnsupportedPayload("empty node")
+    rval = {}
+    for prop, values in sorted(node.items()):
+        if prop == "@id":
+            if not isinstance(values, str):
+                raise UnsupportedPayload("@id value")
+            rval[ctx.compact_iri("@id")] = ctx.compact_iri(values)
+            continue
+        if prop == "@type":
+            types = values if isinstance(values, list) else [values]
+            if not types or not all(isinstance(type_, str) for type_ in types):
+                raise UnsupportedPayload("@type value")
+            alias = ctx.compact_iri("@type")
+            if alias in ctx.mappings and ctx.mappings[alias].get("@container"):
+                raise UnsupportedPayload("@type container")
+            types = [ctx.compact_iri(type_, "@type", vocab=True) for type_ in types]
+            rval[alias] = types[0] if len(types) == 1 else types
+            continue
+        if _is_keyword(prop) or not _is_absolute_iri(prop) or not isinstance(values, list) or not values:
+            raise UnsupportedPayload(f"property {prop}")
+        for item in values:
+            if not isinstance(item, dict) or len(item) != 1:
+                raise UnsupportedPayload(f"value of {prop}")
+            if isinstance(item.get("@value"), (bool, int, float, str)):
+                key = ctx.compact_iri(prop, "@value", vocab=True)
+                value = item["@value"]
+            elif isinstance(item.get("@id"), str):
+                key = ctx.compact_iri(prop, "@id", vocab=True)
+                value = ctx.compact_iri(item["@id"])
+                if (ctx.mappings.get(key) or {}).get("@type") != "@id":
+                    # node reference compacted as an object
+                    value = {ctx.compact_iri("@id"): value}
+            else:
+                raise UnsupportedPayload(f"value of {prop}")
+            if key not in rval:
+                rval[key] = value
+            elif isinstance(rval[key], list):
+                rval[key].append(value)
+            else:
+                rval[key] = [rval[key], value]
+    return rval
@@ -1,10 +1,25 @@
 import copy
 import json
+from hashlib import sha256
 
+from frozendict import frozendict
 from marshmallow import missing
+from marshmallow.fields import List, Nested
 from pyld import jsonld
 
 from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY, NAMESPACE_PUBLIC
+from federation.utils.cache import TTLCache
+
+
+def freeze(value):
+    """
+    Recursively turn dicts into frozendicts. pyld handles frozendict contexts.
+    """
+    if isinstance(value, dict):
+        return frozendict({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [freeze(v) for v in value]
+    return value
 
 
 # Extract context information from the metadata parameter defined for fields
@@ -17,8 +32,12 @@ class LdContextManager:
     _merged = []
     _models = []
 
-    def __init__(self, models):
+    def __init__(self, models, merge_cache_size=256):
         self._models = models
+        # Inbound payloads use a limited number of distinct @context shapes
+        self._merge_cache = TTLCache(maxsize=merge_cache_size)
+        # Outbound context plans, computed once per class
+        self._plans = {}
         for klass in models:
             self._extensions[klass] = {}
             ctx = getattr(klass, 'ctx', [])
@@ -42,9 +61,9 @@ class LdContextManager:
             elif isinstance(item, dict):
                 extensions.update(item)
 
-    def _get_fields(self, obj):
+    def _get_fields(self, cls):
         for klass in self._extensions.keys():
-            if issubclass(type(obj), klass):
+            if issubclass(cls, klass):
                 return self._extensions[klass]
         return {}
 
@@ -75,21 +94,66 @@ class LdContextManager:
         patch_payload(payload, patched)
         return patched
 
+    def _split_extensions(self, ctx):
+        """
+        Split a ctx metadata list in a tuple of context URLs and a dict of term definitions.
+        """
+        urls = tuple(item for item in ctx if isinstance(item, str))
+        defs = {}
+        for item in ctx:
+            if isinstance(item, dict):
+                defs.update(item)
+        return urls, defs
+
+    def _get_plan(self, klass):
+        """
+        Return the outbound context plan for a class.
+
+        The plan is a tuple of the class extensions (or None) and a tuple of
+        (field name, field extensions or None, may hold nested objects) for the
+        fields that either add extensions or can hold nested objects.
+        """
+        plan = self._plans.get(klass)
+        if plan is not None:
+            return plan
+
+        to_add = self._get_fields(klass)
+        class_ctx = self._extensions.get(klass, {}).get(klass.__name__)
+        fields = []
+        for name, field in klass.schema().declared_fields.items():
+            ctx = to_add.get(name)
+            nested = isinstance(field, Nested) or (isinstance(field, List) and isinstance(field.inner, Nested))
+            if ctx or nested:
+                fields.append((name, self._split_extensions(ctx) if ctx else None, nested))
+        plan = (self._split_extensions(class_ctx) if class_ctx else None, tuple(fields))
+        self._plans[klass] = plan
+        return plan
+
     def build_context(self, obj):
         from federation.entities.activitypub.models import Object, Link
 
         final = [CONTEXT_ACTIVITYSTREAMS]
+        seen = {CONTEXT_ACTIVITYSTREAMS}
         extensions = {}
 
+        def add(ctx):
+            urls, defs = ctx
+            for url in urls:
+                if url not in seen:
+                    seen.add(url)
+                    final.append(url)
+            extensions.update(defs)
+
         def walk_object(obj):
-            if type(obj) in self._extensions.keys():
-                self._add_extensions(self._extensions[type(obj)].get(type(obj).__name__, []), final, extensions)
-            to_add = self._get_fields(obj)
-            for field in type(obj).schema().declared_fields.keys():
+            class_ctx, fields = self._get_plan(type(obj))
+            if class_ctx:
+                add(class_ctx)
+            for field, ctx, nested in fields:
                 field_value = getattr(obj, field)
-                if field in to_add.keys():
-                    if field_value is not missing or obj.signable and field == 'signature':
-                        self._add_extensions(to_add[field], final, extensions)
+                if ctx and (field_value is not missing or obj.signable and field == 'signature'):
+                    add(ctx)
+                if not nested:
+                    continue
                 if not isinstance(field_value, list):
                     field_value = [field_value]
                 for value in field_value:
@@ -103,6 +167,24 @@ class LdContextManager:
         return final if len(final) > 1 else final[0]
 
     def merge_context(self, ctx):
+        """
+        Return the inbound context merged with the AP extensions as an immutable tuple.
+
+        Results are cached by a fingerprint of the input context, which is not modified.
+        """
+        canonical = json.dumps(ctx, sort_keys=True, separators=(',', ':'))
+        fingerprint = sha256(canonical.encode('utf-8')).hexdigest()
+        merged = self._merge_cache.get(fingerprint)
+        if merged is None:
+            # work on a mutable copy of the input
+            merged = tuple(freeze(item) for item in self._merge_context(json.loads(canonical)))
+            self._merge_cache.set(fingerprint, merged)
+        return merged
+
+    def merge_cache_stats(self):
+        return self._merge_cache.stats()
+
+    def _merge_context(self, ctx):
         # One platform sends a single string context
         if isinstance(ctx, str):
             ctx = [ctx]
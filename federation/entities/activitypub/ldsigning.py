@@ -1,22 +1,49 @@
 import datetime
+import json
 import logging
 import math
+import random
 import re
+import threading
 from base64 import b64encode, b64decode
+from collections import Counter
 from copy import copy
+from hashlib import sha256
 from funcy import omit
 from pyld import jsonld
 
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
 from Crypto.Hash import SHA256
-from Crypto.PublicKey.RSA import import_key
+from Crypto.PublicKey.RSA import RsaKey
 from Crypto.Signature import pkcs1_15
 
 from federation.entities.utils import get_profile
-from federation.utils.activitypub import retrieve_and_parse_document
+from federation.utils.activitypub import refetch_public_key, retrieve_public_key
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_setting
+from federation.utils.keys import (
+    ED25519_KEY_FRAGMENT, base58_decode, base58_encode, import_ed25519_key, import_rsa_key,
+)
 
 
 logger = logging.getLogger("federation")
 
+# N-Quads digests by fingerprint of the canonical JSON document. Relayed payloads
+# reach us several times and are verified again each time.
+hash_cache = TTLCache(maxsize=get_setting("ld_signature_cache_size", 1024))
+
+# When inbound LD signatures are verified:
+# - relayed: only for relayed payloads, the HTTP signature proves the other ones
+# - sampled: relayed payloads and a percentage of the other ones, for monitoring
+# - always: every inbound signed payload
+LD_SIGNATURE_POLICIES = ("relayed", "sampled", "always")
+
+EDDSA_JCS_CRYPTOSUITE = "eddsa-jcs-2022"
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
 
 def create_ld_signature(obj, author):
     # Use models.Signature? Maybe overkill...
@@ -27,7 +54,7 @@ def create_ld_signature(obj, author):
     }
 
     try:
-        private_key = import_key(author.private_key)
+        private_key = import_rsa_key(author.private_key)
     except (ValueError, TypeError) as exc:
         logger.warning('ld_signature - %s', exc)
         return None
@@ -44,28 +71,196 @@ def create_ld_signature(obj, author):
     obj.update({'signature': sig})
 
 
+def create_data_integrity_proof(obj, author):
+    """
+    Add an eddsa-jcs-2022 DataIntegrityProof to an outbound document, signed with
+    the author Ed25519 key. The document is canonicalized with JCS instead of URDNA2015.
+    """
+    try:
+        private_key = import_ed25519_key(author.ed25519_private_key)
+    except (ValueError, TypeError) as exc:
+        logger.warning('data_integrity_proof - %s', exc)
+        return None
+    if not isinstance(private_key, Ed25519PrivateKey):
+        logger.warning('data_integrity_proof - %s is not a private key', author.id)
+        return None
+
+    proof = {
+        'type': 'DataIntegrityProof',
+        'cryptosuite': EDDSA_JCS_CRYPTOSUITE,
+        'verificationMethod': f'{author.id}#{ED25519_KEY_FRAGMENT}',
+        'proofPurpose': 'assertionMethod',
+        'created': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec='seconds').replace(
+            '+00:00', 'Z'),
+    }
+    signature = private_key.sign(proof_hash(proof, obj))
+    proof['proofValue'] = 'z' + base58_encode(signature)
+    obj.update({'proof': proof})
+
+
+def proof_hash(proof, document):
+    """
+    The eddsa-jcs-2022 hash of a proof configuration (the proof without its value) and of the
+    document it secures (without the proof).
+    """
+    proof_config = omit(proof, ('proofValue',))
+    if '@context' in document:
+        proof_config['@context'] = document['@context']
+    return sha256(jcs(proof_config)).digest() + sha256(jcs(omit(document, ('proof',)))).digest()
+
+
+def _count(*keys):
+    with _stats_lock:
+        _stats.update(keys)
+
+
+def get_ld_signature_stats():
+    """
+    Return the inbound LD signature counters: payloads verified per policy reason
+    (relayed, always, sampled), skipped payloads and verification results (valid, invalid, unsigned).
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_ld_signature_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_ld_signature_policy():
+    policy = get_setting("ld_signature_verification", "always")
+    if policy not in LD_SIGNATURE_POLICIES:
+        logger.warning("ld_signature - unknown verification policy %s, verifying always", policy)
+        return "always"
+    return policy
+
+
+def use_rsa_fallback():
+    """
+    Whether to keep signing with RSA the documents which have an Ed25519 proof, for the platforms not supporting them.
+    """
+    return get_setting("ld_signature_rsa_fallback", True)
+
+
+def should_verify_ld_signature(relayed=False, policy=None):
+    """
+    Decide if an inbound payload LD signature must be verified, according to the
+    ``ld_signature_verification`` policy. Relayed payloads are always verified.
+    """
+    policy = policy or get_ld_signature_policy()
+    if relayed:
+        reason = "relayed"
+    elif policy == "always":
+        reason = "always"
+    elif policy == "sampled" and random.random() * 100 < get_setting("ld_signature_sample_rate", 10):
+        reason = "sampled"
+    else:
+        reason = "skipped"
+    _count(reason)
+    return reason != "skipped"
+
+
 def verify_ld_signature(payload):
     """
     Verify inbound payload LD signature
+
+    An eddsa-jcs-2022 DataIntegrityProof is verified first, the RsaSignature2017 signature
+    is the fallback.
     """
+    actor = _verify_data_integrity_proof(payload) if payload.get('proof') else None
+    if not actor:
+        actor = _verify_ld_signature(payload)
+    _count("valid" if actor else "invalid" if payload.get("signature") or payload.get("proof") else "unsigned")
+    return actor
+
+
+def _get_proof(payload):
+    proofs = payload.get('proof')
+    for proof in proofs if isinstance(proofs, list) else [proofs]:
+        if isinstance(proof, dict) and proof.get('type') == 'DataIntegrityProof' and \
+                proof.get('cryptosuite') == EDDSA_JCS_CRYPTOSUITE and proof.get('proofPurpose') == 'assertionMethod':
+            return proof
+
+
+def _verify_data_integrity_proof(payload):
+    proof = _get_proof(payload)
+    if not proof:
+        logger.debug('data_integrity_proof - No supported proof in %s', payload.get("id", "the payload"))
+        return None
+    proof_value = proof.get('proofValue')
+    try:
+        sig_value = base58_decode(proof_value[1:]) if proof_value.startswith('z') else None
+    except (AttributeError, ValueError):
+        sig_value = None
+    if not sig_value or len(sig_value) != 64:
+        logger.warning('data_integrity_proof - Invalid proof value for %s', payload.get("id"))
+        return None
+    if '@context' in proof:
+        # The proof context must be the beginning of the document context
+        contexts = payload.get('@context')
+        contexts, proof_contexts = [contexts if isinstance(contexts, list) else [contexts],
+                                    proof['@context'] if isinstance(proof['@context'], list) else [proof['@context']]]
+        if contexts[:len(proof_contexts)] != proof_contexts:
+            logger.warning('data_integrity_proof - Proof context mismatch for %s', payload.get("id"))
+            return None
+        payload = dict(payload, **{'@context': proof['@context']})
+
+    key_id = proof.get('verificationMethod')
+    public_key = retrieve_public_key(key_id) if isinstance(key_id, str) else None
+    if not public_key or not isinstance(public_key.key, Ed25519PublicKey):
+        logger.warning('data_integrity_proof - Failed to retrieve the Ed25519 key for %s', key_id)
+        return None
+    # Documents signed with RSA after the proof was added
+    documents = [payload, omit(payload, ('signature',))] if payload.get('signature') else [payload]
+    if not _is_valid_proof(public_key.key, proof, documents, sig_value):
+        # The key may have been rotated, try again once with a fresh copy
+        public_key = refetch_public_key(key_id, stale_key=public_key.pem)
+        if not public_key or not isinstance(public_key.key, Ed25519PublicKey) or \
+                not _is_valid_proof(public_key.key, proof, documents, sig_value):
+            logger.warning('data_integrity_proof - Invalid proof for %s', payload.get("id"))
+            return None
+    logger.debug('data_integrity_proof - %s has a valid proof', payload.get("id"))
+    return public_key.owner
+
+
+def _is_valid_proof(pkey, proof, documents, sig_value):
+    for document in documents:
+        try:
+            pkey.verify(sig_value, proof_hash(proof, document))
+            return True
+        except InvalidSignature:
+            pass
+    return False
+
+
+def _verify_ld_signature(payload):
     signature = copy(payload.get('signature', None))
     if not signature:
         logger.warning('ld_signature - No signature in %s', payload.get("id", "the payload"))
         return None
 
     # retrieve the author's public key
-    profile = get_profile(key_id=signature.get('creator'))
-    if not profile:
-        profile = retrieve_and_parse_document(signature.get('creator'))
-    if not profile:
-        logger.warning('ld_signature - Failed to retrieve profile for %s', signature.get("creator"))
-        return None
-    try:
-        pkey = import_key(profile.public_key)
-    except ValueError as exc:
-        logger.warning('ld_signature - %s', exc)
+    key_id = signature.get('creator')
+    profile = get_profile(key_id=key_id)
+    if profile:
+        signer, pem = profile.id, profile.public_key
+        try:
+            pkey = import_rsa_key(pem)
+        except ValueError as exc:
+            logger.warning('ld_signature - %s', exc)
+            return None
+    else:
+        # Only the key is needed, the full profile parsing is skipped
+        public_key = retrieve_public_key(key_id) if key_id else None
+        if not public_key:
+            logger.warning('ld_signature - Failed to retrieve the public key for %s', key_id)
+            return None
+        signer, pem, pkey = public_key.owner, public_key.pem, public_key.key
+
+    if not isinstance(pkey, RsaKey):
+        logger.warning('ld_signature - %s is not a RSA key', key_id)
         return None
-    verifier = pkcs1_15.new(pkey)
 
     # Compute digests and verify signature
     sig = omit(signature, ('type', 'signatureValue'))
@@ -73,19 +268,92 @@ def verify_ld_signature(payload):
     sig_digest = hash(sig)
     obj = omit(payload, 'signature')
     obj_digest = hash(obj)
-    digest = (sig_digest + obj_digest).encode('utf-8')
+    digest = SHA256.new((sig_digest + obj_digest).encode('utf-8'))
 
     try:
         sig_value = b64decode(signature.get('signatureValue'))
-        verifier.verify(SHA256.new(digest), sig_value)
-        logger.debug('ld_signature - %s has a valid signature', payload.get("id"))
-        return profile.id
-    except ValueError:
-        logger.warning('ld_signature - Invalid signature for %s', payload.get("id"))
+    except (TypeError, ValueError):
+        logger.warning('ld_signature - Invalid signature value for %s', payload.get("id"))
         return None
+    if not _is_valid(pkey, digest, sig_value):
+        # The key may have been rotated, try again once with a fresh copy
+        public_key = refetch_public_key(key_id, stale_key=pem) if key_id else None
+        if not public_key or not _is_valid(public_key.key, digest, sig_value):
+            logger.warning('ld_signature - Invalid signature for %s', payload.get("id"))
+            return None
+        signer = public_key.owner
+    logger.debug('ld_signature - %s has a valid signature', payload.get("id"))
+    return signer
+
+
+def _is_valid(pkey, digest, sig_value):
+    try:
+        pkcs1_15.new(pkey).verify(digest, sig_value)
+        return True
+    except ValueError:
+        return False
+
+
+def jcs(obj):
+    """
+    Serialize a JSON document with the JSON Canonicalization Scheme (RFC 8785).
+    """
+    return _jcs(obj).encode('utf-8')
+
+
+def _jcs(value):
+    if isinstance(value, dict):
+        # keys are sorted by UTF-16 code units
+        items = sorted(value.items(), key=lambda item: item[0].encode('utf-16-be'))
+        return '{' + ','.join(f'{_jcs(str(key))}:{_jcs(item)}' for key, item in items) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(_jcs(item) for item in value) + ']'
+    if isinstance(value, float):
+        return _jcs_number(value)
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _jcs_number(value):
+    """
+    Format a float like the ECMAScript Number.prototype.toString.
+    """
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError('JCS does not support NaN and Infinity')
+    if value == 0:
+        return '0'
+    sign = '-' if value < 0 else ''
+    mantissa, _, exponent = repr(abs(value)).partition('e')
+    integer, _, fraction = mantissa.partition('.')
+    all_digits = integer + fraction.rstrip('0')
+    digits = all_digits.lstrip('0')
+    # value = 0.digits * 10 ** n
+    n = len(integer) + int(exponent or 0) - (len(all_digits) - len(digits))
+    digits = digits.rstrip('0')
+    k = len(digits)
+    if k <= n <= 21:
+        return sign + digits + '0' * (n - k)
+    if 0 < n <= 21:
+        return sign + digits[:n] + '.' + digits[n:]
+    if -6 < n <= 0:
+        return sign + '0.' + '0' * -n + digits
+    e = n - 1
+    return sign + digits[0] + ('.' + digits[1:] if k > 1 else '') + ('e+' if e >= 0 else 'e-') + str(abs(e))
 
 
 def hash(obj):
+    try:
+        canonical = json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except (TypeError, ValueError):
+        return _hash(obj)
+    fingerprint = sha256(canonical.encode('utf-8')).hexdigest()
+    digest = hash_cache.get(fingerprint)
+    if digest is None:
+        digest = _hash(obj)
+        hash_cache.set(fingerprint, digest)
+    return digest
+
+
+def _hash(obj):
     nquads = NormalizedDoubles().normalize(obj, options={'format': 'application/nquads', 'algorithm': 'URDNA2015'})
     return SHA256.new(nquads.encode('utf-8')).hexdigest()
 
@@ -2,7 +2,9 @@ import copy
 import json
 import logging
 import re
+import threading
 import uuid
+from datetime import datetime
 from operator import attrgetter
 from typing import List, Dict, Union
 from unicodedata import normalize
@@ -20,9 +22,11 @@ from marshmallow.utils import EXCLUDE, missing
 from pyld import jsonld
 
 import federation.entities.base as base
+from federation.entities.activitypub import fastpath
 from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY, NAMESPACE_PUBLIC
 from federation.entities.activitypub.ldcontext import LdContextManager
-from federation.entities.activitypub.ldsigning import create_ld_signature, verify_ld_signature
+from federation.entities.activitypub.ldsigning import create_data_integrity_proof, \
+    create_ld_signature, should_verify_ld_signature, use_rsa_fallback, verify_ld_signature
 from federation.entities.mixins import BaseEntity, RawContentMixin
 from federation.entities.utils import get_base_attributes, get_profile
 from federation.outbound import handle_send
@@ -122,8 +126,11 @@ class CompactedDict(fields.Dict):
     def _serialize(self, value, attr, obj, **kwargs):
         if value and isinstance(value, dict):
             value['@context'] = self.ctx
-            value = jsonld.expand(value)
-            if value and isinstance(value, list): value = value[0]
+            try:
+                value = fastpath.expand_node(value)
+            except fastpath.UnsupportedPayload:
+                value = jsonld.expand(value)
+                if value and isinstance(value, list): value = value[0]
         return super()._serialize(value, attr, obj, **kwargs)
 
     def _deserialize(self, value, attr, data, **kwargs):
@@ -133,6 +140,11 @@ class CompactedDict(fields.Dict):
             if isinstance(value, list) and str(as2.content) not in value[0].keys():
                 value = [{str(as2.content): value, str(as2.mediaType): 'text/plain'}]
         ret = super()._deserialize(value, attr, data, **kwargs)
+        # pyld is only needed for unexpected shapes
+        try:
+            return fastpath.compact(ret, self.ctx)
+        except fastpath.UnsupportedPayload:
+            pass
         ret = jsonld.compact(ret, self.ctx)
         ret.pop('@context')
         return ret
@@ -177,6 +189,25 @@ class LanguageMap(CompactedDict):
         return super()._deserialize(ret, attr, data, **kwargs)
 
 
+def get_parent_schema(model, schemas):
+    return next((schemas[klass] for klass in model.__mro__[1:] if klass in schemas), None)
+
+
+def add_subclass_schemas(schemas):
+    """
+    Map the subclasses of the nested models (ie Post and Comment) to the schema of their
+    closest nested parent class.
+    """
+    complete = dict(schemas)
+    pending = list(schemas)
+    while pending:
+        for subclass in pending.pop().__subclasses__():
+            if subclass not in complete:
+                complete[subclass] = get_parent_schema(subclass, schemas)
+                pending.append(subclass)
+    return complete
+
+
 class MixedField(fields.Nested):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -186,8 +217,23 @@ class MixedField(fields.Nested):
         super()._bind_to_schema(field_name, schema)
         self.iri.parent = self.parent
 
+    @property
+    def schema(self):
+        if not self._schema:
+            schema = super().schema
+            # Completed once when built, the mapping is only read afterwards: schemas are
+            # shared by the threads loading and dumping entities.
+            schema['to'] = add_subclass_schemas(schema['to'])
+        return self._schema
+
     def _serialize_single_obj(self, obj, **kwargs):
         if isinstance(obj, str): return self.iri._serialize(obj, None, None, **kwargs)
+        if type(obj) not in self.schema['to']:
+            # Subclass defined after the schema was built
+            schema = get_parent_schema(type(obj), self.schema['to'])
+            if schema is not None:
+                schema._top_level = False
+                return schema.dump(obj)
         return super()._serialize_single_obj(obj, **kwargs)
 
     def _serialize(self, value, attr, obj, **kwargs):
@@ -247,7 +293,64 @@ def set_public(entity):
         elif attr == NAMESPACE_PUBLIC: entity.public = True
 
 
-class Object(BaseEntity, metaclass=JsonLDAnnotation):
+# Values compared by equality rather than identity when tracking entity changes
+VERSIONED_SCALARS = (str, int, float, bool, type(None), datetime)
+# Exact types of the immutable values, copied as is in snapshots
+SCALAR_TYPES = frozenset(VERSIONED_SCALARS)
+
+
+def as2_snapshot(value, seen):
+    """
+    Snapshot the content of a value, for the comparison of ``AS2Versioned._as2_state``.
+
+    Containers are copied into tuples, so that their in place changes are detected. Nested
+    versioned objects are represented by their own state.
+    """
+    if isinstance(value, AS2Versioned):
+        return value._as2_state(seen)
+    if isinstance(value, dict):
+        items = tuple(value.items())
+        if SCALAR_TYPES.issuperset(map(type, value.values())):
+            return (dict,) + items
+        return (dict,) + tuple((key, as2_snapshot(item, seen)) for key, item in items)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = tuple(value)
+        if SCALAR_TYPES.issuperset(map(type, items)):
+            return (type(value),) + items
+        return (type(value),) + tuple(as2_snapshot(item, seen) for item in items)
+    return value
+
+
+class AS2Versioned:
+    """
+    Counts the attribute assignments that change an entity, so that its compacted
+    AS2 document can be reused until the entity or one of its nested objects changes.
+
+    The content of the list, dict, tuple and set values is compared too, to detect their in place changes.
+    """
+    _as2_version = 0
+
+    def __setattr__(self, name, value):
+        if not name.startswith('_as2'):
+            current = self.__dict__.get(name, missing)
+            if current is not value and not (
+                    isinstance(value, VERSIONED_SCALARS) and type(current) is type(value) and current == value):
+                self.__dict__['_as2_version'] = self._as2_version + 1
+        super().__setattr__(name, value)
+
+    def _as2_state(self, seen=None):
+        seen = set() if seen is None else seen
+        if id(self) in seen:
+            return ()
+        seen.add(id(self))
+        state = [id(self), self._as2_version]
+        for name, value in list(self.__dict__.items()):
+            if isinstance(value, (AS2Versioned, dict, list, tuple, set, frozenset)) and not name.startswith('_as2'):
+                state.append((name, as2_snapshot(value, seen)))
+        return tuple(state)
+
+
+class Object(AS2Versioned, BaseEntity, metaclass=JsonLDAnnotation):
     atom_url = fields.String(ostatus.atomUri)
     also_known_as = IRI(as2.alsoKnownAs,
                         metadata={'ctx':[{ 'alsoKnownAs':{'@id':'as:alsoKnownAs','@type':'@id'}}]})
@@ -352,11 +455,20 @@ class Object(BaseEntity, metaclass=JsonLDAnnotation):
 
     def to_as2(self):
         obj = self.activity if isinstance(self.activity, Activity) else self
-        return context_manager.compact(obj)
+        # The compacted document is reused until the entity or its nested objects change
+        document = obj.__dict__.get('_as2_document')
+        if document is None or document[0] != obj._as2_state():
+            payload = context_manager.compact(obj)
+            # The compaction may set attributes, the state is taken once it is done
+            document = obj._as2_document = (obj._as2_state(), payload)
+        return copy.deepcopy(document[1])
 
     def sign_as2(self, sender=None):
         obj = self.to_as2()
-        if self.signable and sender: create_ld_signature(obj, sender)
+        if self.signable and sender:
+            # The RSA signature covers the proof, the proof verification ignores the signature
+            if getattr(sender, 'ed25519_private_key', None): create_data_integrity_proof(obj, sender)
+            if use_rsa_fallback() or 'proof' not in obj: create_ld_signature(obj, sender)
         return obj
 
     @classmethod
@@ -378,7 +490,7 @@ class Object(BaseEntity, metaclass=JsonLDAnnotation):
     def validate(self, direction='inbound'):
         if direction == 'inbound':
             # ensure marshmallow.missing is not sent to the client app
-            for attr in type(self).schema().load_fields.keys():
+            for attr in get_schema(type(self)).load_fields.keys():
                 if getattr(self, attr) is missing:
                     setattr(self, attr, None)
 
@@ -390,14 +502,14 @@ class Object(BaseEntity, metaclass=JsonLDAnnotation):
         # if it was sent, not retrieved.
         if not self._source_object or (not self._sender and isinstance(self, Person)):
             return
-        # Always verify inbound LD signature, for monitoring purposes
-        actor = verify_ld_signature(self._source_object)
-        if not self._sender:
-            return
-        if self.signable and self._sender not in (self.id, getattr(self, 'actor_id', None)):
-            # Relayed payload
-            if not actor:
-                raise InvalidSignature('no or invalid signature for %s, a relayed payload', self.id)
+        relayed = bool(self._sender) and self.signable and \
+            self._sender not in (self.id, getattr(self, 'actor_id', None))
+        # Other inbound LD signatures are verified for monitoring purposes, depending on the policy
+        actor = None
+        if should_verify_ld_signature(relayed):
+            actor = verify_ld_signature(self._source_object)
+        if relayed and not actor:
+            raise InvalidSignature('no or invalid signature for %s, a relayed payload', self.id)
 
     def to_string(self):
         # noinspection PyUnresolvedReferences
@@ -409,8 +521,7 @@ class Object(BaseEntity, metaclass=JsonLDAnnotation):
         @pre_load
         def patch_context(self, data, **kwargs):
             if not data.get('@context'): return data
-            ctx = copy.copy(data['@context'])
-            data['@context'] = context_manager.merge_context(ctx)
+            data['@context'] = list(context_manager.merge_context(data['@context']))
             return data
 
         # JSONLD specs states it is case sensitive.
@@ -418,14 +529,12 @@ class Object(BaseEntity, metaclass=JsonLDAnnotation):
         # for platforms that ignore the spec.
         @pre_load
         def patch_types(self, data, **kwargs):
-            def walk_payload(payload):
-                for key,val in copy.copy(payload).items():
-                    if isinstance(val, dict):
-                        walk_payload(val)
-                    if key == 'type':
-                        payload[key] = MODEL_NAMES.get(val.lower(), val)
-                return payload
-            return walk_payload(data)
+            # Expanded documents (nested objects, fast path) have nothing to patch
+            if 'type' not in data: return data
+            changes = normalize_types(data)
+            if changes:
+                logger.debug("patch_types - fixed type casing for %s: %s", data.get('id'), changes)
+            return data
 
         # A node without an id isn't true json-ld, but many payloads have
         # id-less nodes. Since calamus forces random ids on such nodes, 
@@ -540,7 +649,7 @@ class Infohash(Object):
         rdf_type = pt.Infohash
 
 
-class Link(metaclass=JsonLDAnnotation):
+class Link(AS2Versioned, metaclass=JsonLDAnnotation):
     href = IRI(as2.href)
     rel = fields.List(as2.rel, cls_or_instance=fields.String(as2.rel))
     media_type = fields.String(as2.mediaType)
@@ -887,19 +996,21 @@ class Note(Object, RawContentMixin):
 
         if self.activity_id:
             activity = Update if edited else Create
-            activity.schema().declared_fields['object_'].schema['to'][type(self)] = Note.schema()
-            self.activity=activity(
-                    activity_id=self.activity_id, 
-                    created_at=self.created_at, 
+            kwargs = dict(
+                    activity_id=self.activity_id,
+                    created_at=self.created_at,
                     actor_id=self.actor_id,
-                    object_ = self,
                     to = self.to,
                     cc = self.cc
                     )
+            if type(self.activity) is activity and self.activity is self.__dict__.get('_as2_activity'):
+                # Keep the activity built previously, and its compacted document if nothing changed
+                for key, value in kwargs.items():
+                    setattr(self.activity, key, value)
+            else:
+                self.activity = self._as2_activity = activity(object_=self, **kwargs)
 
-        as2 = super().to_as2()
-        if self.activity_id: del activity.schema().declared_fields['object_'].schema['to'][type(self)]
-        return as2
+        return super().to_as2()
 
     def to_base(self):
         kwargs = get_base_attributes(self, keep=(
@@ -1585,12 +1696,91 @@ def element_to_objects(element: Union[Dict, Object], sender: str = "") -> List:
         return []
 
 
+# Payload nesting levels walked by normalize_types, deeper objects are left untouched
+MAX_PAYLOAD_DEPTH = 32
+
+
+def normalize_types(payload, max_depth=MAX_PAYLOAD_DEPTH):
+    """
+    Fix, in place, the casing of the type names implemented by the models.
+
+    JSON-LD is case sensitive, but some platforms ignore it. The payload is
+    walked once, iteratively, down to ``max_depth`` levels of dicts and lists.
+
+    Returns the list of (path, original, fixed) changes.
+    """
+    changes = []
+    stack = [(payload, 0, ())]
+    while stack:
+        node, depth, path = stack.pop()
+        if isinstance(node, dict):
+            items = node.items()
+        else:
+            items = enumerate(node)
+        for key, val in items:
+            if isinstance(val, (dict, list)):
+                if depth < max_depth:
+                    stack.append((val, depth + 1, path + (key,)))
+            elif key == 'type' and isinstance(val, str):
+                fixed = MODEL_NAMES.get(val.lower(), val)
+                if fixed != val:
+                    # replacing an existing key doesn't change the dict size during iteration
+                    node[key] = fixed
+                    changes.append((path + (key,), val, fixed))
+    return changes
+
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+
+
+def get_schema(model, **options):
+    """
+    Return the shared schema instance of a model for the given schema options.
+
+    Schemas are built once per process, along with the schemas of their nested
+    fields, and reused for every load and dump.
+    """
+    key = (model, tuple(sorted(options.items())))
+    schema = _schemas.get(key)
+    if schema is None:
+        with _schemas_lock:
+            schema = _schemas.get(key)
+            if schema is None:
+                schema = model.schema(**options)
+                # nested schemas are otherwise built lazily, on first use
+                for field in schema.fields.values():
+                    field = getattr(field, 'inner', field)
+                    if isinstance(field, fields.Nested):
+                        field.schema
+                _schemas[key] = schema
+    return schema
+
+
+def load_payload(model, payload):
+    """
+    Deserialize a payload with the model schema.
+
+    The common activity shapes are expanded natively, skipping the JSON-LD
+    processor, everything else goes through the full calamus path.
+    """
+    schema = get_schema(model)
+    if payload.get('type') in fastpath.FAST_PATH_TYPES:
+        # the pre_load hooks are no-ops on the expanded payload
+        payload = schema.patch_types(schema.patch_context(payload))
+        try:
+            payload = fastpath.expand(payload)
+        except fastpath.UnsupportedPayload as exc:
+            logger.debug("fastpath - falling back to the JSON-LD processor (%s)", exc)
+    return schema.load(payload)
+
+
 def model_to_objects(payload):
     original_payload = copy.copy(payload)
     model = globals().get(payload.get('type'))
     if model and issubclass(model, Object):
         try:
-            entity = model.schema().load(payload)
+            entity = load_payload(model, payload)
         except (KeyError, jsonld.JsonLdError, exceptions.ValidationError) as exc :  # Just give up for now. This must be made robust
             logger.error("Error parsing jsonld payload (%s)", exc)
             return None
@@ -16,3 +16,21 @@ class NoSuitableProtocolFoundError(Exception):
 class SignatureVerificationError(Exception):
     """Authenticity of the signature could not be verified given the key."""
     pass
+
+
+class InvalidRequestSignatureError(ValueError):
+    """HTTP signature of a request does not match the given public key."""
+    pass
+
+
+class RequestRejectedError(Exception):
+    """Inbound request was rejected before being processed."""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class BlockedDomainError(RequestRejectedError):
+    """Request was rejected, or a fetch skipped, as the domain is blocked by the domain policy."""
+    def __init__(self, message, status_code=403):
+        super().__init__(message, status_code=status_code)
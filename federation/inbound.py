@@ -1,10 +1,17 @@
 import importlib
 import logging
-from typing import Tuple, List, Callable
+from typing import Tuple, List, Callable, Iterable, Optional, Union
 
 from federation.entities.base import Profile
-from federation import identify_protocol_by_request
-from federation.types import UserType, RequestType
+from federation import identify_protocol_by_headers, identify_protocol_by_request
+from federation.exceptions import BlockedDomainError, RequestRejectedError
+from federation.types import DuplicateResult, UserType, RequestType
+from federation.utils.django import get_setting
+from federation.utils.dedupe import get_dedupe_key, get_seen_activity, remember_activity
+from federation.utils.policy import is_domain_allowed
+from federation.utils.queue import InboundQueue, QueuedRequest, get_inbound_queue
+from federation.utils.request import parse_request
+from federation.utils.verification import get_verification_service
 
 logger = logging.getLogger("federation")
 
@@ -22,6 +29,13 @@ def handle_receive(
       - protocol name
       - list of entities
 
+    Copies of an already processed activity (same id and body), ie received in several inboxes or retried,
+    are not processed again: a `DuplicateResult` with the sender id and protocol name of the first copy,
+    and no entities, is returned.
+
+    Requests from domains blocked by the domain policy raise a `BlockedDomainError` before any
+    verification or key fetch.
+
     NOTE! The returned sender is NOT necessarily the *author* of the entity. By sender here we're
     talking about the sender of the *request*. If this object is being relayed by the sender, the author
     could actually be a different identity.
@@ -34,10 +48,45 @@ def handle_receive(
     :returns: Tuple of sender id, protocol name and list of entity objects
     """
     logger.debug("handle_receive: processing request: %s", request)
+    # The body is parsed once, by the protocol identification, and reused by the protocol
+    request = parse_request(request)
     found_protocol = identify_protocol_by_request(request)
+    check_domain_policy(found_protocol, request)
+    dedupe_key = get_dedupe_key(request)
+    duplicate = _get_duplicate(dedupe_key)
+    if duplicate:
+        return duplicate
 
     logger.debug("handle_receive: using protocol %s", found_protocol.PROTOCOL_NAME)
     protocol = found_protocol.Protocol()
+    return _receive(found_protocol, protocol, request, user, sender_key_fetcher, skip_author_verification, dedupe_key)
+
+
+def check_domain_policy(found_protocol, request: RequestType) -> None:
+    """Reject a request from a domain blocked by the domain policy (``domain_blocklist`` and
+    ``domain_allowlist`` settings), before its signature is verified or its payload processed.
+
+    The sender domains are read from the request by the protocol, ie the signature keyId and the actor.
+
+    :raises BlockedDomainError: If a sender domain is blocked
+    """
+    get_sender_domains = getattr(found_protocol, "get_sender_domains", None)
+    if not get_sender_domains:
+        return
+    for domain in get_sender_domains(request):
+        if not is_domain_allowed(domain):
+            raise BlockedDomainError(f"Domain {domain} is blocked")
+
+
+def _get_duplicate(dedupe_key: Optional[str]) -> Optional[DuplicateResult]:
+    seen = get_seen_activity(dedupe_key) if dedupe_key else None
+    if not seen:
+        return None
+    logger.debug("handle_receive: skipping duplicate of an activity from %s", seen[0])
+    return DuplicateResult(*seen)
+
+
+def _receive(found_protocol, protocol, request, user, sender_key_fetcher, skip_author_verification, dedupe_key=None):
     sender, message = protocol.receive(
         request, user, sender_key_fetcher, skip_author_verification=skip_author_verification)
     logger.debug("handle_receive: sender %s, message %s", sender, message)
@@ -50,4 +99,181 @@ def handle_receive(
     
     logger.debug("handle_receive: entities %s", entities)
 
+    # Protocols return an empty message for the requests they drop, ie failing the signature verification.
+    # These are not remembered, the genuine copy of a forged or unverifiable request is still processed.
+    # Neither are the activities failing the mapping, so that their retries are processed again.
+    if dedupe_key and message:
+        remember_activity(dedupe_key, sender, found_protocol.PROTOCOL_NAME)
+
     return sender, found_protocol.PROTOCOL_NAME, entities
+
+
+def handle_receive_batch(
+        requests: Iterable[RequestType],
+        user: UserType = None,
+        sender_key_fetcher: Callable[[str], str] = None,
+        skip_author_verification: bool = False
+) -> List[Union[Tuple[str, str, List], Exception]]:
+    """Takes several requests and processes them like `handle_receive`, verifying the
+    HTTP signatures of the batch together on the verification process pool.
+
+    Requests of protocols without batch verification support, and the ones failing the
+    batch verification (ie the key was rotated), are processed by `handle_receive`.
+
+    :arg requests: Request objects of type RequestType
+    :arg user: See `handle_receive`
+    :arg sender_key_fetcher: See `handle_receive`
+    :arg skip_author_verification: See `handle_receive`
+    :returns: List with, in the order of the requests, the `handle_receive` result of each request
+        or the exception raised processing it. Copies of an activity found earlier in the batch get a
+        `DuplicateResult`.
+    """
+    requests = [parse_request(request) for request in requests]
+    results = [None] * len(requests)
+    dedupe_keys = [get_dedupe_key(request) for request in requests]
+    # Index of the first copy of each activity in the batch, and indexes of the other copies by first copy
+    first_copies = {}
+    copies = {}
+
+    def fallback(index):
+        try:
+            results[index] = handle_receive(requests[index], user, sender_key_fetcher)
+        except Exception as ex:
+            results[index] = ex
+
+    def receive(index, found_protocol, protocol, skip):
+        results[index] = _receive(
+            found_protocol, protocol, requests[index], user, sender_key_fetcher, skip, dedupe_keys[index])
+
+    prepared = []
+    for index, request in enumerate(requests):
+        dedupe_key = dedupe_keys[index]
+        if dedupe_key in first_copies:
+            copies.setdefault(first_copies[dedupe_key], []).append(index)
+            continue
+        try:
+            found_protocol = identify_protocol_by_request(request)
+            check_domain_policy(found_protocol, request)
+            results[index] = _get_duplicate(dedupe_key)
+            if results[index]:
+                continue
+            if dedupe_key:
+                first_copies[dedupe_key] = index
+            protocol = found_protocol.Protocol()
+            if skip_author_verification or not hasattr(protocol, "get_verification_job"):
+                receive(index, found_protocol, protocol, skip_author_verification)
+                continue
+        except Exception as ex:
+            results[index] = ex
+            continue
+        try:
+            job = protocol.get_verification_job(request, user, sender_key_fetcher)
+        except Exception as ex:
+            # Rejected before the RSA verification, let handle_receive process it the usual way
+            logger.debug("handle_receive_batch: request %s not batched: %s", index, ex)
+            fallback(index)
+            continue
+        prepared.append((index, found_protocol, protocol, job))
+
+    jobs = [job for _index, _found_protocol, _protocol, job in prepared if job]
+    verified = iter(get_verification_service().verify(jobs))
+    logger.debug("handle_receive_batch: verified %s signatures of %s requests", len(jobs), len(requests))
+
+    for index, found_protocol, protocol, job in prepared:
+        if job and not next(verified):
+            fallback(index)
+            continue
+        try:
+            if job:
+                protocol.set_verified(job)
+            receive(index, found_protocol, protocol, True)
+        except Exception as ex:
+            results[index] = ex
+
+    for first, indexes in copies.items():
+        for index in indexes:
+            if isinstance(results[first], Exception) or not get_seen_activity(dedupe_keys[first]):
+                # The first copy was rejected or dropped, the other ones may still be genuine
+                fallback(index)
+            else:
+                results[index] = DuplicateResult(results[first][0], results[first][1])
+    return results
+
+
+def enqueue_receive(
+        request: RequestType,
+        recipient: Optional[str] = None,
+        queue: Optional[InboundQueue] = None,
+) -> QueuedRequest:
+    """Accept a request for a later processing by `process_queue`, so that the inbox view can answer at once.
+
+    Only cheap checks are done: the body size (``inbound_request_max_size`` setting), the domain policy and
+    the presence of the HTTP signature of ActivityPub requests. Signatures are verified when the request
+    is processed.
+
+    :arg request: Request object of type RequestType
+    :arg recipient: Id of the local user receiving the request, for private payloads. `process_queue`
+        passes it to its ``user_fetcher``.
+    :arg queue: Queue to use, defaults to the queue configured by the ``inbound_queue_backend`` setting
+    :returns: The queued request
+    :raises RequestRejectedError: With a ``status_code`` the view can answer with
+    """
+    body = request.body or b""
+    max_size = get_setting("inbound_request_max_size", 1024 * 1024)
+    if max_size and len(body) > max_size:
+        raise RequestRejectedError(f"Request body is larger than {max_size} bytes", status_code=413)
+    protocol = identify_protocol_by_headers(request)
+    if protocol:
+        check_domain_policy(protocol, request)
+    headers = request.headers or {}
+    if protocol and protocol.PROTOCOL_NAME == "activitypub" and not (
+            headers.get("Signature") or headers.get("signature")):
+        raise RequestRejectedError("A signature is required but was not provided", status_code=401)
+    if queue is None:
+        queue = get_inbound_queue()
+    item = QueuedRequest(request=request, recipient=recipient)
+    if not queue.put(item):
+        raise RequestRejectedError("Inbound queue is full", status_code=503)
+    return item
+
+
+def process_queue(
+        handler: Callable[[QueuedRequest, Union[Tuple[str, str, List], Exception]], None],
+        queue: Optional[InboundQueue] = None,
+        user_fetcher: Callable[[str], UserType] = None,
+        sender_key_fetcher: Callable[[str], str] = None,
+        max_requests: Optional[int] = None,
+        timeout: float = 0,
+) -> int:
+    """Worker entry point, processing the requests accepted by `enqueue_receive` with `handle_receive`.
+
+    Stops when the queue stays empty for ``timeout`` seconds, or after ``max_requests`` requests.
+
+    Delivery is at most once: each request is removed from the queue before it is processed, so the requests
+    being processed when a worker dies are lost. Remote servers retry the deliveries that failed, not these ones.
+
+    :arg handler: Function called with each queued request and its `handle_receive` result, or the exception
+        raised processing it
+    :arg queue: Queue to use, defaults to the queue configured by the ``inbound_queue_backend`` setting
+    :arg user_fetcher: Function that accepts the queued request recipient id and returns its UserType (optional)
+    :arg sender_key_fetcher: See `handle_receive`
+    :arg max_requests: Maximum number of requests to process
+    :arg timeout: Time in seconds to wait for a request when the queue is empty
+    :returns: Number of processed requests
+    """
+    if queue is None:
+        queue = get_inbound_queue()
+    count = 0
+    while max_requests is None or count < max_requests:
+        item = queue.get(timeout=timeout)
+        if item is None:
+            break
+        try:
+            user = user_fetcher(item.recipient) if item.recipient and user_fetcher else None
+            result = handle_receive(item.request, user=user, sender_key_fetcher=sender_key_fetcher)
+        except Exception as ex:
+            logger.warning("process_queue: failed to process %s: %s", item.request, ex)
+            result = ex
+        handler(item, result)
+        count += 1
+    return count
@@ -6,18 +6,18 @@ import traceback
 from typing import List, Dict, Union
 from urllib.parse import urljoin
 
-# noinspection PyPackageRequirements
-from Crypto.PublicKey import RSA
 # noinspection PyPackageRequirements
 from Crypto.PublicKey.RSA import RsaKey
 from iteration_utilities import unique_everseen
 
+from federation import get_protocol
 from federation.entities.activitypub.constants import NAMESPACE_PUBLIC
 from federation.entities.mixins import BaseEntity
 from federation.protocols.activitypub.signing import get_http_authentication
 from federation.protocols.enums import ProtocolType
 from federation.types  import UserType
 from federation.utils.django import disable_outbound_federation
+from federation.utils.keys import import_rsa_key
 from federation.utils.matrix import get_matrix_configuration
 from federation.utils.network import send_document
 
@@ -52,9 +52,8 @@ def handle_create_payload(
     :returns: Built payload(s) (str or dict or list (of payloads))
     """
     mappers = importlib.import_module(f"federation.entities.{protocol_name}.mappers")
-    protocol = importlib.import_module(f"federation.protocols.{protocol_name}.protocol")
     # noinspection PyUnresolvedReferences
-    protocol = protocol.Protocol()
+    protocol = get_protocol(protocol_name).Protocol()
     # noinspection PyUnresolvedReferences
     outbound_entity = mappers.get_outbound_entity(entity, author_user.rsa_private_key)
     if parent_user:
@@ -199,7 +198,7 @@ def handle_send(
         guid = recipient.get("guid")
         public_key = recipient.get("public_key")
         if isinstance(public_key, str):
-            public_key = RSA.importKey(public_key)
+            public_key = import_rsa_key(public_key)
         public = recipient["public"]
 
         if protocol == "activitypub":
@@ -1,7 +1,6 @@
-import json
 import logging
 import re
-from typing import Callable, Tuple, Union, Dict
+from typing import Callable, Optional, Set, Tuple, Union, Dict
 
 from cryptography.exceptions import InvalidSignature
 from Crypto.PublicKey.RSA import RsaKey
@@ -9,15 +8,24 @@ from Crypto.PublicKey.RSA import RsaKey
 from federation.entities.activitypub.enums import ActorType
 from federation.entities.mixins import BaseEntity
 from federation.entities.utils import get_profile
-from federation.protocols.activitypub.signing import verify_request_signature
+from federation.exceptions import InvalidRequestSignatureError, NoSuitableProtocolFoundError
+from federation.protocols.activitypub.signing import (
+    get_request_verification_job, remember_request_signature, verify_request_signature,
+)
 from federation.types import UserType, RequestType
-from federation.utils.activitypub import retrieve_and_parse_document
-from federation.utils.text import decode_if_bytes
+from federation.utils.activitypub import refetch_public_key, retrieve_public_key
+from federation.utils.keys import key_cache
+from federation.utils.policy import get_domain
+from federation.utils.request import parse_request
+from federation.utils.verification import VerificationJob
 
 
 logger = logging.getLogger('federation')
 
 PROTOCOL_NAME = "activitypub"
+# Request content types identifying the protocol
+CONTENT_TYPES = ("application/activity+json", "application/ld+json")
+SIGNATURE_KEY_ID = re.compile(r'keyId="([^"]*)"')
 
 
 def identify_id(id: str) -> bool:
@@ -33,14 +41,27 @@ def identify_request(request: RequestType) -> bool:
     """
     # noinspection PyBroadException
     try:
-        data = json.loads(decode_if_bytes(request.body))
-        if "@context" in data:
+        data = parse_request(request).json
+        if data is not None and "@context" in data:
             return True
     except Exception:
         pass
     return False
 
 
+def get_sender_domains(request: RequestType) -> Set[str]:
+    """
+    Get the domains of the request signature keyId and of the activity actor, without verifying the request.
+    """
+    headers = request.headers or {}
+    match = SIGNATURE_KEY_ID.search(headers.get("Signature") or headers.get("signature") or "")
+    document = parse_request(request).json
+    actor = document.get("actor") if isinstance(document, dict) else None
+    if isinstance(actor, dict):
+        actor = actor.get("id")
+    return set(filter(None, (get_domain(match.group(1)) if match else None, get_domain(actor))))
+
+
 class Protocol:
     actor = None
     get_contact_key = None
@@ -76,6 +97,18 @@ class Protocol:
         else:
             self.actor = self.payload.get('actor')
 
+    def load_request(self, request: RequestType, user: UserType = None,
+                     sender_key_fetcher: Callable[[str], str] = None) -> None:
+        self.user = user
+        self.get_contact_key = sender_key_fetcher
+        parsed = parse_request(request)
+        if parsed.json is None:
+            # Identified by its Content-Type only, the request is not ActivityPub after all
+            raise NoSuitableProtocolFoundError("Request body is not JSON") from parsed.json_error
+        self.payload = parsed.json
+        self.request = request
+        self.extract_actor()
+
     def receive(
             self,
             request: RequestType,
@@ -85,15 +118,22 @@ class Protocol:
         """
         Receive a request.
 
+        Requests failing the signature verification, and the dropped self Deletes of unknown actors,
+        return an empty message: they are acknowledged but not processed, nor remembered as received.
+
         For testing purposes, `skip_author_verification` can be passed. Authorship will not be verified.
         """
-        self.user = user
-        self.get_contact_key = sender_key_fetcher
-        self.payload = json.loads(decode_if_bytes(request.body))
-        self.request = request
-        self.extract_actor()
+        self.load_request(request, user, sender_key_fetcher)
         # Verify the message is from who it claims to be
         if not skip_author_verification:
+            if self.is_self_delete():
+                try:
+                    self.verify_self_delete()
+                except (ValueError, KeyError, InvalidSignature) as exc:
+                    # Acknowledged and dropped, these come in floods when an instance deletes accounts
+                    logger.debug('Dropping the Delete of %s: %s', self.actor, exc)
+                    return self.actor, {}
+                return self.sender, self.payload
             try:
                 # Verify the HTTP signature
                 self.verify()
@@ -102,20 +142,85 @@ class Protocol:
                 return self.actor, {}
         return self.sender, self.payload
 
-    def verify(self):
+    def is_self_delete(self) -> bool:
+        """
+        Whether the payload is the Delete of an actor by itself.
+        """
+        obj = self.payload.get("object")
+        if isinstance(obj, dict):
+            obj = obj.get("id")
+        return str(self.payload.get("type", "")).lower() == "delete" and bool(self.actor) and obj == self.actor
+
+    def get_verification_job(
+            self,
+            request: RequestType,
+            user: UserType = None,
+            sender_key_fetcher: Callable[[str], str] = None) -> Optional[VerificationJob]:
+        """
+        Prepare the HTTP signature verification of a request, for a batch verification.
+
+        Sets the sender like ``verify``. Returns None if the signature needs no RSA verification
+        (already verified). Raises like ``verify`` if the request is rejected beforehand.
+        """
+        self.load_request(request, user, sender_key_fetcher)
+        if self.is_self_delete():
+            key_id, key, algorithm = self.get_cached_signer_key()
+        else:
+            key_id, key, algorithm = self.get_signer_key()
+        return get_request_verification_job(self.request, key=key, algorithm=algorithm)
+
+    def set_verified(self, job: VerificationJob) -> None:
+        """
+        Record the successful batch verification of the request signature.
+        """
+        remember_request_signature(self.request, job.key)
+
+    def get_signature(self) -> Dict[str, str]:
         sig_struct = self.request.headers.get("Signature", None)
         if not sig_struct:
             raise ValueError("A signature is required but was not provided")
 
         # this should return a dict populated with the following keys:
         # keyId, algorithm, headers and signature
-        sig = {i.split("=", 1)[0]: i.split("=", 1)[1].strip('"') for i in sig_struct.split(",")}
+        return {i.split("=", 1)[0]: i.split("=", 1)[1].strip('"') for i in sig_struct.split(",")}
+
+    def get_cached_signer_key(self) -> Tuple[Optional[str], str, str]:
+        """
+        Find the public key of the request signature like ``get_signer_key``, without network calls:
+        only the keys of the profiles known by the client app, the key cache and the client app
+        ``sender_key_fetcher`` are used.
 
-        signer = get_profile(key_id=sig.get('keyId'))
-        if not signer:
-            signer = retrieve_and_parse_document(sig.get('keyId'))
-        self.sender = signer.id if signer else self.actor
-        key = getattr(signer, 'public_key', None)
+        :raises ValueError: If the key is not known
+        """
+        sig = self.get_signature()
+        key_id = sig.get('keyId')
+        signer = get_profile(key_id=key_id)
+        if signer and getattr(signer, 'public_key', None):
+            self.sender, key = signer.id, signer.public_key
+        else:
+            public_key = key_cache.get(key_id) if key_id else None
+            self.sender, key = (public_key.owner, public_key.pem) if public_key else (self.actor, None)
+        if not key and self.get_contact_key and self.actor:
+            key = self.get_contact_key(self.actor)
+        if not key:
+            raise ValueError(f"Unknown actor {self.actor}")
+        return key_id, key, sig.get('algorithm', "")
+
+    def get_signer_key(self) -> Tuple[Optional[str], str, str]:
+        """
+        Find the public key of the request signature, and set the sender.
+
+        :returns: The signature keyId, the PEM encoded key and the signature algorithm.
+        """
+        sig = self.get_signature()
+        key_id = sig.get('keyId')
+        signer = get_profile(key_id=key_id)
+        if signer:
+            self.sender, key = signer.id, getattr(signer, 'public_key', None)
+        else:
+            # Only the key is needed, the full profile parsing is skipped
+            public_key = retrieve_public_key(key_id) if key_id else None
+            self.sender, key = (public_key.owner, public_key.pem) if public_key else (self.actor, None)
         if not key:
             key = self.get_contact_key(self.actor) if self.get_contact_key and self.actor else ''
             if key:
@@ -123,5 +228,26 @@ class Protocol:
                 logger.warning("Failed to retrieve keyId for %s, trying the actor's key", sig.get('keyId'))
             else:
                 raise ValueError(f"No public key for {sig.get('keyId')}")
+        return key_id, key, sig.get('algorithm', "")
 
-        verify_request_signature(self.request, key=key, algorithm=sig.get('algorithm',""))
+    def verify(self):
+        key_id, key, algorithm = self.get_signer_key()
+        try:
+            verify_request_signature(self.request, key=key, algorithm=algorithm)
+        except InvalidRequestSignatureError:
+            # The key may have been rotated, try again once with a fresh copy
+            public_key = refetch_public_key(key_id, stale_key=key) if key_id else None
+            if not public_key:
+                raise
+            self.sender = public_key.owner
+            verify_request_signature(self.request, key=public_key.pem, algorithm=algorithm)
+
+    def verify_self_delete(self) -> None:
+        """
+        Verify the HTTP signature of the Delete of an actor by itself, with the cached keys only.
+
+        The keys of deleted actors are gone, fetching them would only wait for an error. The Delete
+        of an unknown actor is rejected without network calls, there is nothing to delete anyway.
+        """
+        key_id, key, algorithm = self.get_cached_signer_key()
+        verify_request_signature(self.request, key=key, algorithm=algorithm)
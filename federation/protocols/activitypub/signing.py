@@ -3,43 +3,162 @@ Thank you Funkwhale for inspiration on the HTTP signatures parts <3
 
 https://funkwhale.audio/
 """
+import base64
+import binascii
 import datetime
 import logging
+import time
+from email.utils import formatdate
+from hashlib import sha256
+from typing import Optional, Union
 from urllib.parse import urlsplit
 
 import pytz
+import requests.auth
+from Crypto.Hash import SHA256
 from Crypto.PublicKey.RSA import RsaKey
+from Crypto.Signature import PKCS1_v1_5, pkcs1_15
 from httpsig.sign_algorithms import PSS
-from httpsig.requests_auth import HTTPSignatureAuth
-from httpsig.verify import HeaderVerifier
+from httpsig.utils import (
+    ALGORITHMS, HASHES, HttpSigException, build_signature_template, generate_message, parse_signature_header,
+)
+from httpsig.verify import HeaderVerifier, Verifier
 
+from federation.exceptions import InvalidRequestSignatureError
 from federation.types import RequestType
+from federation.utils.keys import get_key_fingerprint, import_rsa_key
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_setting
 from federation.utils.network import parse_http_date
 from federation.utils.text import encode_if_text
+from federation.utils.verification import VerificationJob
 
 logger = logging.getLogger("federation")
 
+# Verified signatures by (keyId, signature, signed string digest, body digest, key fingerprint), until the request
+# Date leaves the accepted window. Retried deliveries and relayed requests are identical and skip the RSA verification.
+# The signed string covers the signed headers, method and path, so a replay elsewhere is verified again.
+signature_memo = TTLCache(maxsize=get_setting("http_signature_memo_size", 4096))
 
-def get_http_authentication(private_key: RsaKey, private_key_id: str, digest: bool=True) -> HTTPSignatureAuth:
+
+class CachedKeyPSS(PSS):
+    """
+    hs2019 algorithm, using the shared parsed key cache.
+    """
+    def _create_pss(self, key):
+        try:
+            return PKCS1_v1_5.new(import_rsa_key(key))
+        except ValueError:
+            raise HttpSigException("Invalid key.")
+
+
+class CachedKeyVerifier(Verifier):
+    """
+    Verifier using the shared parsed key cache for the rsa-* algorithms, instead
+    of parsing the PEM encoded public key on each verification.
+    """
+    def __init__(self, secret, algorithm=None, sign_algorithm=None):
+        if algorithm not in ALGORITHMS or not algorithm.startswith('rsa-'):
+            return super().__init__(secret, algorithm=algorithm, sign_algorithm=sign_algorithm)
+        self.algorithm = algorithm
+        self.secret = encode_if_text(secret)
+        self.sign_algorithm, self.hash_algorithm = algorithm.split('-')
+        self._hash = HASHES[self.hash_algorithm]
+        try:
+            self._rsa = PKCS1_v1_5.new(import_rsa_key(self.secret))
+        except ValueError:
+            raise HttpSigException("Invalid key.")
+
+
+# HeaderVerifier initializes its Verifier base with super(), the MRO puts
+# CachedKeyVerifier between them.
+class CachedKeyHeaderVerifier(HeaderVerifier, CachedKeyVerifier):
+    def get_verification_job(self) -> Optional[VerificationJob]:
+        """
+        Build the RSA verification of the signature, to run it in a batch.
+
+        Mirrors the checks of ``verify``. Returns None for the algorithms that can't be
+        verified from a digest (hmac), these are verified with ``verify``.
+        """
+        if self.sign_algorithm == 'rsa':
+            hash_module = self._hash
+        elif isinstance(self.sign_algorithm, PSS):
+            hash_module = self.sign_algorithm.hash_algorithm
+        else:
+            return None
+        hash_name = next(name for name, module in HASHES.items() if module is hash_module)
+
+        auth_headers = self.auth_dict.get('headers', 'date').split(' ')
+        missing = set(self.required_headers) - set(auth_headers)
+        if missing:
+            raise ValueError('{} is a required header(s)'.format(', '.join(missing)))
+        message = generate_message(auth_headers, self.headers, self.host, self.method, self.path)
+        try:
+            signature = base64.b64decode(self.auth_dict['signature'])
+        except binascii.Error:
+            raise InvalidRequestSignatureError("Invalid signature encoding")
+        return VerificationJob.from_message(self.secret, message, signature, hash_name=hash_name)
+
+
+class RsaSignatureAuth(requests.auth.AuthBase):
+    """
+    Sign a request with a rsa-sha256 HTTP signature, like httpsig ``HTTPSignatureAuth``, but with
+    the parsed private key instead of parsing its PEM export again for each request.
+    """
+    def __init__(self, private_key: Union[RsaKey, str, bytes], key_id: str, headers: list):
+        self.signer = pkcs1_15.new(import_rsa_key(private_key))
+        self.headers = headers
+        self.signature_template = build_signature_template(key_id, "rsa-sha256", headers, None, None)
+
+    def __call__(self, r):
+        r.headers['date'] = r.headers.pop('date', formatdate(time.time(), usegmt=True))
+        if r.body is not None and 'digest' in self.headers:
+            digest = sha256(encode_if_text(r.body)).digest()
+            r.headers['digest'] = "SHA-256=" + base64.b64encode(digest).decode()
+        # The Host header is only added when the request is sent
+        host = urlsplit(r.url).netloc if 'host' in self.headers else None
+        message = generate_message(self.headers, r.headers, host, r.method, r.path_url)
+        signature = self.signer.sign(SHA256.new(message))
+        r.headers['Signature'] = self.signature_template % base64.b64encode(signature).decode("ascii")
+        return r
+
+
+def get_http_authentication(private_key: RsaKey, private_key_id: str, digest: bool=True) -> RsaSignatureAuth:
     """
     Get HTTP signature authentication for a request.
     """
-    key = private_key.exportKey()
     headers = ["(request-target)", "user-agent", "host", "date"]
     if digest: headers.append('digest')
-    return HTTPSignatureAuth(
-        headers=headers,
-        algorithm="rsa-sha256",
-        secret=key,
-        key_id=private_key_id,
+    return RsaSignatureAuth(private_key, private_key_id, headers)
+
+
+def get_request_path(request: RequestType) -> str:
+    return getattr(request, 'path', urlsplit(request.url).path)
+
+
+def get_signature_memo_key(request: RequestType, key: bytes) -> Optional[tuple]:
+    """
+    Get the memo key of a request signature, None if the signed string can't be built.
+    """
+    try:
+        signature = parse_signature_header(request.headers.get("Signature", ""))
+        auth_headers = signature.get("headers", "date").split(" ")
+        message = generate_message(auth_headers, request.headers, None, request.method, get_request_path(request))
+    except (HttpSigException, ValueError):
+        return None
+    body = encode_if_text(request.body or b"")
+    return (
+        signature.get("keyid"), signature.get("signature"), sha256(message).hexdigest(), sha256(body).hexdigest(),
+        get_key_fingerprint(key),
     )
 
 
-def verify_request_signature(request: RequestType, key: str="", algorithm: str=""):
+def check_request_date(request: RequestType) -> float:
     """
-    Verify HTTP signature in request against a public key.
+    Check the request Date is in the accepted window.
+
+    :returns: Number of seconds the request Date stays accepted.
     """
-    key = encode_if_text(key)
     date_header = request.headers.get("Date")
     if not date_header:
         raise ValueError("Request Date header is missing")
@@ -51,9 +170,71 @@ def verify_request_signature(request: RequestType, key: str="", algorithm: str="
     now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
     if dt < now - past_delta or dt > now + future_delta:
         raise ValueError("Request Date is too far in future or past")
+    return (dt + past_delta - now).total_seconds()
+
+
+def is_signature_remembered(request: RequestType, key: bytes, replay_protection: bool=None) -> bool:
+    memo_key = get_signature_memo_key(request, key)
+    if memo_key is None or memo_key not in signature_memo:
+        return False
+    if replay_protection is None:
+        # Reject the requests whose signature was already verified
+        replay_protection = get_setting("http_signature_replay_protection", False)
+    if replay_protection:
+        raise ValueError("Request signature was already used")
+    return True
+
+
+def remember_request_signature(request: RequestType, key: str) -> None:
+    """
+    Remember a verified request signature while the request Date is accepted.
+    """
+    memo_key = get_signature_memo_key(request, encode_if_text(key))
+    if memo_key is not None:
+        signature_memo.set(memo_key, True, ttl=check_request_date(request))
+
+
+def get_request_verifier(request: RequestType, key: bytes, algorithm: str) -> CachedKeyHeaderVerifier:
+    return CachedKeyHeaderVerifier(request.headers, key, method=request.method,
+            path=get_request_path(request), sign_header='signature',
+            sign_algorithm=CachedKeyPSS() if algorithm == 'hs2019' else None)
+
+
+def get_request_verification_job(request: RequestType, key: str="", algorithm: str="",
+                                 replay_protection: bool=None) -> Optional[VerificationJob]:
+    """
+    Check the request like ``verify_request_signature`` but return the RSA verification as a job,
+    to be run by a VerificationService. Call ``remember_request_signature`` once it succeeded.
+
+    Returns None if the request signature was already verified.
+    Raises ValueError if the request is rejected before the RSA verification.
+    """
+    key = encode_if_text(key)
+    check_request_date(request)
+    if is_signature_remembered(request, key, replay_protection):
+        return None
+    verifier = get_request_verifier(request, key, algorithm)
+    job = verifier.get_verification_job()
+    if job is None:
+        if not verifier.verify():
+            raise InvalidRequestSignatureError("Invalid signature")
+        remember_request_signature(request, key)
+    return job
+
+
+def verify_request_signature(request: RequestType, key: str="", algorithm: str="", replay_protection: bool=None):
+    """
+    Verify HTTP signature in request against a public key.
+
+    Successful verifications are remembered while the request Date is accepted. With
+    ``replay_protection`` (defaults to the ``http_signature_replay_protection`` setting),
+    requests identical to an already verified one are rejected.
+    """
+    key = encode_if_text(key)
+    check_request_date(request)
+    if is_signature_remembered(request, key, replay_protection):
+        return
 
-    path = getattr(request, 'path', urlsplit(request.url).path)
-    if not HeaderVerifier(request.headers, key, method=request.method,
-            path=path, sign_header='signature',
-            sign_algorithm=PSS() if algorithm == 'hs2019' else None).verify():
-        raise ValueError("Invalid signature")
+    if not get_request_verifier(request, key, algorithm).verify():
+        raise InvalidRequestSignatureError("Invalid signature")
+    remember_request_signature(request, key)
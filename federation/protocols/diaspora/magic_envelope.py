@@ -1,12 +1,12 @@
 from base64 import urlsafe_b64encode, b64encode, urlsafe_b64decode
 
 from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 from lxml import etree
 
 from federation.exceptions import SignatureVerificationError
 from federation.utils.diaspora import fetch_public_key
+from federation.utils.keys import import_rsa_key
 from federation.utils.text import decode_if_bytes
 
 NAMESPACE = "http://salmon-protocol.org/ns/magic-env"
@@ -152,6 +152,6 @@ class MagicEnvelope:
             b64encode(b"RSA-SHA256").decode("ascii")
         ])
         sig_hash = SHA256.new(sig_contents.encode("ascii"))
-        cipher = PKCS1_v1_5.new(RSA.importKey(self.public_key))
+        cipher = PKCS1_v1_5.new(import_rsa_key(self.public_key))
         if not cipher.verify(sig_hash, urlsafe_b64decode(sig)):
             raise SignatureVerificationError("Signature cannot be verified using the given public key")
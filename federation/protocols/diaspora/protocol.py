@@ -1,8 +1,6 @@
-import json
 import logging
 from base64 import urlsafe_b64decode
-from typing import Callable, Tuple, Union, Dict
-from urllib.parse import unquote
+from typing import Callable, Set, Tuple, Union, Dict
 
 from Crypto.PublicKey.RSA import RsaKey
 from lxml import etree
@@ -13,13 +11,17 @@ from federation.protocols.diaspora.encrypted import EncryptedPayload
 from federation.protocols.diaspora.magic_envelope import MagicEnvelope
 from federation.types import UserType, RequestType
 from federation.utils.diaspora import fetch_public_key
-from federation.utils.text import decode_if_bytes, encode_if_text, validate_handle
+from federation.utils.policy import get_domain
+from federation.utils.request import ParsedRequest, parse_request
+from federation.utils.text import validate_handle
 
 logger = logging.getLogger("federation")
 
 PROTOCOL_NAME = "diaspora"
 PROTOCOL_NS = "https://joindiaspora.com/protocol"
 MAGIC_ENV_TAG = "{http://salmon-protocol.org/ns/magic-env}env"
+# Request content types identifying the protocol
+CONTENT_TYPES = ("application/magic-envelope+xml",)
 
 
 def identify_id(id: str) -> bool:
@@ -35,23 +37,40 @@ def identify_request(request: RequestType):
 
     Try first public message. Then private message. The check if this is a legacy payload.
     """
+    parsed = parse_request(request)
     # Private encrypted JSON payload
     try:
-        data = json.loads(decode_if_bytes(request.body))
-        if "encrypted_magic_envelope" in data:
+        data = parsed.json
+        if data is not None and "encrypted_magic_envelope" in data:
             return True
     except Exception:
         pass
     # Public XML payload
     try:
-        xml = etree.fromstring(encode_if_text(request.body))
-        if xml.tag == MAGIC_ENV_TAG:
+        xml = parsed.xml
+        if xml is not None and xml.tag == MAGIC_ENV_TAG:
             return True
     except Exception:
         pass
     return False
 
 
+def get_sender_domains(request: RequestType) -> Set[str]:
+    """
+    Get the domain of the author handle of a public payload, without verifying the request.
+
+    The author of private payloads is only known once they are decrypted.
+    """
+    xml = parse_request(request).xml
+    if xml is None or xml.tag != MAGIC_ENV_TAG:
+        return set()
+    try:
+        domain = get_domain(MagicEnvelope.get_sender(xml))
+    except (AttributeError, TypeError, ValueError):
+        return set()
+    return {domain} if domain else set()
+
+
 class Protocol:
     """Diaspora protocol parts
 
@@ -70,17 +89,16 @@ class Protocol:
 
     def store_magic_envelope_doc(self, payload):
         """Get the Magic Envelope, trying JSON first."""
-        try:
-            json_payload = json.loads(decode_if_bytes(payload))
-        except ValueError:
-            # XML payload
-            xml = unquote(decode_if_bytes(payload))
-            xml = xml.lstrip().encode("utf-8")
-            logger.debug("diaspora.protocol.store_magic_envelope_doc: xml payload: %s", xml)
-            self.doc = etree.fromstring(xml)
+        parsed = payload if isinstance(payload, ParsedRequest) else ParsedRequest(RequestType(body=payload))
+        if parsed.json is not None:
+            logger.debug("diaspora.protocol.store_magic_envelope_doc: json payload: %s", parsed.json)
+            self.doc = self.get_json_payload_magic_envelope(parsed.json)
         else:
-            logger.debug("diaspora.protocol.store_magic_envelope_doc: json payload: %s", json_payload)
-            self.doc = self.get_json_payload_magic_envelope(json_payload)
+            # XML payload
+            logger.debug("diaspora.protocol.store_magic_envelope_doc: xml payload: %s", parsed.text)
+            if parsed.xml is None:
+                raise parsed.xml_error
+            self.doc = parsed.xml
 
     def receive(
             self,
@@ -93,7 +111,7 @@ class Protocol:
         For testing purposes, `skip_author_verification` can be passed. Authorship will not be verified."""
         self.user = user
         self.get_contact_key = sender_key_fetcher
-        self.store_magic_envelope_doc(request.body)
+        self.store_magic_envelope_doc(parse_request(request))
         # Open payload and get actual message
         self.content = self.get_message_content()
         # Get sender handle
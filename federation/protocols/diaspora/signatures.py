@@ -1,10 +1,11 @@
 from base64 import b64decode, b64encode
 
 from Crypto.Hash import SHA256
-from Crypto.PublicKey import RSA
 from Crypto.PublicKey.RSA import RsaKey
 from Crypto.Signature import PKCS1_v1_5
 
+from federation.utils.keys import import_rsa_key
+
 
 def get_element_child_info(doc, attr):
     """Get information from child elements of this elementas a list since order is important.
@@ -33,7 +34,7 @@ def verify_relayable_signature(public_key, doc, signature):
     author did actually generate this message.
     """
     sig_hash = _create_signature_hash(doc)
-    cipher = PKCS1_v1_5.new(RSA.importKey(public_key))
+    cipher = PKCS1_v1_5.new(import_rsa_key(public_key))
     return cipher.verify(sig_hash, b64decode(signature))
 
 
@@ -1,15 +1,16 @@
-import json
 import logging
 import re
 from typing import Callable, Tuple, List, Dict
 
 from federation.entities.matrix.entities import MatrixEntityMixin
 from federation.types import UserType, RequestType
-from federation.utils.text import decode_if_bytes
+from federation.utils.request import parse_request
 
 logger = logging.getLogger('federation')
 
 PROTOCOL_NAME = "activitypub"
+# Appservice transactions, see federation.entities.matrix.django.urls
+REQUEST_PATH = re.compile(r"/transactions/[\w-]+$")
 
 
 def identify_id(identifier: str) -> bool:
@@ -27,8 +28,8 @@ def identify_request(request: RequestType) -> bool:
     """
     # noinspection PyBroadException
     try:
-        data = json.loads(decode_if_bytes(request.body))
-        if "events" in data:
+        data = parse_request(request).json
+        if data is not None and "events" in data:
             return True
     except Exception:
         pass
@@ -8,6 +8,7 @@ import requests
 from federation.tests.fixtures.entities import *
 from federation.tests.fixtures.types import *
 from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.utils.dedupe import seen_activities
 
 
 @pytest.fixture(autouse=True)
@@ -41,6 +42,13 @@ def disable_network_calls(monkeypatch):
 
     monkeypatch.setattr("requests.head", Mock(return_value=MockHeadResponse))
 
+
+@pytest.fixture(autouse=True)
+def clear_seen_activities():
+    """Don't deduplicate the payloads received by other tests."""
+    seen_activities.clear()
+
+
 @pytest.fixture
 def private_key():
     return get_dummy_private_key()
@@ -1,13 +1,17 @@
 import json
+from datetime import datetime
 from unittest.mock import patch
 
 import pytest
+from django.conf import settings
 from django.http import HttpResponse
-from django.test import RequestFactory
+from django.test import RequestFactory, override_settings
 from django.utils.decorators import method_decorator
 from django.views import View
 
-from federation.entities.activitypub.django.views import activitypub_object_view
+from federation.entities.activitypub.django.views import activitypub_object_view, get_object_cache_key, object_cache
+from federation.entities.activitypub.mappers import get_outbound_entity
+from federation.tests.django.utils import dummy_profile
 
 
 @activitypub_object_view
@@ -114,3 +118,42 @@ class TestActivityPubObjectView:
             response = view(request=request)
 
         assert response.status_code == 404
+
+    def test_renders_as2__shared_cache(self):
+        profile = dummy_profile()
+        profile.updated = datetime(2024, 1, 1)
+        request = RequestFactory().get("/", HTTP_ACCEPT='application/activity+json')
+        with override_settings(FEDERATION={**settings.FEDERATION, "activitypub_object_cache_ttl": 60}), \
+                patch("federation.tests.django.utils.get_object_function", return_value=profile), \
+                patch("federation.entities.activitypub.django.views.get_outbound_entity",
+                      wraps=get_outbound_entity) as mock_get_outbound_entity:
+            first = dummy_view(request=request)
+            second = dummy_view(request=request)
+
+        assert first.content == second.content
+        assert json.loads(second.content)['name'] == 'Bob Bobértson'
+        assert mock_get_outbound_entity.call_count == 1
+        assert get_object_cache_key(profile) in object_cache
+        object_cache.clear()
+
+    def test_renders_as2__not_cached_without_update_time(self):
+        request = RequestFactory().get("/", HTTP_ACCEPT='application/activity+json')
+        with override_settings(FEDERATION={**settings.FEDERATION, "activitypub_object_cache_ttl": 60}), \
+                patch("federation.entities.activitypub.django.views.get_outbound_entity",
+                      wraps=get_outbound_entity) as mock_get_outbound_entity:
+            dummy_view(request=request)
+            dummy_view(request=request)
+
+        assert mock_get_outbound_entity.call_count == 2
+        assert get_object_cache_key(dummy_profile()) is None
+        assert len(object_cache) == 0
+
+    def test_renders_as2__shared_cache_disabled(self):
+        request = RequestFactory().get("/", HTTP_ACCEPT='application/activity+json')
+        with patch("federation.entities.activitypub.django.views.get_outbound_entity",
+                   wraps=get_outbound_entity) as mock_get_outbound_entity:
+            dummy_view(request=request)
+            dummy_view(request=request)
+
+        assert mock_get_outbound_entity.call_count == 2
+        assert len(object_cache) == 0
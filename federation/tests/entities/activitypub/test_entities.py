@@ -6,8 +6,8 @@ from pprint import pprint
 # noinspection PyPackageRequirements
 from Crypto.PublicKey.RSA import RsaKey
 
-from federation.entities.activitypub.models import context_manager
-from federation.entities.activitypub.models import Accept
+from federation.entities.activitypub.models import context_manager, get_schema, normalize_types
+from federation.entities.activitypub.models import Accept, Create, Note, Post, as2
 from federation.protocols.enums import ProtocolType
 from federation.tests.fixtures.keys import PUBKEY
 from federation.types import UserType
@@ -413,6 +413,125 @@ class TestEntitiesConvertToAS2:
         }
 
 
+class TestEntitiesToAS2Memo:
+    def test_post_document_is_reused(self, activitypubpost):
+        activitypubpost.pre_send()
+        first = activitypubpost.to_as2()
+        with patch.object(context_manager, "compact", wraps=context_manager.compact) as mock_compact:
+            second = activitypubpost.to_as2()
+        assert second == first
+        assert second is not first
+        mock_compact.assert_not_called()
+
+    def test_returned_document_can_be_modified(self, activitypubpost):
+        activitypubpost.pre_send()
+        activitypubpost.to_as2()["object"]["id"] = "changed"
+        assert activitypubpost.to_as2()["object"]["id"] == "http://127.0.0.1:8000/post/123456/"
+
+    def test_attribute_assignment_invalidates(self, activitypubpost):
+        activitypubpost.pre_send()
+        activitypubpost.to_as2()
+        activitypubpost.rendered_content = "<p>changed</p>"
+        assert activitypubpost.to_as2()["object"]["content"] == "<p>changed</p>"
+
+    def test_nested_object_change_invalidates(self, activitypubpost_images):
+        activitypubpost_images.pre_send()
+        activitypubpost_images.to_as2()
+        activitypubpost_images.attachment[0].name = "changed"
+        result = activitypubpost_images.to_as2()
+        assert result["object"]["attachment"][0]["name"] == "changed"
+
+    def test_list_append_invalidates(self, activitypubpost):
+        activitypubpost.pre_send()
+        activitypubpost.to_as2()
+        activitypubpost.cc.append("https://example.com/profile")
+        assert "https://example.com/profile" in activitypubpost.to_as2()["cc"]
+
+    def test_same_length_list_change_invalidates(self, activitypubpost):
+        activitypubpost.pre_send()
+        activitypubpost.to = ["https://example.com/alice"]
+        activitypubpost.to_as2()
+        activitypubpost.to[0] = "https://example.com/bob"
+        assert activitypubpost.to_as2()["to"] == ["https://example.com/bob"]
+
+    def test_equal_assignment_keeps_version(self, activitypubprofile):
+        activitypubprofile.to_as2()
+        version = activitypubprofile._as2_version
+        activitypubprofile.url = "https://example.com/bob-bobertson"
+        activitypubprofile.to_as2()
+        assert activitypubprofile._as2_version == version
+
+
+class TestEntitiesSchemas:
+    def test_get_schema_is_shared(self):
+        schema = get_schema(Note)
+        assert get_schema(Note) is schema
+        assert get_schema(Note, only=("id",)) is not schema
+        assert schema.fields["tag_objects"]._schema
+
+    def test_subclass_dumped_with_parent_nested_schema(self, activitypubpost):
+        activitypubpost.pre_send()
+        result = activitypubpost.to_as2()
+        assert result["object"]["type"] == "Note"
+        schemas = get_schema(Create).fields["object_"].schema["to"]
+        assert schemas[Post] is schemas[Note]
+        assert schemas[Note] is not Note.schema()
+
+    def test_subclass_schemas_are_mapped_before_use(self):
+        field = get_schema(Create).fields["object_"]
+        schemas = dict(field.schema["to"])
+        assert schemas[Post] is schemas[Note]
+        field._serialize_single_obj(Post(id="https://example.com/post/1", raw_content="foo"))
+        assert field.schema["to"] == schemas
+
+    def test_late_subclass_dumped_with_parent_nested_schema(self):
+        class LatePost(Post):
+            class Meta:
+                rdf_type = as2.Note
+        field = get_schema(Create).fields["object_"]
+        schemas = dict(field.schema["to"])
+        result = field._serialize_single_obj(LatePost(id="https://example.com/post/1", raw_content="foo"))
+        assert result["@id"] == "https://example.com/post/1"
+        assert field.schema["to"] == schemas
+
+
+class TestNormalizeTypes:
+    def test_fixes_types_in_place(self):
+        tag = {"type": "hashtag", "name": "#foo"}
+        payload = {
+            "type": "create",
+            "object": {"type": "NOTE", "tag": [tag, {"type": "Unknown"}]},
+        }
+        changes = normalize_types(payload)
+        assert payload["type"] == "Create"
+        assert payload["object"]["type"] == "Note"
+        assert tag["type"] == "Hashtag"
+        assert payload["object"]["tag"][1]["type"] == "Unknown"
+        assert sorted(changes) == [
+            (("object", "tag", 0, "type"), "hashtag", "Hashtag"),
+            (("object", "type"), "NOTE", "Note"),
+            (("type",), "create", "Create"),
+        ]
+
+    def test_no_changes(self):
+        payload = {"type": "Note", "tag": [{"type": "Hashtag"}]}
+        assert normalize_types(payload) == []
+
+    def test_max_depth(self):
+        payload = {"type": "note", "object": {"object": {"type": "note"}}}
+        changes = normalize_types(payload, max_depth=1)
+        assert payload["type"] == "Note"
+        assert payload["object"]["object"]["type"] == "note"
+        assert changes == [(("type",), "note", "Note")]
+
+    def test_deep_payload_does_not_recurse(self):
+        payload = node = {"type": "note"}
+        for _ in range(5000):
+            node["object"] = {}
+            node = node["object"]
+        assert normalize_types(payload) == [(("type",), "note", "Note")]
+
+
 class TestEntitiesPostReceive:
     @patch("federation.entities.activitypub.models.retrieve_and_parse_profile", autospec=True)
     @patch("federation.entities.activitypub.models.handle_send", autospec=True)
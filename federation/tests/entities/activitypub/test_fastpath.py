@@ -0,0 +1,132 @@
+import copy
+
+import pytest
+from pyld import jsonld
+
+from federation.entities.activitypub import fastpath, models
+from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY
+from federation.entities.activitypub.models import context_manager, load_payload, Follow
+from federation.tests.fixtures.payloads import (
+    ACTIVITYPUB_COMMENT, ACTIVITYPUB_FOLLOW, ACTIVITYPUB_POST, ACTIVITYPUB_POST_IMAGES,
+    ACTIVITYPUB_POST_WITH_MENTIONS, ACTIVITYPUB_POST_WITH_SOURCE_BBCODE, ACTIVITYPUB_POST_WITH_SOURCE_MARKDOWN,
+    ACTIVITYPUB_POST_WITH_TAGS, ACTIVITYPUB_RETRACTION, ACTIVITYPUB_RETRACTION_SHARE, ACTIVITYPUB_SHARE,
+    ACTIVITYPUB_UNDO_FOLLOW,
+)
+
+PAYLOADS = (
+    ACTIVITYPUB_COMMENT, ACTIVITYPUB_FOLLOW, ACTIVITYPUB_POST, ACTIVITYPUB_POST_IMAGES,
+    ACTIVITYPUB_POST_WITH_MENTIONS, ACTIVITYPUB_POST_WITH_SOURCE_BBCODE, ACTIVITYPUB_POST_WITH_SOURCE_MARKDOWN,
+    ACTIVITYPUB_POST_WITH_TAGS, ACTIVITYPUB_RETRACTION, ACTIVITYPUB_RETRACTION_SHARE, ACTIVITYPUB_SHARE,
+    ACTIVITYPUB_UNDO_FOLLOW,
+)
+
+
+def merged(payload):
+    payload = copy.deepcopy(payload)
+    payload["@context"] = list(context_manager.merge_context(payload["@context"]))
+    return payload
+
+
+class TestExpand:
+    @pytest.mark.parametrize("payload", PAYLOADS)
+    def test_same_as_jsonld_expand(self, payload):
+        payload = merged(payload)
+        assert fastpath.expand(payload) == jsonld.expand(copy.deepcopy(payload))[0]
+
+    def test_unsupported_type(self):
+        payload = merged(ACTIVITYPUB_POST)["object"]
+        payload["@context"] = [CONTEXT_ACTIVITYSTREAMS]
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.expand(payload)
+
+    def test_unknown_remote_context(self):
+        payload = merged(ACTIVITYPUB_FOLLOW)
+        payload["@context"].append("https://example.com/context.jsonld")
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.expand(payload)
+
+    def test_redefined_standard_term(self):
+        payload = merged(ACTIVITYPUB_FOLLOW)
+        payload["@context"].append({"object": "https://example.com/ns#object"})
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.expand(payload)
+
+    def test_new_terms_are_expanded(self):
+        payload = merged(ACTIVITYPUB_FOLLOW)
+        payload["@context"].append({"ex": "https://example.com/ns#", "foo": "ex:foo"})
+        payload["foo"] = "bar"
+        expanded = fastpath.expand(payload)
+        assert expanded["https://example.com/ns#foo"] == [{"@value": "bar"}]
+        assert expanded == jsonld.expand(copy.deepcopy(payload))[0]
+
+    def test_embedded_context(self):
+        payload = merged(ACTIVITYPUB_POST)
+        payload["object"]["@context"] = CONTEXT_ACTIVITYSTREAMS
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.expand(payload)
+
+
+class TestLoadPayload:
+    @pytest.mark.parametrize("payload", PAYLOADS)
+    def test_same_entity_as_full_path(self, payload):
+        model = getattr(models, payload["type"])
+        entity = load_payload(model, copy.deepcopy(payload))
+        expected = model.schema().load(copy.deepcopy(payload))
+        assert entity.to_as2() == expected.to_as2()
+
+    def test_falls_back_to_full_path(self):
+        payload = copy.deepcopy(ACTIVITYPUB_FOLLOW)
+        payload["@context"] = [CONTEXT_ACTIVITYSTREAMS, {"object": "https://example.com/ns#object"}]
+        entity = load_payload(Follow, payload)
+        assert isinstance(entity, Follow)
+        assert entity.actor_id == "https://example.com/actor"
+
+
+COMPACTED_DICT_CONTEXT = [CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY]
+
+
+class TestCompact:
+    @pytest.mark.parametrize("node", (
+        {"@id": "https://example.com/alice#main-key",
+         "https://w3id.org/security#owner": [{"@id": "https://example.com/alice"}],
+         "https://w3id.org/security#publicKeyPem": [{"@value": "-----BEGIN PUBLIC KEY-----"}]},
+        {"https://www.w3.org/ns/activitystreams#content": [{"@value": "**foo**"}],
+         "https://www.w3.org/ns/activitystreams#mediaType": [{"@value": "text/markdown"}]},
+        {"https://www.w3.org/ns/activitystreams#sharedInbox": [{"@id": "https://example.com/inbox"}]},
+        {"_:orig": [{"@value": "<p>foo</p>"}], "_:en": [{"@value": "<p>foo</p>"}]},
+        {"http://litepub.social/ns#acceptsChatMessages": [{"@value": True}]},
+        {"https://www.w3.org/ns/activitystreams#name": [{"@value": "foo"}, {"@value": "bar"}]},
+        {"https://www.w3.org/ns/activitystreams#to": [{"@id": "https://www.w3.org/ns/activitystreams#Public"}]},
+        {"@type": ["https://w3id.org/security#Key"], "@id": "https://example.com/alice#main-key"},
+        {"https://example.com/ns#foo": [{"@id": "https://example.com/foo"}]},
+    ))
+    def test_same_as_jsonld_compact(self, node):
+        expected = jsonld.compact(copy.deepcopy(node), COMPACTED_DICT_CONTEXT)
+        expected.pop("@context")
+        assert fastpath.compact(node, COMPACTED_DICT_CONTEXT) == expected
+
+    @pytest.mark.parametrize("node", (
+        {"https://www.w3.org/ns/activitystreams#content": [{"@value": "foo", "@language": "en"}]},
+        {"https://www.w3.org/ns/activitystreams#published": [{"@value": "2019-06-29T21:08:45Z"}]},
+        {"https://www.w3.org/ns/activitystreams#content": []},
+        {"@id": "https://example.com/foo"},
+    ))
+    def test_unsupported_shapes(self, node):
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.compact(node, COMPACTED_DICT_CONTEXT)
+
+
+class TestExpandNode:
+    @pytest.mark.parametrize("document", (
+        {"content": "**foo**", "mediaType": "text/markdown"},
+        {"id": "https://example.com/alice#main-key", "owner": "https://example.com/alice",
+         "publicKeyPem": "-----BEGIN PUBLIC KEY-----"},
+        {"sharedInbox": "https://example.com/inbox"},
+    ))
+    def test_same_as_jsonld_expand(self, document):
+        document["@context"] = COMPACTED_DICT_CONTEXT
+        assert fastpath.expand_node(document) == jsonld.expand(copy.deepcopy(document))[0]
+
+    def test_empty_document(self):
+        with pytest.raises(fastpath.UnsupportedPayload):
+            fastpath.expand_node({"sharedInbox": None, "@context": COMPACTED_DICT_CONTEXT})
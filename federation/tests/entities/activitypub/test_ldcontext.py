@@ -0,0 +1,67 @@
+import pytest
+from marshmallow import missing
+
+from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY
+from federation.entities.activitypub.ldcontext import LdContextManager
+from federation.entities.activitypub.models import CLASSES_WITH_CONTEXT_EXTENSIONS
+
+
+class TestMergeContext:
+    def setup_method(self):
+        self.manager = LdContextManager(CLASSES_WITH_CONTEXT_EXTENSIONS)
+
+    def test_merges_extensions(self):
+        merged = self.manager.merge_context([CONTEXT_ACTIVITYSTREAMS, 'http://joinmastodon.org/ns',
+                                             {'@language': 'und', 'toot': 'http://joinmastodon.org/ns#'}])
+        assert merged[0] == CONTEXT_ACTIVITYSTREAMS
+        assert CONTEXT_SECURITY in merged
+        assert 'http://joinmastodon.org/ns' not in merged
+        assert merged[-1]['toot'] == 'http://joinmastodon.org/ns#'
+        assert '@language' not in merged[-1]
+        assert 'manuallyApprovesFollowers' in merged[-1]
+
+    def test_result_is_cached_by_fingerprint(self):
+        first = self.manager.merge_context([CONTEXT_ACTIVITYSTREAMS, {'toot': 'http://joinmastodon.org/ns#'}])
+        second = self.manager.merge_context([CONTEXT_ACTIVITYSTREAMS, {'toot': 'http://joinmastodon.org/ns#'}])
+        assert first is second
+        assert self.manager.merge_cache_stats()['hits'] == 1
+        assert self.manager.merge_cache_stats()['misses'] == 1
+
+    def test_input_is_not_modified(self):
+        ctx = [CONTEXT_ACTIVITYSTREAMS, {'@language': 'und', '@context': {'foo': 'https://example.com/foo'}}]
+        self.manager.merge_context(ctx)
+        assert ctx == [CONTEXT_ACTIVITYSTREAMS, {'@language': 'und', '@context': {'foo': 'https://example.com/foo'}}]
+
+    def test_result_is_immutable(self):
+        merged = self.manager.merge_context(CONTEXT_ACTIVITYSTREAMS)
+        assert isinstance(merged, tuple)
+        with pytest.raises((AttributeError, TypeError)):
+            merged[-1]['foo'] = 'bar'
+
+    def test_python_federation_legacy_context(self):
+        merged = self.manager.merge_context([CONTEXT_ACTIVITYSTREAMS,
+                                             {'pyfed': 'https://docs.jasonrobinson.me/ns/python-federation'}])
+        assert merged[-1]['pyfed'] == 'https://docs.jasonrobinson.me/ns/python-federation#'
+
+
+class TestBuildContext:
+    def setup_method(self):
+        self.manager = LdContextManager(CLASSES_WITH_CONTEXT_EXTENSIONS)
+
+    def test_plan_is_computed_once_per_class(self, activitypubpost):
+        self.manager.build_context(activitypubpost)
+        plan = self.manager._plans[type(activitypubpost)]
+        self.manager.build_context(activitypubpost)
+        assert self.manager._plans[type(activitypubpost)] is plan
+
+    def test_only_set_fields_add_extensions(self, activitypubpost):
+        activitypubpost.guid = missing
+        activitypubpost.sensitive = missing
+        ctx = self.manager.build_context(activitypubpost)
+        assert 'diaspora' not in ctx[-1]
+        assert 'sensitive' not in ctx[-1]
+        activitypubpost.guid = 'totallyrandomguid'
+        activitypubpost.sensitive = True
+        ctx = self.manager.build_context(activitypubpost)
+        assert ctx[-1]['diaspora'] == 'https://diasporafoundation.org/ns/'
+        assert ctx[-1]['sensitive'] == 'as:sensitive'
@@ -0,0 +1,207 @@
+import copy
+from unittest.mock import patch
+
+import pytest
+from cryptography.exceptions import InvalidSignature
+from django.conf import settings
+from django.test import override_settings
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from federation.entities.activitypub import ldsigning
+from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS
+from federation.entities.activitypub.ldsigning import (
+    create_data_integrity_proof, create_ld_signature, hash, hash_cache, get_ld_signature_stats, jcs,
+    reset_ld_signature_stats, should_verify_ld_signature, verify_ld_signature,
+)
+from federation.entities.activitypub.models import model_to_objects
+from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.tests.fixtures.payloads import ACTIVITYPUB_POST
+from federation.types import PublicKeyType, UserType
+from federation.utils.keys import encode_multikey
+
+
+DOCUMENT = {
+    "@context": CONTEXT_ACTIVITYSTREAMS,
+    "id": "https://example.com/notes/1",
+    "type": "Note",
+    "content": "foobar",
+    "to": ["https://www.w3.org/ns/activitystreams#Public"],
+}
+
+
+class TestHash:
+    def setup_method(self):
+        hash_cache.clear()
+
+    def test_identical_documents_are_normalized_once(self):
+        with patch.object(ldsigning, "_hash", wraps=ldsigning._hash) as mock_hash:
+            digest = hash(dict(DOCUMENT))
+            assert hash(dict(DOCUMENT)) == digest
+        assert mock_hash.call_count == 1
+        assert hash_cache.stats()["hits"] == 1
+
+    def test_key_order_does_not_matter(self):
+        digest = hash(DOCUMENT)
+        assert hash(dict(reversed(list(DOCUMENT.items())))) == digest
+        assert hash_cache.stats()["hits"] == 1
+
+    def test_same_digest_as_normalization(self):
+        assert hash(DOCUMENT) == ldsigning._hash(DOCUMENT)
+
+    def test_different_documents(self):
+        assert hash(DOCUMENT) != hash(dict(DOCUMENT, content="barfoo"))
+        assert len(hash_cache) == 2
+
+
+class TestShouldVerifyLdSignature:
+    def setup_method(self):
+        reset_ld_signature_stats()
+
+    def test_relayed_payloads_are_always_verified(self):
+        for policy in ldsigning.LD_SIGNATURE_POLICIES:
+            assert should_verify_ld_signature(relayed=True, policy=policy)
+        assert get_ld_signature_stats() == {"relayed": 3}
+
+    def test_always(self):
+        assert should_verify_ld_signature(policy="always")
+        assert get_ld_signature_stats() == {"always": 1}
+
+    def test_relayed(self):
+        assert not should_verify_ld_signature(policy="relayed")
+        assert get_ld_signature_stats() == {"skipped": 1}
+
+    @override_settings(FEDERATION={**settings.FEDERATION, "ld_signature_sample_rate": 10})
+    def test_sampled(self):
+        with patch("federation.entities.activitypub.ldsigning.random.random", return_value=0.05):
+            assert should_verify_ld_signature(policy="sampled")
+        with patch("federation.entities.activitypub.ldsigning.random.random", return_value=0.5):
+            assert not should_verify_ld_signature(policy="sampled")
+        assert get_ld_signature_stats() == {"sampled": 1, "skipped": 1}
+
+    def test_unsigned_payload_is_counted(self):
+        assert ldsigning.verify_ld_signature({"id": "https://example.com/foo"}) is None
+        assert get_ld_signature_stats() == {"unsigned": 1}
+
+
+@patch("federation.entities.activitypub.models.verify_ld_signature", return_value=None)
+class TestValidateSignaturesPolicy:
+    @pytest.fixture(autouse=True)
+    def relayed_policy(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "ld_signature_verification": "relayed"}):
+            yield
+
+    def get_entity(self, sender):
+        entity = model_to_objects(copy.deepcopy(ACTIVITYPUB_POST))
+        entity._sender = sender
+        return entity
+
+    def test_sender_is_author__not_verified(self, mock_verify):
+        entity = self.get_entity(ACTIVITYPUB_POST["actor"])
+        entity._validate_signatures()
+        assert not mock_verify.called
+
+    def test_relayed__verified(self, mock_verify):
+        entity = self.get_entity("https://relay.example.com/actor")
+        with pytest.raises(InvalidSignature):
+            entity._validate_signatures()
+        assert mock_verify.called
+
+
+class TestJcs:
+    def test_canonical_form(self):
+        assert jcs({"b": [1, 2.0, 0.5, None, True], "a": "é\n", "c": {"z": 1e21, "y": 1e-7}}) == \
+            '{"a":"é\\n","b":[1,2,0.5,null,true],"c":{"y":1e-7,"z":1e+21}}'.encode("utf-8")
+
+    def test_keys_sorted_by_utf16_code_units(self):
+        assert jcs({"\U0001f600": 1, "\ufb01": 2}) == '{"\U0001f600":1,"\ufb01":2}'.encode("utf-8")
+
+    def test_numbers(self):
+        assert jcs([333333333.3333333, 1e-6, 100.0, -0.0, 4.5e25]) == b"[333333333.3333333,0.000001,100,0,4.5e+25]"
+
+
+class TestDataIntegrityProof:
+    def setup_method(self):
+        reset_ld_signature_stats()
+        self.key = Ed25519PrivateKey.generate()
+        self.author = UserType(id="https://example.com/u/bob", private_key=get_dummy_private_key(),
+                               ed25519_private_key=self.key)
+        self.public_key = PublicKeyType(id="https://example.com/u/bob#ed25519-key", owner="https://example.com/u/bob",
+                                        pem=encode_multikey(self.key), key=self.key.public_key())
+
+    def get_document(self):
+        document = copy.deepcopy(DOCUMENT)
+        create_data_integrity_proof(document, self.author)
+        return document
+
+    def test_create_proof(self):
+        proof = self.get_document()["proof"]
+        assert proof["type"] == "DataIntegrityProof"
+        assert proof["cryptosuite"] == "eddsa-jcs-2022"
+        assert proof["verificationMethod"] == "https://example.com/u/bob#ed25519-key"
+        assert proof["proofPurpose"] == "assertionMethod"
+        assert proof["proofValue"].startswith("z")
+
+    def test_verify_proof(self):
+        with patch.object(ldsigning, "retrieve_public_key", return_value=self.public_key) as mock_retrieve, \
+                patch.object(ldsigning, "_hash") as mock_hash:
+            assert verify_ld_signature(self.get_document()) == "https://example.com/u/bob"
+        mock_retrieve.assert_called_once_with("https://example.com/u/bob#ed25519-key")
+        # no URDNA2015 normalization
+        assert not mock_hash.called
+        assert get_ld_signature_stats() == {"valid": 1}
+
+    def test_verify_proof_with_rsa_signature(self):
+        document = self.get_document()
+        create_ld_signature(document, self.author)
+        with patch.object(ldsigning, "retrieve_public_key", return_value=self.public_key):
+            assert verify_ld_signature(document) == "https://example.com/u/bob"
+
+    @patch.object(ldsigning, "refetch_public_key", return_value=None)
+    def test_tampered_document(self, mock_refetch):
+        document = self.get_document()
+        document["content"] = "barfoo"
+        with patch.object(ldsigning, "retrieve_public_key", return_value=self.public_key):
+            assert verify_ld_signature(document) is None
+        assert mock_refetch.called
+        assert get_ld_signature_stats() == {"invalid": 1}
+
+    def test_rotated_key(self):
+        document = self.get_document()
+        stale_key = Ed25519PrivateKey.generate()
+        stale = PublicKeyType(id=self.public_key.id, owner=self.public_key.owner, pem=encode_multikey(stale_key),
+                              key=stale_key.public_key())
+        with patch.object(ldsigning, "retrieve_public_key", return_value=stale), \
+                patch.object(ldsigning, "refetch_public_key", return_value=self.public_key) as mock_refetch:
+            assert verify_ld_signature(document) == "https://example.com/u/bob"
+        mock_refetch.assert_called_once_with("https://example.com/u/bob#ed25519-key", stale_key=stale.pem)
+
+    def test_proof_context_must_prefix_document_context(self):
+        document = self.get_document()
+        document["proof"]["@context"] = ["https://example.com/context"]
+        with patch.object(ldsigning, "retrieve_public_key", return_value=self.public_key):
+            assert verify_ld_signature(document) is None
+
+    @patch.object(ldsigning, "refetch_public_key", return_value=None)
+    def test_falls_back_to_rsa_signature(self, mock_refetch):
+        document = self.get_document()
+        create_ld_signature(document, self.author)
+        document["proof"]["proofValue"] = "zfoobar"
+        rsa_key = PublicKeyType(id="https://example.com/u/bob#main-key", owner="https://example.com/u/bob",
+                                pem="", key=get_dummy_private_key().publickey())
+        with patch.object(ldsigning, "get_profile", return_value=None), \
+                patch.object(ldsigning, "retrieve_public_key", return_value=rsa_key):
+            assert verify_ld_signature(document) == "https://example.com/u/bob"
+
+    def test_sign_as2_adds_proof_and_rsa_signature(self):
+        entity = model_to_objects(copy.deepcopy(ACTIVITYPUB_POST))
+        document = entity.sign_as2(sender=self.author)
+        assert document["proof"]["cryptosuite"] == "eddsa-jcs-2022"
+        assert document["signature"]["type"] == "RsaSignature2017"
+
+    def test_sign_as2_without_rsa_fallback(self):
+        entity = model_to_objects(copy.deepcopy(ACTIVITYPUB_POST))
+        with override_settings(FEDERATION={**settings.FEDERATION, "ld_signature_rsa_fallback": False}), \
+                patch("federation.entities.activitypub.models.create_ld_signature") as mock_sign:
+            document = entity.sign_as2(sender=self.author)
+        assert "proof" in document
+        assert not mock_sign.called
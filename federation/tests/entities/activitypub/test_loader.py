@@ -0,0 +1,109 @@
+import json
+from unittest.mock import patch, Mock
+
+from django.conf import settings
+from django.test import override_settings
+from pyld import jsonld
+
+from federation.entities.activitypub import get_loader, get_bundled_context, context_cache, is_context_allowed
+from federation.entities.activitypub.constants import CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY, CONTEXT_LITEPUB
+
+
+class TestGetBundledContext:
+    def test_returns_bundled_contexts(self):
+        for url in (CONTEXT_ACTIVITYSTREAMS, CONTEXT_SECURITY, CONTEXT_LITEPUB):
+            doc = get_bundled_context(url)
+            assert doc["documentUrl"] == url
+            assert "@context" in doc["document"]
+
+    def test_returns_none_for_unknown_context(self):
+        assert get_bundled_context("https://example.com/context.jsonld") is None
+
+    def test_instance_contexts_are_not_bundled(self):
+        assert get_bundled_context("https://pleroma.example.com/schemas/litepub-0.1.jsonld") is None
+
+
+class TestLoader:
+    @patch("federation.entities.activitypub.jsonld.requests_document_loader")
+    def test_bundled_context_does_not_fetch(self, mock_loader):
+        loader = get_loader()
+        doc = loader(CONTEXT_ACTIVITYSTREAMS, {"headers": {}})
+        assert doc["document"]["@context"]["as"] == "https://www.w3.org/ns/activitystreams#"
+        assert not mock_loader.return_value.called
+
+    @patch("federation.entities.activitypub.cache", new={})
+    @override_settings(FEDERATION={**settings.FEDERATION, "jsonld_context_allowlist": ["https://allowed.example.com/"]})
+    @patch("federation.entities.activitypub.jsonld.requests_document_loader")
+    def test_allowlist(self, mock_loader):
+        mock_loader.return_value = Mock(return_value={"document": {"@context": {"foo": "bar"}}})
+        loader = get_loader()
+        doc = loader("https://denied.example.com/context.jsonld", {"headers": {}})
+        assert doc["document"] == {"@context": {}}
+        assert not mock_loader.return_value.called
+        doc = loader("https://allowed.example.com/context.jsonld", {"headers": {}})
+        assert doc["document"] == {"@context": {"foo": "bar"}}
+        assert mock_loader.return_value.called
+
+    @override_settings(FEDERATION={**settings.FEDERATION, "jsonld_context_allowlist": [
+        "https://allowed.example", "https://example.com/schemas/"]})
+    def test_allowlist_matches_host_and_path(self):
+        assert is_context_allowed("https://allowed.example/context.jsonld")
+        assert is_context_allowed("https://ALLOWED.example/context.jsonld")
+        assert is_context_allowed("https://example.com/schemas/context.jsonld")
+        assert not is_context_allowed("https://allowed.example.evil.net/context.jsonld")
+        assert not is_context_allowed("https://allowed.example@evil.net/context.jsonld")
+        assert not is_context_allowed("http://allowed.example/context.jsonld")
+        assert not is_context_allowed("https://allowed.example:8443/context.jsonld")
+        assert not is_context_allowed("https://example.com/schemas.evil/context.jsonld")
+        assert not is_context_allowed("https://example.com/context.jsonld")
+
+    @patch("federation.entities.activitypub.jsonld.requests_document_loader")
+    def test_timeout(self, mock_loader):
+        get_loader()
+        mock_loader.assert_called_once_with(timeout=5)
+
+
+class TestContextCache:
+    def setup_method(self):
+        context_cache.clear()
+
+    @patch("federation.entities.activitypub.jsonld.requests_document_loader")
+    def test_redis_is_only_hit_once(self, mock_loader):
+        redis = Mock()
+        redis.__getitem__ = Mock(return_value='{"document": {"@context": {"foo": "bar"}}}')
+        with patch("federation.entities.activitypub.cache", new=redis):
+            loader = get_loader()
+            loader("https://example.com/context.jsonld", {"headers": {}})
+            doc = loader("https://example.com/context.jsonld", {"headers": {}})
+        assert doc["document"] == {"@context": {"foo": "bar"}}
+        assert "tag" not in doc
+        assert redis.__getitem__.call_count == 1
+        assert not mock_loader.return_value.called
+        assert context_cache.stats()["hits"] == 1
+
+    def test_processed_bundled_contexts_are_reused(self):
+        loader = Mock(wraps=get_loader())
+        doc = {"@context": CONTEXT_ACTIVITYSTREAMS, "name": "foo"}
+        jsonld.expand(doc, options={"documentLoader": loader})
+        loader.reset_mock()
+        expanded = jsonld.expand(doc, options={"documentLoader": loader})
+        assert expanded == [{"https://www.w3.org/ns/activitystreams#name": [{"@value": "foo"}]}]
+        assert not loader.called
+
+    def test_expired_remote_contexts_are_loaded_again(self):
+        now = [0]
+        loader = Mock(wraps=get_loader())
+        doc = {"@context": "https://example.com/expiring.jsonld", "foo": "bar"}
+        redis = Mock()
+        redis.__getitem__ = Mock(return_value=json.dumps(
+            {"contextUrl": None, "documentUrl": "https://example.com/expiring.jsonld",
+             "document": {"@context": {"foo": "https://example.com/foo"}}}))
+        with patch("federation.entities.activitypub.cache", new=redis), \
+                patch.object(context_cache, "timer", lambda: now[0]):
+            jsonld.expand(doc, options={"documentLoader": loader})
+            expanded = jsonld.expand(doc, options={"documentLoader": loader})
+            assert redis.__getitem__.call_count == 1
+            now[0] += context_cache.ttl + 1
+            jsonld.expand(doc, options={"documentLoader": loader})
+        assert expanded == [{"https://example.com/foo": [{"@value": "bar"}]}]
+        assert redis.__getitem__.call_count == 2
@@ -1,7 +1,18 @@
 import json
+from email.utils import formatdate
+from unittest.mock import patch, Mock
 
-from federation.protocols.activitypub.protocol import identify_request, identify_id
-from federation.types import RequestType
+import pytest
+import requests
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
+
+from federation.exceptions import InvalidRequestSignatureError
+from federation.protocols.activitypub.protocol import get_sender_domains, identify_request, identify_id, Protocol
+from federation.protocols.activitypub.signing import get_http_authentication
+from federation.tests.fixtures.keys import PUBKEY, get_dummy_private_key
+from federation.types import RequestType, PublicKeyType
+from federation.utils.keys import key_cache, refetch_cooldowns
 
 
 def test_identify_id():
@@ -21,3 +32,149 @@ class TestIdentifyRequest:
         assert not identify_request(RequestType(body='foo'))
         assert not identify_request(RequestType(body='<xml></<xml>'))
         assert not identify_request(RequestType(body=b'<xml></<xml>'))
+
+
+def test_get_sender_domains():
+    request = RequestType(body=json.dumps({"actor": {"id": "https://example.com/u/bob"}}), headers={
+        "Signature": 'keyId="https://relay.example.net/actor#main-key",algorithm="rsa-sha256",signature="foo"',
+    })
+    assert get_sender_domains(request) == {"example.com", "relay.example.net"}
+    assert get_sender_domains(RequestType(body='["foo"]')) == set()
+
+
+class TestVerify:
+    def setup_method(self):
+        key_cache.clear()
+        refetch_cooldowns.clear()
+
+    teardown_method = setup_method
+
+    def get_protocol(self):
+        request = RequestType(body=b"{}", headers={"Signature": 'keyId="https://example.com/bob#main-key",'
+                                                                'algorithm="rsa-sha256",headers="date",signature="foo"'})
+        protocol = Protocol(request=request)
+        protocol.actor = "https://example.com/bob"
+        return protocol
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature")
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    @patch("federation.protocols.activitypub.protocol.retrieve_public_key")
+    def test_uses_key_only_fetch(self, mock_retrieve, mock_get_profile, mock_verify):
+        mock_retrieve.return_value = PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None)
+        protocol = self.get_protocol()
+        protocol.verify()
+        mock_retrieve.assert_called_once_with("https://example.com/bob#main-key")
+        mock_verify.assert_called_once_with(protocol.request, key=PUBKEY, algorithm="rsa-sha256")
+        assert protocol.sender == "https://example.com/bob"
+
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    @patch("federation.protocols.activitypub.protocol.retrieve_public_key", return_value=None)
+    def test_raises_without_key(self, mock_retrieve, mock_get_profile):
+        with pytest.raises(ValueError):
+            self.get_protocol().verify()
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature")
+    @patch("federation.protocols.activitypub.protocol.get_profile")
+    @patch("federation.protocols.activitypub.protocol.refetch_public_key")
+    def test_retries_with_refetched_key(self, mock_refetch, mock_get_profile, mock_verify):
+        mock_get_profile.return_value = Mock(id="https://example.com/bob", public_key="old key")
+        mock_refetch.return_value = PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None)
+        mock_verify.side_effect = [InvalidRequestSignatureError("Invalid signature"), None]
+        protocol = self.get_protocol()
+        protocol.verify()
+        mock_refetch.assert_called_once_with("https://example.com/bob#main-key", stale_key="old key")
+        assert mock_verify.call_args.kwargs["key"] == PUBKEY
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature",
+           side_effect=InvalidRequestSignatureError("Invalid signature"))
+    @patch("federation.protocols.activitypub.protocol.get_profile")
+    @patch("federation.protocols.activitypub.protocol.refetch_public_key", return_value=None)
+    def test_raises_without_new_key(self, mock_refetch, mock_get_profile, mock_verify):
+        mock_get_profile.return_value = Mock(id="https://example.com/bob", public_key="old key")
+        with pytest.raises(InvalidRequestSignatureError):
+            self.get_protocol().verify()
+        assert mock_verify.call_count == 1
+
+    @patch("federation.utils.activitypub.retrieve_public_key")
+    @patch("federation.protocols.activitypub.protocol.get_profile")
+    def test_uses_rotated_key_during_refetch_cooldown(self, mock_get_profile, mock_retrieve):
+        key_id = "https://example.com/bob#main-key"
+        old_key, new_key = get_dummy_private_key(), RSA.generate(2048)
+        # the client app profile still has the old key, another request already refetched the new one
+        mock_get_profile.return_value = Mock(
+            id="https://example.com/bob", public_key=old_key.publickey().export_key().decode())
+        key_cache.set(key_id, PublicKeyType(
+            id=key_id, owner="https://example.com/bob", pem=new_key.publickey().export_key().decode(), key=None))
+        refetch_cooldowns.add(key_id, True)
+        request = requests.Request("POST", "https://example.com/inbox", data=b"{}", headers={
+            "Date": formatdate(usegmt=True), "User-Agent": "foobar", "Host": "example.com",
+        }).prepare()
+        request = get_http_authentication(new_key, key_id)(request)
+        protocol = Protocol(request=RequestType(
+            body=request.body, headers=request.headers, method="POST", url=request.url))
+        protocol.actor = "https://example.com/bob"
+        protocol.verify()
+        assert protocol.sender == "https://example.com/bob"
+        assert not mock_retrieve.called
+
+
+class TestReceiveSelfDelete:
+    def setup_method(self):
+        key_cache.clear()
+
+    def get_request(self, obj="https://example.com/bob"):
+        return RequestType(body=json.dumps({
+            "@context": "https://www.w3.org/ns/activitystreams", "id": "https://example.com/bob#delete",
+            "type": "Delete", "actor": "https://example.com/bob", "object": obj,
+        }), headers={"Signature": 'keyId="https://example.com/bob#main-key",algorithm="rsa-sha256",'
+                                  'headers="date",signature="foo"'})
+
+    def test_is_self_delete(self):
+        protocol = Protocol()
+        for obj, expected in (("https://example.com/bob", True), ({"id": "https://example.com/bob"}, True),
+                              ("https://example.com/bob/note/1", False)):
+            protocol.load_request(self.get_request(obj))
+            assert protocol.is_self_delete() is expected
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature")
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    @patch("federation.protocols.activitypub.protocol.retrieve_public_key")
+    @patch("federation.protocols.activitypub.protocol.refetch_public_key")
+    def test_unknown_actor_is_dropped_without_fetches(self, mock_refetch, mock_retrieve, mock_get_profile,
+                                                      mock_verify):
+        sender, payload = Protocol().receive(self.get_request())
+        assert (sender, payload) == ("https://example.com/bob", {})
+        assert not mock_retrieve.called
+        assert not mock_refetch.called
+        assert not mock_verify.called
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature")
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    @patch("federation.protocols.activitypub.protocol.retrieve_public_key")
+    def test_known_actor_is_verified_with_cached_key(self, mock_retrieve, mock_get_profile, mock_verify):
+        key_cache.set("https://example.com/bob#main-key", PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None))
+        protocol = Protocol()
+        sender, payload = protocol.receive(self.get_request())
+        assert sender == "https://example.com/bob"
+        assert payload["type"] == "Delete"
+        mock_verify.assert_called_once_with(protocol.request, key=PUBKEY, algorithm="rsa-sha256")
+        assert not mock_retrieve.called
+
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature",
+           side_effect=InvalidRequestSignatureError("Invalid signature"))
+    @patch("federation.protocols.activitypub.protocol.get_profile")
+    @patch("federation.protocols.activitypub.protocol.refetch_public_key")
+    def test_invalid_signature_is_not_retried(self, mock_refetch, mock_get_profile, mock_verify):
+        mock_get_profile.return_value = Mock(id="https://example.com/bob", public_key=PUBKEY)
+        assert Protocol().receive(self.get_request()) == ("https://example.com/bob", {})
+        assert not mock_refetch.called
+
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    @patch("federation.protocols.activitypub.protocol.retrieve_public_key")
+    def test_verification_job_of_unknown_actor(self, mock_retrieve, mock_get_profile):
+        with pytest.raises(ValueError):
+            Protocol().get_verification_job(self.get_request())
+        assert not mock_retrieve.called
@@ -1,17 +1,155 @@
-from federation.protocols.activitypub.signing import get_http_authentication
+from email.utils import formatdate
+from unittest.mock import patch
+
+import pytest
+import requests
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
+
+from federation.protocols.activitypub.signing import (
+    CachedKeyHeaderVerifier, get_http_authentication, get_request_verification_job, remember_request_signature,
+    signature_memo, verify_request_signature,
+)
 from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.types import RequestType
+from federation.utils.verification import verify_job
 
 
 def test_signing_request():
     key = get_dummy_private_key()
     auth = get_http_authentication(key, "dummy_key_id")
-    assert auth.header_signer.headers == [
+    assert auth.headers == [
         '(request-target)',
         'user-agent',
         'host',
         'date',
         'digest',
     ]
-    assert auth.header_signer.secret == key.exportKey()
-    assert 'dummy_key_id' in auth.header_signer.signature_template
+    assert 'keyId="dummy_key_id"' in auth.signature_template
+
+
+def test_signing_request__does_not_parse_the_key_again():
+    key = get_dummy_private_key()
+    auth = get_http_authentication(key, "https://example.com/u/bob#main-key")
+    request = requests.Request("POST", "https://example.com/inbox", data=b"{}", headers={
+        "User-Agent": "foobar", "Host": "example.com",
+    }).prepare()
+    with patch("federation.utils.keys.RSA.import_key", wraps=RSA.import_key) as mock_import:
+        auth(request)
+    assert not mock_import.called
+    assert request.headers["Digest"].startswith("SHA-256=")
+    assert request.headers["Signature"].startswith('keyId="https://example.com/u/bob#main-key",algorithm="rsa-sha256"')
+    verify_request_signature(RequestType(
+        body=request.body, headers=request.headers, method="POST", url=request.url,
+    ), key=key.publickey().export_key().decode())
+
+
+
+class TestVerifyRequestSignature:
+    def setup_method(self):
+        signature_memo.clear()
+
+    def get_request(self, key):
+        request = requests.Request("POST", "https://example.com/inbox", data=b"{}", headers={
+            "Date": formatdate(usegmt=True), "User-Agent": "foobar", "Host": "example.com",
+        }).prepare()
+        request = get_http_authentication(key, "https://example.com/u/bob#main-key")(request)
+        return RequestType(body=request.body, headers=request.headers, method="POST", url=request.url)
+
+    def test_verifies_with_cached_key(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        with patch("federation.utils.keys.RSA.import_key", wraps=RSA.import_key) as mock_import:
+            verify_request_signature(request, key=public_key)
+            verify_request_signature(request, key=public_key)
+        assert mock_import.call_count <= 1
+
+    def test_raises_for_invalid_signature(self):
+        request = self.get_request(get_dummy_private_key())
+        other_key = RSA.generate(2048).publickey().export_key().decode()
+        with pytest.raises(ValueError):
+            verify_request_signature(request, key=other_key)
+
+    def test_skips_verification_of_verified_signature(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        with patch.object(CachedKeyHeaderVerifier, "verify", autospec=True, return_value=True) as mock_verify:
+            verify_request_signature(request, key=public_key)
+            verify_request_signature(request, key=public_key)
+        assert mock_verify.call_count == 1
+        assert len(signature_memo) == 1
+
+    def test_memo_requires_same_body(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        verify_request_signature(request, key=public_key)
+        request.body = b'{"foo": "bar"}'
+        with patch.object(CachedKeyHeaderVerifier, "verify", autospec=True, return_value=True) as mock_verify:
+            verify_request_signature(request, key=public_key)
+        assert mock_verify.call_count == 1
+
+    def test_memo_requires_same_path(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        verify_request_signature(request, key=public_key)
+        replayed = RequestType(
+            body=request.body, headers=request.headers, method="POST", url="https://example.com/u/alice/inbox",
+        )
+        with pytest.raises(ValueError):
+            verify_request_signature(replayed, key=public_key)
+
+    def test_replay_protection(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        verify_request_signature(request, key=public_key, replay_protection=True)
+        with pytest.raises(ValueError):
+            verify_request_signature(request, key=public_key, replay_protection=True)
+
+
+class TestGetRequestVerificationJob:
+    def setup_method(self):
+        signature_memo.clear()
+
+    def get_request(self, key):
+        return TestVerifyRequestSignature().get_request(key)
+
+    def test_job_verifies_signature(self):
+        key = get_dummy_private_key()
+        request = self.get_request(key)
+        job = get_request_verification_job(request, key=key.publickey().export_key().decode())
+        assert verify_job(job) is True
+
+    def test_job_fails_for_other_key(self):
+        request = self.get_request(get_dummy_private_key())
+        job = get_request_verification_job(request, key=RSA.generate(2048).publickey().export_key().decode())
+        assert verify_job(job) is False
+
+    def test_no_job_for_remembered_signature(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        remember_request_signature(request, public_key)
+        assert get_request_verification_job(request, key=public_key) is None
+
+    def test_job_for_remembered_signature_replayed_elsewhere(self):
+        key = get_dummy_private_key()
+        public_key = key.publickey().export_key().decode()
+        request = self.get_request(key)
+        remember_request_signature(request, public_key)
+        replayed = RequestType(
+            body=request.body, headers=request.headers, method="POST", url="https://example.com/u/alice/inbox",
+        )
+        job = get_request_verification_job(replayed, key=public_key)
+        assert verify_job(job) is False
 
+    def test_raises_for_missing_date(self):
+        key = get_dummy_private_key()
+        request = self.get_request(key)
+        del request.headers["Date"]
+        with pytest.raises(ValueError):
+            get_request_verification_job(request, key=key.publickey().export_key().decode())
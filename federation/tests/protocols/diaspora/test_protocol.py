@@ -6,13 +6,19 @@ import pytest
 from federation.entities.diaspora.entities import DiasporaPost
 from federation.entities.diaspora.mappers import get_outbound_entity
 from federation.exceptions import NoSenderKeyFoundError, SignatureVerificationError
-from federation.protocols.diaspora.protocol import Protocol, identify_request
+from federation.protocols.diaspora.protocol import Protocol, get_sender_domains, identify_request
 from federation.tests.fixtures.keys import PUBKEY, get_dummy_private_key
 from federation.tests.fixtures.payloads import DIASPORA_PUBLIC_PAYLOAD, DIASPORA_ENCRYPTED_PAYLOAD, \
     DIASPORA_RESHARE_PAYLOAD
 from federation.types import RequestType, UserType
 
 
+def test_get_sender_domains():
+    assert get_sender_domains(RequestType(body=DIASPORA_PUBLIC_PAYLOAD)) == {"example.com"}
+    # the sender of encrypted payloads is unknown
+    assert get_sender_domains(RequestType(body=DIASPORA_ENCRYPTED_PAYLOAD)) == set()
+
+
 class MockUser:
     def __init__(self, nokey=False):
         if nokey:
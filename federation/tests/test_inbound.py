@@ -1,12 +1,27 @@
-from unittest.mock import patch
+import json
+from email.utils import formatdate
+from unittest.mock import Mock, patch
 
 import pytest
+import requests
+from django.conf import settings
+from django.test import override_settings
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
 
-from federation.exceptions import NoSuitableProtocolFoundError
-from federation.inbound import handle_receive
+from federation import identify_protocol_by_request
+from federation.exceptions import BlockedDomainError, NoSuitableProtocolFoundError, RequestRejectedError
+from federation.inbound import enqueue_receive, handle_receive, handle_receive_batch, process_queue
+from federation.protocols.activitypub.protocol import Protocol as ActivitypubProtocol
+from federation.protocols.activitypub.signing import get_http_authentication, signature_memo
 from federation.protocols.diaspora.protocol import Protocol
+from federation.tests.fixtures.keys import PUBKEY, get_dummy_private_key
 from federation.tests.fixtures.payloads import DIASPORA_PUBLIC_PAYLOAD
-from federation.types import RequestType
+from federation.types import DuplicateResult, PublicKeyType, RequestType, UserType
+from federation.utils.keys import key_cache
+from federation.utils.policy import DomainPolicy
+from federation.utils.queue import MemoryQueue
+from federation.utils.verification import VerificationService
 
 
 class TestHandleReceiveProtocolIdentification:
@@ -26,3 +41,307 @@ class TestHandleReceiveProtocolIdentification:
         payload = RequestType(body="foobar")
         with pytest.raises(NoSuitableProtocolFoundError):
             handle_receive(payload)
+
+
+class TestIdentifyProtocolByRequest:
+    @pytest.mark.parametrize("content_type,protocol_name", (
+        ("application/activity+json", "activitypub"),
+        ('application/ld+json; profile="https://www.w3.org/ns/activitystreams"', "activitypub"),
+        ("application/magic-envelope+xml", "diaspora"),
+    ))
+    def test_identified_by_content_type(self, content_type, protocol_name):
+        request = RequestType(body="foobar", headers={"Content-Type": content_type})
+        with patch("federation.utils.request.json.loads") as mock_loads:
+            assert identify_protocol_by_request(request).__name__ == f"federation.protocols.{protocol_name}.protocol"
+        assert not mock_loads.called
+
+    def test_activitypub_content_type_with_non_json_body(self):
+        request = RequestType(body="foobar", headers={"Content-Type": "application/activity+json"})
+        with pytest.raises(NoSuitableProtocolFoundError):
+            handle_receive(request)
+
+    def test_identified_by_matrix_transaction_path(self):
+        request = RequestType(body='{"events": []}', headers={"Content-Type": "application/json"},
+                              url="https://example.com/matrix/transactions/123?access_token=foo")
+        assert identify_protocol_by_request(request).__name__ == "federation.protocols.matrix.protocol"
+
+    def test_body_is_sniffed_for_other_content_types(self):
+        request = RequestType(body=DIASPORA_PUBLIC_PAYLOAD, headers={"Content-Type": "application/xml"})
+        assert identify_protocol_by_request(request).__name__ == "federation.protocols.diaspora.protocol"
+        with pytest.raises(NoSuitableProtocolFoundError):
+            identify_protocol_by_request(RequestType(body="foobar", headers={"Content-Type": "text/plain"}))
+
+    def test_protocols_are_imported_once(self):
+        identify_protocol_by_request(RequestType(body=DIASPORA_PUBLIC_PAYLOAD))
+        with patch("federation.importlib.import_module") as mock_import:
+            identify_protocol_by_request(RequestType(body=DIASPORA_PUBLIC_PAYLOAD))
+        assert not mock_import.called
+
+
+@patch("federation.utils.policy._policy", DomainPolicy(blocklist=["example.com"]))
+class TestHandleReceiveDomainPolicy:
+    def test_blocked_domain_is_rejected_before_verification(self):
+        with patch.object(Protocol, "receive") as mock_receive:
+            with pytest.raises(BlockedDomainError) as exc_info:
+                handle_receive(RequestType(body=DIASPORA_PUBLIC_PAYLOAD))
+        assert exc_info.value.status_code == 403
+        assert not mock_receive.called
+
+    def test_batch(self):
+        with patch.object(Protocol, "receive") as mock_receive:
+            results = handle_receive_batch([RequestType(body=DIASPORA_PUBLIC_PAYLOAD)])
+        assert isinstance(results[0], BlockedDomainError)
+        assert not mock_receive.called
+
+    def test_enqueue_receive(self):
+        queue = MemoryQueue()
+        request = RequestType(body='{"actor": "https://example.com/u/bob"}', headers={
+            "Content-Type": "application/activity+json", "Signature": 'keyId="https://example.com/u/bob#main-key"',
+        })
+        with pytest.raises(BlockedDomainError):
+            enqueue_receive(request, queue=queue)
+        assert len(queue) == 0
+
+
+@patch("federation.utils.dedupe._get_redis", return_value=None)
+class TestHandleReceiveDeduplication:
+    def get_request(self, payload_id="https://example.com/activity/1"):
+        return RequestType(body=json.dumps({
+            "@context": "https://www.w3.org/ns/activitystreams", "id": payload_id, "type": "Like",
+            "actor": "https://example.com/u/bob", "object": "https://example.com/note/1",
+        }))
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=["entity"])
+    def test_duplicates_are_not_processed(self, mock_message_to_objects, mock_redis):
+        with patch.object(ActivitypubProtocol, "receive", return_value=("https://example.com/u/bob", {"type": "Like"})) \
+                as mock_receive:
+            assert handle_receive(self.get_request()) == ("https://example.com/u/bob", "activitypub", ["entity"])
+            result = handle_receive(self.get_request())
+            assert isinstance(result, DuplicateResult)
+            assert result == ("https://example.com/u/bob", "activitypub", [])
+            assert mock_receive.call_count == 1
+            handle_receive(self.get_request("https://example.com/activity/2"))
+            assert mock_receive.call_count == 2
+
+    def test_failed_mappings_are_not_remembered(self, mock_redis):
+        with patch.object(ActivitypubProtocol, "receive", return_value=("https://example.com/u/bob", {"type": "Like"})), \
+                patch("federation.entities.activitypub.mappers.message_to_objects",
+                      side_effect=[ValueError, ["entity"]]) as mock_message_to_objects:
+            with pytest.raises(ValueError):
+                handle_receive(self.get_request())
+            assert handle_receive(self.get_request()) == ("https://example.com/u/bob", "activitypub", ["entity"])
+            assert isinstance(handle_receive(self.get_request()), DuplicateResult)
+        assert mock_message_to_objects.call_count == 2
+
+    def test_failed_mappings_in_a_batch_are_not_remembered(self, mock_redis):
+        with patch.object(ActivitypubProtocol, "receive", return_value=("https://example.com/u/bob", {"type": "Like"})), \
+                patch("federation.entities.activitypub.mappers.message_to_objects",
+                      side_effect=[ValueError, ["entity"]]):
+            results = handle_receive_batch([self.get_request()], skip_author_verification=True)
+            assert isinstance(results[0], ValueError)
+            assert handle_receive_batch([self.get_request()], skip_author_verification=True) == [
+                ("https://example.com/u/bob", "activitypub", ["entity"])]
+
+    def get_signed_requests(self):
+        signature_memo.clear()
+        signed = TestHandleReceiveBatch().get_request()
+        headers = {name: value for name, value in signed.headers.items() if name.lower() != "signature"}
+        return RequestType(body=signed.body, headers=headers, method="POST", url=signed.url), signed
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_unverified_copies_are_not_remembered(self, mock_message_to_objects, mock_redis):
+        unsigned, signed = self.get_signed_requests()
+        with patch.object(ActivitypubProtocol, "get_signer_key", autospec=True,
+                          side_effect=TestHandleReceiveBatch().signer_key()):
+            assert handle_receive(unsigned) == ("https://example.com/u/bob", "activitypub", [])
+            assert mock_message_to_objects.call_args[0][0] == {}
+            result = handle_receive(signed)
+            assert not isinstance(result, DuplicateResult)
+            assert mock_message_to_objects.call_args[0][0]["id"] == "https://example.com/activity/1"
+            assert isinstance(handle_receive(signed), DuplicateResult)
+        assert mock_message_to_objects.call_count == 2
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_unverified_copies_in_a_batch_are_not_remembered(self, mock_message_to_objects, mock_redis):
+        unsigned, signed = self.get_signed_requests()
+        with patch.object(ActivitypubProtocol, "get_signer_key", autospec=True,
+                          side_effect=TestHandleReceiveBatch().signer_key()):
+            results = handle_receive_batch([unsigned, signed])
+            assert not isinstance(results[1], DuplicateResult)
+            assert mock_message_to_objects.call_args[0][0]["id"] == "https://example.com/activity/1"
+            assert isinstance(handle_receive(signed), DuplicateResult)
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    @patch("federation.protocols.activitypub.protocol.verify_request_signature")
+    @patch("federation.protocols.activitypub.protocol.get_profile", return_value=None)
+    def test_dropped_self_deletes_are_not_remembered(self, mock_get_profile, mock_verify, mock_message_to_objects,
+                                                     mock_redis):
+        request = RequestType(body=json.dumps({
+            "@context": "https://www.w3.org/ns/activitystreams", "id": "https://example.com/u/bob#delete",
+            "type": "Delete", "actor": "https://example.com/u/bob", "object": "https://example.com/u/bob",
+        }), headers={"Signature": 'keyId="https://example.com/u/bob#main-key",algorithm="rsa-sha256",'
+                                  'headers="date",signature="foo"'})
+        key_cache.clear()
+        # the actor key isn't cached yet, the Delete is dropped
+        assert handle_receive(request) == ("https://example.com/u/bob", "activitypub", [])
+        assert not mock_verify.called
+        key_cache.set("https://example.com/u/bob#main-key", PublicKeyType(
+            id="https://example.com/u/bob#main-key", owner="https://example.com/u/bob", pem=PUBKEY, key=None))
+        try:
+            result = handle_receive(request)
+        finally:
+            key_cache.clear()
+        assert not isinstance(result, DuplicateResult)
+        assert mock_verify.call_count == 1
+        assert mock_message_to_objects.call_args[0][0]["type"] == "Delete"
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_copies_in_a_batch(self, mock_message_to_objects, mock_redis):
+        with patch.object(ActivitypubProtocol, "receive", return_value=("https://example.com/u/bob", {"type": "Like"})) \
+                as mock_receive:
+            results = handle_receive_batch([self.get_request(), self.get_request()], skip_author_verification=True)
+        assert mock_receive.call_count == 1
+        assert not isinstance(results[0], DuplicateResult)
+        assert isinstance(results[1], DuplicateResult)
+        assert results == [("https://example.com/u/bob", "activitypub", [])] * 2
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_copies_in_a_batch_are_processed_if_the_first_one_fails(self, mock_message_to_objects, mock_redis):
+        with patch.object(ActivitypubProtocol, "receive", side_effect=[
+                    ValueError, ("https://example.com/u/bob", {})]) as mock_receive:
+            results = handle_receive_batch([self.get_request(), self.get_request()], skip_author_verification=True)
+        assert mock_receive.call_count == 2
+        assert isinstance(results[0], ValueError)
+        assert results[1] == ("https://example.com/u/bob", "activitypub", [])
+
+
+class TestHandleReceiveBatch:
+    def setup_method(self):
+        signature_memo.clear()
+
+    def get_request(self, payload_id="https://example.com/activity/1"):
+        body = json.dumps({
+            "@context": "https://www.w3.org/ns/activitystreams", "id": payload_id, "type": "Like",
+            "actor": "https://example.com/u/bob", "object": "https://example.com/note/1",
+        })
+        request = requests.Request("POST", "https://example.com/inbox", data=body.encode(), headers={
+            "Date": formatdate(usegmt=True), "User-Agent": "foobar", "Host": "example.com",
+        }).prepare()
+        request = get_http_authentication(get_dummy_private_key(), "https://example.com/u/bob#main-key")(request)
+        return RequestType(body=request.body, headers=request.headers, method="POST", url=request.url)
+
+    def signer_key(self, key=None):
+        key = key or get_dummy_private_key().publickey().export_key().decode()
+
+        def get_signer_key(protocol):
+            protocol.sender = "https://example.com/u/bob"
+            return "https://example.com/u/bob#main-key", key, "rsa-sha256"
+        return get_signer_key
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_verifies_signatures_as_a_batch(self, mock_message_to_objects):
+        with patch.object(ActivitypubProtocol, "get_signer_key", autospec=True, side_effect=self.signer_key()), \
+                patch("federation.inbound.get_verification_service") as mock_service:
+            mock_service.return_value.verify.return_value = [True, True]
+            results = handle_receive_batch([self.get_request(), self.get_request("https://example.com/activity/2")])
+        assert len(mock_service.return_value.verify.call_args[0][0]) == 2
+        assert results == [
+            ("https://example.com/u/bob", "activitypub", []),
+            ("https://example.com/u/bob", "activitypub", []),
+        ]
+        assert mock_message_to_objects.call_args[0][0]["id"] == "https://example.com/activity/2"
+        assert len(signature_memo) == 2
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    def test_failed_verification_goes_through_handle_receive(self, mock_message_to_objects):
+        request = self.get_request()
+        with patch.object(ActivitypubProtocol, "get_signer_key", autospec=True, side_effect=self.signer_key()), \
+                patch("federation.inbound.get_verification_service") as mock_service, \
+                patch("federation.inbound.handle_receive", return_value=("actor", "activitypub", [])) as mock_receive:
+            mock_service.return_value.verify.return_value = [False]
+            results = handle_receive_batch([request])
+        assert mock_receive.call_count == 1
+        # the parsed request is passed on
+        assert mock_receive.call_args[0][0].request is request
+        assert results == [("actor", "activitypub", [])]
+
+    def test_returns_exceptions_per_request(self):
+        with patch.object(Protocol, "receive", return_value=("foobar@domain.tld", "<foobar></foobar>")), \
+                patch("federation.entities.diaspora.mappers.message_to_objects", return_value=[]):
+            results = handle_receive_batch([RequestType(body="foobar"), RequestType(body=DIASPORA_PUBLIC_PAYLOAD)])
+        assert isinstance(results[0], NoSuitableProtocolFoundError)
+        assert results[1] == ("foobar@domain.tld", "diaspora", [])
+
+    @patch("federation.entities.activitypub.mappers.message_to_objects", return_value=[])
+    @patch("federation.protocols.activitypub.protocol.refetch_public_key", return_value=None)
+    def test_invalid_signature(self, mock_refetch, mock_message_to_objects):
+        other_key = RSA.generate(2048).publickey().export_key().decode()
+        with patch.object(ActivitypubProtocol, "get_signer_key", autospec=True,
+                          side_effect=self.signer_key(key=other_key)), \
+                patch("federation.inbound.get_verification_service", return_value=VerificationService(max_workers=0)):
+            results = handle_receive_batch([self.get_request()])
+        assert results == [("https://example.com/u/bob", "activitypub", [])]
+        assert mock_refetch.called
+        assert not mock_message_to_objects.call_args[0][0]
+        assert len(signature_memo) == 0
+
+
+class TestEnqueueReceive:
+    def test_queues_request(self):
+        queue = MemoryQueue()
+        request = RequestType(body=DIASPORA_PUBLIC_PAYLOAD)
+        item = enqueue_receive(request, recipient="https://example.com/u/bob", queue=queue)
+        assert item.request is request
+        assert item.recipient == "https://example.com/u/bob"
+        assert queue.get() is item
+
+    def test_rejects_large_body(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "inbound_request_max_size": 10}):
+            with pytest.raises(RequestRejectedError) as exc_info:
+                enqueue_receive(RequestType(body=DIASPORA_PUBLIC_PAYLOAD), queue=MemoryQueue())
+        assert exc_info.value.status_code == 413
+
+    def test_rejects_unsigned_activitypub_request(self):
+        queue = MemoryQueue()
+        request = RequestType(body="{}", headers={"Content-Type": "application/activity+json"})
+        with pytest.raises(RequestRejectedError) as exc_info:
+            enqueue_receive(request, queue=queue)
+        assert exc_info.value.status_code == 401
+        assert len(queue) == 0
+        request.headers["signature"] = "foo"
+        enqueue_receive(request, queue=queue)
+        assert len(queue) == 1
+
+    def test_rejects_when_queue_is_full(self):
+        queue = MemoryQueue(maxsize=1)
+        enqueue_receive(RequestType(body=DIASPORA_PUBLIC_PAYLOAD), queue=queue)
+        with pytest.raises(RequestRejectedError) as exc_info:
+            enqueue_receive(RequestType(body=DIASPORA_PUBLIC_PAYLOAD), queue=queue)
+        assert exc_info.value.status_code == 503
+
+
+class TestProcessQueue:
+    def test_drains_queue_through_handle_receive(self):
+        queue = MemoryQueue()
+        user = UserType(id="https://example.com/u/bob")
+        first = enqueue_receive(RequestType(body="foo"), recipient=user.id, queue=queue)
+        second = enqueue_receive(RequestType(body="bar"), queue=queue)
+        handler = Mock()
+        error = NoSuitableProtocolFoundError()
+        with patch("federation.inbound.handle_receive", side_effect=[("sender", "activitypub", []), error]) as \
+                mock_receive:
+            assert process_queue(handler, queue=queue, user_fetcher={user.id: user}.get) == 2
+        assert mock_receive.call_args_list[0][0][0] is first.request
+        assert mock_receive.call_args_list[0][1]["user"] is user
+        assert mock_receive.call_args_list[1][1]["user"] is None
+        assert handler.call_args_list[0][0] == (first, ("sender", "activitypub", []))
+        assert handler.call_args_list[1][0] == (second, error)
+        assert len(queue) == 0
+
+    def test_max_requests(self):
+        queue = MemoryQueue()
+        for _ in range(3):
+            enqueue_receive(RequestType(body="foo"), queue=queue)
+        with patch("federation.inbound.handle_receive", return_value=("sender", "activitypub", [])):
+            assert process_queue(Mock(), queue=queue, max_requests=2) == 2
+        assert len(queue) == 1
@@ -0,0 +1,27 @@
+from unittest.mock import patch
+
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
+# noinspection PyPackageRequirements
+from Crypto.PublicKey.RSA import RsaKey
+
+from federation.tests.fixtures.keys import PRIVATE_KEY, get_dummy_private_key
+from federation.types import UserType
+from federation.utils.keys import rsa_key_cache
+
+
+class TestUserType:
+    def test_rsa_private_key__parses_pem_once(self):
+        rsa_key_cache.clear()
+        user = UserType(id="https://example.com/u/bob/", private_key=PRIVATE_KEY)
+        with patch("federation.utils.keys.RSA.import_key", wraps=RSA.import_key) as mock_import:
+            key = user.rsa_private_key
+            assert user.rsa_private_key is key
+            assert UserType(id="https://example.com/u/bob/", private_key=PRIVATE_KEY).rsa_private_key is key
+        assert mock_import.call_count == 1
+        assert isinstance(key, RsaKey)
+        assert key == get_dummy_private_key()
+
+    def test_rsa_private_key__returns_key_object(self):
+        key = get_dummy_private_key()
+        assert UserType(id="https://example.com/u/bob/", private_key=key).rsa_private_key is key
@@ -3,12 +3,19 @@ import json
 from unittest.mock import patch, Mock
 
 import pytest
+# noinspection PyPackageRequirements
+from Crypto.PublicKey.RSA import RsaKey
 
 from federation.entities.activitypub.models import Follow, Note
+from federation.tests.fixtures.keys import PUBKEY
+from federation.types import PublicKeyType
 from federation.tests.fixtures.payloads import (
     ACTIVITYPUB_FOLLOW, ACTIVITYPUB_POST, ACTIVITYPUB_POST_OBJECT, ACTIVITYPUB_POST_OBJECT_IMAGES)
 from federation.utils.activitypub import (
-    retrieve_and_parse_document, retrieve_and_parse_profile, get_profile_id_from_webfinger)
+    retrieve_and_parse_document, retrieve_and_parse_profile, get_profile_id_from_webfinger, extract_public_key,
+    key_cache, refetch_public_key, retrieve_public_key)
+from federation.utils.keys import gone_keys, refetch_cooldowns
+from federation.utils.policy import DomainPolicy
 
 
 class TestGetProfileIdFromWebfinger:
@@ -52,6 +59,12 @@ class TestRetrieveAndParseDocument:
             extra_headers={'accept': 'application/activity+json, application/ld+json; profile="https://www.w3.org/ns/activitystreams"'}, cache=True, auth=auth,
         )
 
+    @patch("federation.utils.activitypub.fetch_document", autospec=True)
+    def test_blocked_domain_is_not_fetched(self, mock_fetch):
+        with patch("federation.utils.policy._policy", DomainPolicy(blocklist=["example.com"])):
+            assert retrieve_and_parse_document("https://example.com/foobar") is None
+        assert not mock_fetch.called
+
     @patch("federation.entities.activitypub.models.extract_receivers", return_value=[])
     @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(
         json.dumps(ACTIVITYPUB_FOLLOW), None, None),
@@ -130,3 +143,138 @@ class TestRetrieveAndParseProfile:
             mock_retrieve.return_value = mock_profile()
             retrieve_and_parse_profile("https://example.com/profile")
             assert mock_profile.validate.called
+
+
+class TestExtractPublicKey:
+    def test_actor_document(self):
+        document = {
+            "id": "https://example.com/bob",
+            "publicKey": {"id": "https://example.com/bob#main-key", "owner": "https://example.com/bob",
+                          "publicKeyPem": PUBKEY},
+        }
+        assert extract_public_key(document, "https://example.com/bob#main-key") == ("https://example.com/bob", PUBKEY)
+        # keyId without fragment
+        assert extract_public_key(document, "https://example.com/bob") == ("https://example.com/bob", PUBKEY)
+        assert extract_public_key(document, "https://example.com/bob#other-key") is None
+
+    def test_key_list(self):
+        document = {
+            "id": "https://example.com/bob",
+            "publicKey": [
+                {"id": "https://example.com/bob#main-key", "publicKeyPem": "foo"},
+                {"id": "https://example.com/bob#other-key", "publicKeyPem": PUBKEY},
+            ],
+        }
+        assert extract_public_key(document, "https://example.com/bob#other-key") == ("https://example.com/bob", PUBKEY)
+
+    def test_standalone_key_document(self):
+        document = {"id": "https://example.com/bob/main-key", "owner": "https://example.com/bob", "publicKeyPem": PUBKEY}
+        assert extract_public_key(document, "https://example.com/bob/main-key") == ("https://example.com/bob", PUBKEY)
+
+    def test_forged_owner(self):
+        document = {"id": "https://example.com/bob/main-key", "owner": "https://evil.com/bob", "publicKeyPem": PUBKEY}
+        assert extract_public_key(document, "https://example.com/bob/main-key") is None
+
+    def test_assertion_method_multikey(self):
+        document = {
+            "id": "https://example.com/bob",
+            "publicKey": {"id": "https://example.com/bob#main-key", "publicKeyPem": PUBKEY},
+            "assertionMethod": [{"id": "https://example.com/bob#ed25519-key", "type": "Multikey",
+                                 "controller": "https://example.com/bob", "publicKeyMultibase": "z6Mkfoobar"}],
+        }
+        assert extract_public_key(document, "https://example.com/bob#ed25519-key") == (
+            "https://example.com/bob", "z6Mkfoobar")
+        # keyId without fragment is still the RSA key
+        assert extract_public_key(document, "https://example.com/bob") == ("https://example.com/bob", PUBKEY)
+
+    def test_standalone_multikey_document(self):
+        document = {"id": "https://example.com/bob#ed25519-key", "type": "Multikey",
+                    "controller": "https://example.com/bob", "publicKeyMultibase": "z6Mkfoobar"}
+        assert extract_public_key(document, "https://example.com/bob#ed25519-key") == (
+            "https://example.com/bob", "z6Mkfoobar")
+        document["controller"] = "https://evil.com/bob"
+        assert extract_public_key(document, "https://example.com/bob#ed25519-key") is None
+
+
+class TestRetrievePublicKey:
+    def setup_method(self):
+        key_cache.clear()
+        gone_keys.clear()
+
+    @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(json.dumps({
+        "id": "https://example.com/bob",
+        "type": "Person",
+        "publicKey": {"id": "https://example.com/bob#main-key", "owner": "https://example.com/bob",
+                      "publicKeyPem": PUBKEY},
+    }), 200, None))
+    def test_returns_and_caches_key(self, mock_fetch):
+        public_key = retrieve_public_key("https://example.com/bob#main-key")
+        assert public_key.owner == "https://example.com/bob"
+        assert public_key.pem == PUBKEY
+        assert isinstance(public_key.key, RsaKey)
+        assert retrieve_public_key("https://example.com/bob#main-key") is public_key
+        assert mock_fetch.call_count == 1
+        retrieve_public_key("https://example.com/bob#main-key", cache=False)
+        assert mock_fetch.call_count == 2
+        assert mock_fetch.call_args.kwargs["cache"] is False
+
+    @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(None, 404, None))
+    def test_returns_none_if_not_found(self, mock_fetch):
+        assert retrieve_public_key("https://example.com/bob#main-key") is None
+        assert "https://example.com/bob#main-key" not in key_cache
+
+    @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(None, 410, None))
+    def test_gone_keys_are_not_fetched_again(self, mock_fetch):
+        assert retrieve_public_key("https://example.com/bob#main-key") is None
+        assert retrieve_public_key("https://example.com/bob#main-key") is None
+        assert mock_fetch.call_count == 1
+        # a refetch still goes through
+        retrieve_public_key("https://example.com/bob#main-key", cache=False)
+        assert mock_fetch.call_count == 2
+
+    @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(None, 503, None))
+    def test_unavailable_keys_are_fetched_again(self, mock_fetch):
+        retrieve_public_key("https://example.com/bob#main-key")
+        retrieve_public_key("https://example.com/bob#main-key")
+        assert mock_fetch.call_count == 2
+
+    @patch("federation.utils.activitypub.fetch_document", autospec=True, return_value=(json.dumps({
+        "id": "https://example.com/bob", "publicKey": {"id": "https://example.com/bob#main-key",
+                                                      "publicKeyPem": "not a key"},
+    }), 200, None))
+    def test_returns_none_for_invalid_key(self, mock_fetch):
+        assert retrieve_public_key("https://example.com/bob#main-key") is None
+
+
+class TestRefetchPublicKey:
+    def setup_method(self):
+        key_cache.clear()
+        gone_keys.clear()
+        refetch_cooldowns.clear()
+
+    @patch("federation.utils.activitypub.retrieve_public_key", autospec=True)
+    def test_refetches_once_per_cooldown(self, mock_retrieve):
+        mock_retrieve.return_value = PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None)
+        assert refetch_public_key("https://example.com/bob#main-key", stale_key="old") == mock_retrieve.return_value
+        mock_retrieve.assert_called_once_with("https://example.com/bob#main-key", cache=False)
+        assert refetch_public_key("https://example.com/bob#main-key", stale_key="old") is None
+        assert mock_retrieve.call_count == 1
+
+    @patch("federation.utils.activitypub.retrieve_public_key", autospec=True)
+    def test_returns_none_for_same_key(self, mock_retrieve):
+        mock_retrieve.return_value = PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None)
+        assert refetch_public_key("https://example.com/bob#main-key", stale_key=PUBKEY) is None
+
+    @patch("federation.utils.activitypub.retrieve_public_key", autospec=True)
+    def test_returns_cached_rotated_key_during_cooldown(self, mock_retrieve):
+        public_key = PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=None)
+        refetch_cooldowns.add("https://example.com/bob#main-key", True)
+        key_cache.set("https://example.com/bob#main-key", public_key)
+        assert refetch_public_key("https://example.com/bob#main-key", stale_key="old") is public_key
+        assert not mock_retrieve.called
+        # the cached key is the stale one
+        assert refetch_public_key("https://example.com/bob#main-key", stale_key=PUBKEY) is None
+        assert not mock_retrieve.called
@@ -0,0 +1,52 @@
+from federation.utils.cache import TTLCache
+
+
+class TestTTLCache:
+    def test_get_set(self):
+        cache = TTLCache()
+        cache.set('foo', 'bar')
+        assert cache.get('foo') == 'bar'
+        assert cache.get('bar') is None
+        assert cache.get('bar', 'baz') == 'baz'
+        assert cache.stats() == {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 1}
+
+    def test_expiration(self):
+        now = [0]
+        cache = TTLCache(ttl=10, timer=lambda: now[0])
+        cache.set('foo', 'bar')
+        cache.set('spam', 'eggs', ttl=None)
+        now[0] = 9
+        assert 'foo' in cache
+        now[0] = 10
+        assert 'foo' not in cache
+        assert cache.get('foo') is None
+        assert cache.get('spam') == 'eggs'
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert cache.stats()['evictions'] == 1
+
+    def test_pop_and_clear(self):
+        cache = TTLCache()
+        cache.set('a', 1)
+        assert cache.pop('a') == 1
+        assert cache.pop('a', 2) == 2
+        cache.set('a', 1)
+        cache.clear()
+        assert len(cache) == 0
+
+    def test_add(self):
+        now = [0]
+        cache = TTLCache(ttl=10, timer=lambda: now[0])
+        assert cache.add('a', 1) is True
+        assert cache.add('a', 2) is False
+        assert cache.get('a') == 1
+        now[0] = 10
+        assert cache.add('a', 3) is True
+        assert cache.get('a') == 3
@@ -0,0 +1,62 @@
+import json
+from unittest.mock import Mock, patch
+
+from django.conf import settings
+from django.test import override_settings
+
+from federation.tests.fixtures.payloads import DIASPORA_PUBLIC_PAYLOAD
+from federation.types import RequestType
+from federation.utils.dedupe import (
+    REDIS_KEY_PREFIX, get_dedupe_key, get_seen_activity, remember_activity, seen_activities)
+from federation.utils.request import ParsedRequest
+
+
+def get_request(payload_id="https://example.com/activity/1", **extra):
+    return ParsedRequest(RequestType(body=json.dumps({"id": payload_id, "type": "Like", **extra})))
+
+
+class TestGetDedupeKey:
+    def test_same_activity(self):
+        assert get_dedupe_key(get_request()) == get_dedupe_key(get_request())
+
+    def test_different_id_or_body(self):
+        key = get_dedupe_key(get_request())
+        assert get_dedupe_key(get_request("https://example.com/activity/2")) != key
+        assert get_dedupe_key(get_request(object="https://example.com/note/1")) != key
+
+    def test_payloads_without_id(self):
+        assert get_dedupe_key(ParsedRequest(RequestType(body='{"type": "Like"}'))) is None
+        assert get_dedupe_key(ParsedRequest(RequestType(body=DIASPORA_PUBLIC_PAYLOAD))) is None
+
+    def test_disabled(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "inbound_dedupe_ttl": 0}):
+            assert get_dedupe_key(get_request()) is None
+
+
+@patch("federation.utils.dedupe._get_redis", return_value=None)
+class TestSeenActivities:
+    def test_remember_activity(self, mock_redis):
+        assert get_seen_activity("foo") is None
+        remember_activity("foo", "https://example.com/u/bob", "activitypub")
+        assert get_seen_activity("foo") == ("https://example.com/u/bob", "activitypub")
+
+    def test_redis(self, mock_redis):
+        redis = mock_redis.return_value = Mock()
+        remember_activity("foo", "https://example.com/u/bob", "activitypub")
+        redis.set.assert_called_once_with(
+            REDIS_KEY_PREFIX + "foo", '["https://example.com/u/bob", "activitypub"]', ex=86400)
+
+        seen_activities.clear()
+        redis.get.return_value = '["https://example.com/u/bob", "activitypub"]'
+        assert get_seen_activity("foo") == ("https://example.com/u/bob", "activitypub")
+        # kept in the process-local cache
+        redis.get.reset_mock()
+        assert get_seen_activity("foo") == ("https://example.com/u/bob", "activitypub")
+        assert not redis.get.called
+
+    def test_redis_errors_are_ignored(self, mock_redis):
+        redis = mock_redis.return_value = Mock()
+        redis.get.side_effect = redis.set.side_effect = ConnectionError
+        remember_activity("foo", "https://example.com/u/bob", "activitypub")
+        seen_activities.clear()
+        assert get_seen_activity("foo") is None
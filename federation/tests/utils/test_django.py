@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.test import override_settings
+
+from federation.utils.django import get_redis
+
+
+class TestGetRedis:
+    def test_not_configured(self):
+        assert get_redis() is None
+
+    def test_client_is_shared(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "redis": {"host": "localhost", "db": 1}}):
+            client = get_redis()
+            assert get_redis() is client
+        with override_settings(FEDERATION={**settings.FEDERATION, "redis": {"host": "localhost", "db": 2}}):
+            assert get_redis() is not client
@@ -0,0 +1,109 @@
+from unittest.mock import patch
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, NoEncryption, PrivateFormat, PublicFormat
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
+
+from federation.tests.fixtures.keys import PUBKEY, get_dummy_private_key
+from federation.types import PublicKeyType
+from federation.utils.keys import (
+    base58_decode, base58_encode, decode_multikey, encode_multikey, get_key_fingerprint, get_multikey,
+    import_ed25519_key, import_public_key, import_rsa_key, invalidate_public_key, key_cache, rsa_key_cache)
+
+
+class TestImportRsaKey:
+    def setup_method(self):
+        rsa_key_cache.clear()
+
+    def test_parses_key_once(self):
+        with patch("federation.utils.keys.RSA.import_key", wraps=RSA.import_key) as mock_import:
+            key = import_rsa_key(PUBKEY)
+            assert import_rsa_key(PUBKEY) is key
+            assert import_rsa_key(PUBKEY.encode()) is key
+        assert mock_import.call_count == 1
+        assert key == RSA.import_key(PUBKEY)
+
+    def test_returns_rsa_key_objects(self):
+        key = get_dummy_private_key()
+        assert import_rsa_key(key) is key
+
+    def test_raises_for_invalid_key(self):
+        with pytest.raises(ValueError):
+            import_rsa_key("foobar")
+        assert len(rsa_key_cache) == 0
+
+
+class TestInvalidatePublicKey:
+    def setup_method(self):
+        rsa_key_cache.clear()
+        key_cache.clear()
+
+    def test_invalidates_by_key_id(self):
+        key = import_rsa_key(PUBKEY)
+        key_cache.set("https://example.com/bob#main-key", PublicKeyType(
+            id="https://example.com/bob#main-key", owner="https://example.com/bob", pem=PUBKEY, key=key))
+        invalidate_public_key(key_id="https://example.com/bob#main-key")
+        assert "https://example.com/bob#main-key" not in key_cache
+        assert get_key_fingerprint(PUBKEY) not in rsa_key_cache
+
+    def test_invalidates_by_key(self):
+        import_rsa_key(PUBKEY)
+        invalidate_public_key(key=PUBKEY)
+        assert get_key_fingerprint(PUBKEY) not in rsa_key_cache
+
+
+def raw(key):
+    return key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+
+
+class TestMultikey:
+    def test_base58(self):
+        assert base58_encode(b"\0\0hello world") == "11StV1DL6CwTryKyV"
+        assert base58_decode("11StV1DL6CwTryKyV") == b"\0\0hello world"
+        with pytest.raises(ValueError):
+            base58_decode("0OIl")
+
+    def test_encode_decode(self):
+        key = Ed25519PrivateKey.generate()
+        multikey = encode_multikey(key)
+        assert multikey.startswith("z6Mk")
+        assert raw(decode_multikey(multikey)) == raw(key.public_key())
+
+    def test_decode_invalid_multikey(self):
+        with pytest.raises(ValueError):
+            decode_multikey("foobar")
+        with pytest.raises(ValueError):
+            decode_multikey("z" + base58_encode(b"\x12\x00" + b"\0" * 32))
+
+    def test_get_multikey(self):
+        key = Ed25519PrivateKey.generate()
+        assert get_multikey("https://example.com/u/bob", key) == {
+            "id": "https://example.com/u/bob#ed25519-key",
+            "type": "Multikey",
+            "controller": "https://example.com/u/bob",
+            "publicKeyMultibase": encode_multikey(key),
+        }
+
+
+class TestImportPublicKey:
+    def test_rsa_key(self):
+        assert import_public_key(PUBKEY) == RSA.import_key(PUBKEY)
+
+    def test_multikey(self):
+        key = Ed25519PrivateKey.generate()
+        assert raw(import_public_key(encode_multikey(key))) == raw(key.public_key())
+
+    def test_ed25519_pem(self):
+        key = Ed25519PrivateKey.generate()
+        pem = key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption())
+        assert raw(import_ed25519_key(pem).public_key()) == raw(key.public_key())
+
+    def test_not_ed25519(self):
+        key = ec.generate_private_key(ec.SECP256R1())
+        with pytest.raises(ValueError):
+            import_ed25519_key(key.private_bytes(Encoding.PEM, PrivateFormat.PKCS8, NoEncryption()))
+        with pytest.raises(ValueError):
+            import_ed25519_key("foobar")
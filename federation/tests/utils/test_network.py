@@ -1,13 +1,18 @@
+import socket
 from datetime import timedelta
 from unittest.mock import patch, Mock, call
 
 import pytest
+import requests
 from requests import HTTPError
 from requests.exceptions import SSLError, RequestException
 
+from federation.exceptions import BlockedDomainError
 from federation.utils.network import (
-    fetch_document, USER_AGENT, send_document, fetch_host_ip,
+    fetch_document, USER_AGENT, send_document, fetch_host_ip, dns_cache, install_dns_cache, CachedDNSAdapter,
+    CachedDNSHTTPSConnection,
 )
+from federation.utils.policy import DomainPolicy
 
 
 class TestFetchDocument:
@@ -25,6 +30,15 @@ class TestFetchDocument:
         with pytest.raises(ValueError):
             fetch_document()
 
+    @patch("federation.utils.network.session.get")
+    def test_blocked_domains_are_not_fetched(self, mock_get):
+        with patch("federation.utils.policy._policy", DomainPolicy(blocklist=["example.com"])):
+            for kwargs in ({"url": "https://social.example.com/foo"}, {"host": "example.com"}):
+                document, status_code, error = fetch_document(**kwargs)
+                assert (document, status_code) == (None, None)
+                assert isinstance(error, BlockedDomainError)
+        assert not mock_get.called
+
     @patch("federation.utils.network.session.get")
     def test_url_is_called(self, mock_get):
         mock_get.return_value = Mock(status_code=200, text="foo")
@@ -99,12 +113,56 @@ class TestFetchDocument:
 
 
 class TestFetchHostIp:
+    def setup_method(self):
+        dns_cache.invalidate()
+
     @patch('federation.utils.network.socket.gethostbyname', autospec=True, return_value='127.0.0.1')
     def test_calls(self, mock_get_ip):
         result = fetch_host_ip('domain.local')
         assert result == '127.0.0.1'
         mock_get_ip.assert_called_once_with('domain.local')
 
+    @patch('federation.utils.network.socket.gethostbyname', autospec=True, return_value='127.0.0.1')
+    def test_uses_cache(self, mock_get_ip):
+        assert fetch_host_ip('domain.local') == '127.0.0.1'
+        assert fetch_host_ip('domain.local') == '127.0.0.1'
+        mock_get_ip.assert_called_once_with('domain.local')
+        assert dns_cache.stats()['hits'] == 1
+        assert dns_cache.stats()['misses'] == 1
+
+    @patch('federation.utils.network.socket.gethostbyname', autospec=True, side_effect=socket.gaierror)
+    def test_negative_cache(self, mock_get_ip):
+        assert fetch_host_ip('domain.local') == ''
+        assert fetch_host_ip('domain.local') == ''
+        mock_get_ip.assert_called_once_with('domain.local')
+        assert dns_cache.stats()['negative_hits'] == 1
+
+    @patch('federation.utils.network.socket.gethostbyname', autospec=True, return_value='127.0.0.1')
+    def test_invalidate(self, mock_get_ip):
+        fetch_host_ip('domain.local')
+        dns_cache.invalidate('domain.local')
+        fetch_host_ip('domain.local')
+        assert mock_get_ip.call_count == 2
+
+
+class TestInstallDnsCache:
+    def setup_method(self):
+        dns_cache.invalidate()
+
+    def test_mounts_adapter(self):
+        session = requests.Session()
+        install_dns_cache(session)
+        assert isinstance(session.get_adapter("https://example.com"), CachedDNSAdapter)
+        assert isinstance(session.get_adapter("http://example.com"), CachedDNSAdapter)
+
+    @patch('federation.utils.network.socket.gethostbyname', autospec=True, return_value='127.0.0.1')
+    @patch('urllib3.connection.connection.create_connection')
+    def test_connects_to_cached_address(self, mock_create_connection, mock_get_ip):
+        conn = CachedDNSHTTPSConnection('domain.local', 443)
+        conn._new_conn()
+        assert mock_create_connection.call_args[0][0] == ('127.0.0.1', 443)
+        assert conn.host == 'domain.local'
+
 
 class TestSendDocument:
     call_args = {"timeout": 10, "headers": {'user-agent': USER_AGENT}}
@@ -0,0 +1,61 @@
+from unittest.mock import patch
+
+import pytest
+from django.conf import settings
+from django.test import override_settings
+
+from federation.utils.policy import DomainPolicy, get_domain, get_domain_policy, is_domain_allowed, set_domain_policy
+
+
+@pytest.mark.parametrize("value,domain", (
+    ("https://Example.com:8000/u/bob#main-key", "example.com"),
+    ("bob@example.com", "example.com"),
+    ("example.com.", "example.com"),
+    ("EXAMPLE.com/foo", "example.com"),
+    ("", None),
+    (None, None),
+))
+def test_get_domain(value, domain):
+    assert get_domain(value) == domain
+
+
+class TestDomainPolicy:
+    def test_blocklist_matches_subdomains(self):
+        policy = DomainPolicy(blocklist=["example.com", "https://spam.example.net/"])
+        assert not policy.is_allowed("https://example.com/u/bob")
+        assert not policy.is_allowed("https://a.b.example.com/u/bob")
+        assert not policy.is_allowed("bob@spam.example.net")
+        assert policy.is_allowed("https://example.net/u/bob")
+        assert policy.is_allowed("https://notexample.com/u/bob")
+
+    def test_allowlist(self):
+        policy = DomainPolicy(blocklist=["spam.example.com"], allowlist=["example.com"])
+        assert policy.is_allowed("https://example.com/u/bob")
+        assert policy.is_allowed("https://social.example.com/u/bob")
+        assert not policy.is_allowed("https://spam.example.com/u/bob")
+        assert not policy.is_allowed("https://example.net/u/bob")
+
+    def test_values_without_domain_are_allowed(self):
+        assert DomainPolicy(allowlist=["example.com"]).is_allowed("")
+
+
+@patch("federation.utils.policy._policy", None)
+@patch("federation.utils.policy._policy_settings", None)
+class TestGetDomainPolicy:
+    def test_built_from_settings(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "domain_blocklist": ["example.com"]}):
+            policy = get_domain_policy()
+            assert policy.blocklist == {"example.com"}
+            assert policy.allowlist is None
+            assert get_domain_policy() is policy
+            assert not is_domain_allowed("https://example.com/u/bob")
+        with override_settings(FEDERATION={**settings.FEDERATION, "domain_blocklist": ["example.net"]}):
+            assert is_domain_allowed("https://example.com/u/bob")
+            assert not is_domain_allowed("https://example.net/u/bob")
+
+    def test_set_domain_policy(self):
+        policy = set_domain_policy(blocklist=["example.net"])
+        with override_settings(FEDERATION={**settings.FEDERATION, "domain_blocklist": ["example.com"]}):
+            assert get_domain_policy() is policy
+        assert not is_domain_allowed("https://example.net/u/bob")
+        assert is_domain_allowed("https://example.com/u/bob")
@@ -0,0 +1,141 @@
+from email.utils import formatdate
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+from django.conf import settings
+from django.test import override_settings
+
+from federation.protocols.activitypub.signing import get_http_authentication, verify_request_signature
+from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.types import RequestType
+from federation.utils import queue as queue_module
+from federation.utils.queue import (
+    REDIS_PUT_SCRIPT, MemoryQueue, QueuedRequest, RedisQueue, SQLiteQueue, deserialize_request, get_inbound_queue,
+    serialize_request)
+from federation.utils.request import ParsedRequest
+
+
+def get_item(body=b'{"foo": "bar"}'):
+    return QueuedRequest(
+        request=RequestType(body=body, headers={"Signature": "foo"}, method="POST", url="https://example.com/inbox"),
+        recipient="https://example.com/u/bob",
+    )
+
+
+class TestSerializeRequest:
+    @pytest.mark.parametrize("body", (b'{"foo": "bar"}', b"\xff\x00", '<foo>bar</foo>'))
+    def test_roundtrip(self, body):
+        item = get_item(body)
+        assert deserialize_request(serialize_request(item)) == item
+
+    def test_parsed_request(self):
+        item = get_item()
+        parsed = QueuedRequest(request=ParsedRequest(item.request), recipient=item.recipient,
+                               received_at=item.received_at)
+        assert deserialize_request(serialize_request(parsed)) == item
+
+    def test_signed_request(self):
+        key = get_dummy_private_key()
+        request = requests.Request("POST", "https://example.com/inbox", data=b"{}", headers={
+            "Date": formatdate(usegmt=True), "User-Agent": "foobar", "Host": "example.com",
+        }).prepare()
+        request = get_http_authentication(key, "https://example.com/u/bob#main-key")(request)
+        item = QueuedRequest(request=RequestType(
+            body=request.body, headers=request.headers, method="POST", url=request.url,
+        ))
+        queued = deserialize_request(serialize_request(item)).request
+        assert queued.headers["date"] == queued.headers["Date"]
+        verify_request_signature(queued, key=key.publickey().export_key().decode())
+
+
+class TestMemoryQueue:
+    def test_fifo(self):
+        queue = MemoryQueue()
+        first, second = get_item(b"1"), get_item(b"2")
+        assert queue.put(first) and queue.put(second)
+        assert len(queue) == 2
+        assert queue.get() is first
+        assert queue.get() is second
+        assert queue.get() is None
+
+    def test_maxsize(self):
+        queue = MemoryQueue(maxsize=1)
+        assert queue.put(get_item())
+        assert not queue.put(get_item())
+
+    def test_get_timeout(self):
+        assert MemoryQueue().get(timeout=0.01) is None
+
+
+class TestSQLiteQueue:
+    def test_fifo(self, tmp_path):
+        queue = SQLiteQueue(str(tmp_path / "queue.sqlite"))
+        first, second = get_item(b"1"), get_item(b"2")
+        assert queue.put(first) and queue.put(second)
+        assert len(queue) == 2
+        # shared by the queues using the same database
+        assert SQLiteQueue(str(tmp_path / "queue.sqlite")).get() == first
+        assert queue.get() == second
+        assert queue.get(timeout=0.01) is None
+        assert len(queue) == 0
+
+    def test_maxsize(self, tmp_path):
+        queue = SQLiteQueue(str(tmp_path / "queue.sqlite"), maxsize=1)
+        assert queue.put(get_item())
+        assert not queue.put(get_item())
+
+
+class TestRedisQueue:
+    def test_put_get(self):
+        redis = Mock(llen=Mock(return_value=0))
+        queue = RedisQueue(redis, key="queue")
+        item = get_item()
+        assert queue.put(item)
+        data = redis.lpush.call_args[0][1]
+        redis.lpush.assert_called_once_with("queue", data)
+        redis.rpop.return_value = data
+        assert queue.get() == item
+        redis.brpop.return_value = ("queue", data)
+        assert queue.get(timeout=5) == item
+        redis.brpop.assert_called_once_with("queue", timeout=5)
+
+    def test_empty(self):
+        redis = Mock(rpop=Mock(return_value=None), brpop=Mock(return_value=None))
+        queue = RedisQueue(redis)
+        assert queue.get() is None
+        assert queue.get(timeout=0.5) is None
+        # at least one second, 0 blocks forever
+        assert redis.brpop.call_args[1]["timeout"] == 1
+
+    def test_maxsize(self):
+        redis = Mock(eval=Mock(return_value=0))
+        assert not RedisQueue(redis, key="queue", maxsize=1).put(get_item())
+        assert not redis.lpush.called
+        assert not redis.llen.called
+        redis.eval.return_value = 1
+        item = get_item()
+        assert RedisQueue(redis, key="queue", maxsize=1).put(item)
+        # the length check and the push are done by one script
+        redis.eval.assert_called_with(REDIS_PUT_SCRIPT, 1, "queue", redis.eval.call_args[0][3], 1)
+        assert deserialize_request(redis.eval.call_args[0][3]) == item
+
+
+class TestGetInboundQueue:
+    @pytest.fixture(autouse=True)
+    def reset_queue(self):
+        with patch.object(queue_module, "_queue", None):
+            yield
+
+    def test_sqlite(self, tmp_path):
+        path = str(tmp_path / "queue.sqlite")
+        with override_settings(FEDERATION={**settings.FEDERATION, "inbound_queue_backend": "sqlite",
+                                           "inbound_queue_path": path}):
+            queue = get_inbound_queue()
+        assert isinstance(queue, SQLiteQueue)
+        assert queue.path == path
+
+    def test_sqlite_requires_path(self):
+        with override_settings(FEDERATION={**settings.FEDERATION, "inbound_queue_backend": "sqlite"}):
+            with pytest.raises(ValueError):
+                get_inbound_queue()
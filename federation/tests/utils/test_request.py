@@ -0,0 +1,65 @@
+import json
+from unittest.mock import patch
+
+from lxml import etree
+
+from federation import identify_protocol_by_request
+from federation.tests.fixtures.payloads import DIASPORA_PUBLIC_PAYLOAD
+from federation.types import RequestType
+from federation.utils.request import ParsedRequest, parse_request
+
+
+class TestParsedRequest:
+    def test_json_body(self):
+        parsed = ParsedRequest(RequestType(body=b'{"foo": "bar"}'))
+        assert parsed.json == {"foo": "bar"}
+        assert parsed.xml is None
+
+    def test_xml_body(self):
+        parsed = ParsedRequest(RequestType(body="<foo>bar</foo>"))
+        assert parsed.json is None
+        assert parsed.xml.tag == "foo"
+
+    def test_url_encoded_xml_body(self):
+        parsed = ParsedRequest(RequestType(body="%3Cfoo%3Ebar%3C/foo%3E"))
+        assert parsed.xml.text == "bar"
+
+    def test_invalid_body(self):
+        parsed = ParsedRequest(RequestType(body="foobar"))
+        assert parsed.json is None
+        assert parsed.xml is None
+        assert isinstance(parsed.json_error, ValueError)
+        assert isinstance(parsed.xml_error, etree.XMLSyntaxError)
+
+    def test_body_is_parsed_once(self):
+        parsed = ParsedRequest(RequestType(body='{"foo": "bar"}'))
+        with patch("federation.utils.request.json.loads", wraps=json.loads) as mock_loads:
+            assert parsed.json is parsed.json
+            assert parsed.xml is None
+        assert mock_loads.call_count == 1
+
+    def test_xml_content_type_skips_json(self):
+        parsed = ParsedRequest(RequestType(body="<foo>bar</foo>", headers={
+            "Content-Type": "application/magic-envelope+xml; charset=utf-8"}))
+        with patch("federation.utils.request.json.loads") as mock_loads:
+            assert parsed.json is None
+        assert not mock_loads.called
+        assert parsed.xml.tag == "foo"
+
+    def test_request_attributes(self):
+        request = RequestType(body="foo", headers={"Content-Type": "application/json"}, method="POST")
+        parsed = parse_request(request)
+        assert parsed.method == "POST"
+        assert parsed.content_type == "application/json"
+        assert parse_request(parsed) is parsed
+
+
+def test_diaspora_payload_is_parsed_once():
+    with patch("federation.utils.request.etree.fromstring", wraps=etree.fromstring) as mock_fromstring, \
+            patch("federation.utils.request.json.loads", wraps=json.loads) as mock_loads:
+        request = parse_request(RequestType(body=DIASPORA_PUBLIC_PAYLOAD))
+        protocol = identify_protocol_by_request(request)
+        assert protocol.PROTOCOL_NAME == "diaspora"
+        protocol.Protocol().store_magic_envelope_doc(request)
+    assert mock_fromstring.call_count == 1
+    assert mock_loads.call_count == 1
@@ -0,0 +1,50 @@
+from unittest.mock import patch
+
+# noinspection PyPackageRequirements
+from Crypto.Hash import SHA256
+# noinspection PyPackageRequirements
+from Crypto.Signature import pkcs1_15
+
+from federation.tests.fixtures.keys import get_dummy_private_key
+from federation.utils.verification import VerificationJob, VerificationService, verify_job
+
+
+def get_job(message=b"foobar", signed=b"foobar"):
+    key = get_dummy_private_key()
+    signature = pkcs1_15.new(key).sign(SHA256.new(signed))
+    return VerificationJob.from_message(key.publickey().export_key(), message, signature)
+
+
+class TestVerifyJob:
+    def test_valid_signature(self):
+        assert verify_job(get_job()) is True
+
+    def test_invalid_signature(self):
+        assert verify_job(get_job(message=b"barfoo")) is False
+
+    def test_invalid_key(self):
+        job = get_job()
+        assert verify_job(VerificationJob("foobar", job.digest, job.signature)) is False
+
+
+class TestVerificationService:
+    def test_verify_in_process(self):
+        service = VerificationService(max_workers=0)
+        with patch("federation.utils.verification.ProcessPoolExecutor") as mock_executor:
+            assert service.verify([get_job(), get_job(message=b"barfoo")]) == [True, False]
+        assert not mock_executor.called
+
+    def test_verify_on_process_pool(self):
+        service = VerificationService(max_workers=2)
+        try:
+            assert service.verify([get_job(), get_job(message=b"barfoo"), get_job()]) == [True, False, True]
+        finally:
+            service.shutdown()
+
+    def test_small_batch_is_verified_in_process(self):
+        service = VerificationService(max_workers=2)
+        assert service.verify([get_job()]) == [True]
+        assert service._executor is None
+
+    def test_empty_batch(self):
+        assert VerificationService().verify([]) == []
@@ -2,8 +2,7 @@ from enum import Enum
 from typing import Optional, Dict, Union
 
 import attr
-# noinspection PyPackageRequirements
-from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
 # noinspection PyPackageRequirements
 from Crypto.PublicKey.RSA import RsaKey
 
@@ -21,6 +20,28 @@ class RequestType:
     url: str = attr.ib(default=None)
 
 
+class DuplicateResult(tuple):
+    """
+    ``handle_receive`` result for a copy of an already processed activity: the sender id and protocol
+    name of the first copy, and no entities. Callers can treat it as a success.
+    """
+    def __new__(cls, sender: str, protocol_name: str):
+        return super().__new__(cls, (sender, protocol_name, []))
+
+
+@attr.s(frozen=True)
+class PublicKeyType:
+    """
+    A remote public key, resolved from a signature keyId.
+
+    ``pem`` is the PEM encoded RSA key, or the ``publicKeyMultibase`` value of an Ed25519 Multikey.
+    """
+    id: str = attr.ib()
+    owner: str = attr.ib()
+    pem: str = attr.ib()
+    key: Union[RsaKey, Ed25519PublicKey] = attr.ib()
+
+
 class ReceiverVariant(Enum):
     # Indicates this receiver is a single actor
     ACTOR = "actor"
@@ -52,8 +73,13 @@ class UserType:
     # TODO needed?
     variant: Optional[UserVariant] = attr.ib(default=None)
 
+    # Optional, adds Ed25519 proofs to the outbound ActivityPub payloads
+    ed25519_private_key: Optional[Union[Ed25519PrivateKey, str]] = attr.ib(default=None)
+
     @property
     def rsa_private_key(self) -> RsaKey:
         if isinstance(self.private_key, str):
-            return RSA.importKey(self.private_key)
+            # The class is frozen, parsed keys are cached by digest of the PEM encoded key
+            from federation.utils.keys import import_rsa_key  # Circulars
+            return import_rsa_key(self.private_key)
         return self.private_key
@@ -6,7 +6,10 @@ from urllib.parse import urlparse
 
 from federation.entities.base import Profile
 from federation.protocols.activitypub.signing import get_http_authentication
+from federation.types import PublicKeyType
+from federation.utils.keys import allow_key_refetch, gone_keys, import_public_key, invalidate_public_key, key_cache
 from federation.utils.network import fetch_document, try_retrieve_webfinger_document
+from federation.utils.policy import is_domain_allowed
 from federation.utils.text import decode_if_bytes, validate_handle
 
 logger = logging.getLogger('federation')
@@ -20,6 +23,8 @@ except Exception as exc:
 
 type_path = re.compile(r'^application/(activity|ld)\+json')
 
+AS2_HEADERS = {'accept': 'application/activity+json, application/ld+json; profile="https://www.w3.org/ns/activitystreams"'}
+
 
 def get_profile_id_from_webfinger(handle: str) -> Optional[str]:
     """
@@ -56,6 +61,126 @@ def get_profile_finger_from_webfinger(fid: str) -> Optional[str]:
     return finger if validate_handle(finger) else None
 
 
+def get_federation_user_auth():
+    """
+    HTTP signature authentication of the federation user for GET requests, if configured.
+    """
+    if not federation_user:
+        return None
+    return get_http_authentication(federation_user.rsa_private_key,
+                                   f'{federation_user.id}#main-key',
+                                   digest=False)
+
+
+def _get_key_value(key: dict) -> Optional[str]:
+    if key.get('publicKeyPem'):
+        return key['publicKeyPem']
+    if key.get('type') == 'Multikey':
+        return key.get('publicKeyMultibase')
+
+
+def extract_public_key(document: dict, key_id: str) -> Optional[tuple]:
+    """
+    Find the public key matching key_id in an actor or a standalone key document.
+
+    RSA keys are found in ``publicKey``, Ed25519 Multikeys in ``assertionMethod``.
+    Returns a tuple of the key owner and the PEM encoded RSA key or the multibase encoded Multikey.
+    """
+    if not isinstance(document, dict):
+        return None
+    if _get_key_value(document):
+        # standalone key document
+        keys, owner = [document], document.get('owner') or document.get('controller')
+    else:
+        keys = []
+        for name in ('publicKey', 'assertionMethod'):
+            value = document.get(name) or []
+            keys.extend(value if isinstance(value, list) else [value])
+        owner = document.get('id')
+    keys = [key for key in keys if isinstance(key, dict) and _get_key_value(key)]
+    key = next((key for key in keys if key.get('id') == key_id), None)
+    pem_keys = [key for key in keys if key.get('publicKeyPem')]
+    if not key and len(pem_keys) == 1 and key_id == owner:
+        # a keyId without the #main-key fragment
+        key = pem_keys[0]
+    if not key or not isinstance(owner, str):
+        return None
+    owner = key.get('owner') or key.get('controller') or owner
+    # check against payload forgery, the key must be served by its owner host
+    if not (urlparse(owner).netloc == urlparse(key_id).netloc == urlparse(document.get('id') or key_id).netloc):
+        logger.warning('extract_public_key - key owner %s does not match %s, discarding', owner, key_id)
+        return None
+    return owner, _get_key_value(key)
+
+
+def retrieve_public_key(key_id: str, cache: bool = True) -> Optional[PublicKeyType]:
+    """
+    Retrieve the public key identified by a signature keyId.
+
+    The keyId document is read as plain JSON, the full profile parsing is skipped.
+    Keys are kept in ``key_cache`` by keyId, pass ``cache=False`` to fetch the key again.
+    keyIds answering 404 or 410, ie of deleted actors, are kept in ``gone_keys`` and not
+    fetched again for ``public_key_gone_ttl`` seconds.
+    """
+    if cache:
+        public_key = key_cache.get(key_id)
+        if public_key:
+            return public_key
+        if key_id in gone_keys:
+            logger.debug("retrieve_public_key - %s is gone, skipping", key_id)
+            return None
+    document, status_code, ex = fetch_document(key_id,
+                                               extra_headers=AS2_HEADERS,
+                                               cache=cache,
+                                               auth=get_federation_user_auth())
+    if not document:
+        if status_code in (404, 410):
+            gone_keys.set(key_id, status_code)
+        logger.warning("retrieve_public_key - failed to fetch %s: %s", key_id, ex or status_code)
+        return None
+    try:
+        found = extract_public_key(json.loads(decode_if_bytes(document)), key_id)
+    except json.decoder.JSONDecodeError:
+        found = None
+    if not found:
+        logger.warning("retrieve_public_key - no public key found for %s", key_id)
+        return None
+    owner, pem = found
+    try:
+        key = import_public_key(pem)
+    except (ValueError, IndexError, TypeError) as exc:
+        logger.warning("retrieve_public_key - invalid public key for %s: %s", key_id, exc)
+        return None
+    public_key = PublicKeyType(id=key_id, owner=owner, pem=pem, key=key)
+    key_cache.set(key_id, public_key)
+    gone_keys.pop(key_id)
+    return public_key
+
+
+def refetch_public_key(key_id: str, stale_key: Optional[str] = None) -> Optional[PublicKeyType]:
+    """
+    Fetch a public key again, bypassing the caches, after a failed signature verification.
+
+    Remote actors may have rotated their key. To avoid turning invalid payloads into
+    fetches, a keyId is refetched at most once per ``public_key_refetch_cooldown`` period.
+    A cached key differing from the stale one (ie already refetched for another request)
+    is returned without fetching, also during the cooldown.
+    Returns the refetched key if it differs from the stale one.
+    """
+    cached_key = key_cache.get(key_id)
+    if cached_key and not (stale_key and cached_key.pem.strip() == stale_key.strip()):
+        return cached_key
+    if not allow_key_refetch(key_id):
+        logger.debug("refetch_public_key - %s was refetched recently, skipping", key_id)
+        return None
+    invalidate_public_key(key_id=key_id, key=stale_key)
+    public_key = retrieve_public_key(key_id, cache=False)
+    if not public_key or (stale_key and public_key.pem.strip() == stale_key.strip()):
+        return None
+    logger.info("refetch_public_key - %s has a new key", key_id)
+    return public_key
+
+
 def retrieve_and_parse_content(**kwargs) -> Optional[Any]:
     return retrieve_and_parse_document(kwargs.get("id"), cache=kwargs.get('cache',True))
 
@@ -63,16 +188,17 @@ def retrieve_and_parse_content(**kwargs) -> Optional[Any]:
 def retrieve_and_parse_document(fid: str, cache: bool=True) -> Optional[Any]:
     """
     Retrieve remote document by ID and return the entity.
+
+    Documents of domains blocked by the domain policy are not retrieved.
     """
+    if not is_domain_allowed(fid):
+        logger.debug("retrieve_and_parse_document - domain of %s is blocked", fid)
+        return None
     from federation.entities.activitypub.models import element_to_objects # Circulars
-    extra_headers={'accept': 'application/activity+json, application/ld+json; profile="https://www.w3.org/ns/activitystreams"'}
-    auth=get_http_authentication(federation_user.rsa_private_key,
-                                 f'{federation_user.id}#main-key',
-                                 digest=False) if federation_user else None
     document, status_code, ex = fetch_document(fid,
-                                               extra_headers=extra_headers,
+                                               extra_headers=AS2_HEADERS,
                                                cache=cache,
-                                               auth=auth)
+                                               auth=get_federation_user_auth())
     if document:
         try:
             document = json.loads(decode_if_bytes(document))
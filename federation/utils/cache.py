@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe, size bounded LRU mapping with optional per entry expiration.
+
+    Used for the various process-local caches (DNS, keys, JSON-LD documents...).
+    Hit, miss and eviction counters are kept and exposed through ``stats``.
+
+    :arg maxsize: Maximum number of entries kept. The least recently used entry is evicted first.
+    :arg ttl: Default time to live in seconds. ``None`` means entries never expire.
+    :arg timer: Monotonic clock function (overridable for tests).
+    """
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.timer():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = MISSING) -> None:
+        ttl = self.ttl if ttl is MISSING else ttl
+        expires = self.timer() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def add(self, key: Hashable, value: Any, ttl: Optional[float] = MISSING) -> bool:
+        """
+        Set the value unless the key is already present. Returns whether the value was set.
+        """
+        with self._lock:
+            if key in self:
+                return False
+            self.set(key, value, ttl=ttl)
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._data.pop(key, MISSING)
+        return default if value is MISSING else value[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and (item[1] is None or item[1] > self.timer())
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,87 @@
+import json
+import logging
+from datetime import timedelta
+from hashlib import sha256
+from typing import Optional, Tuple
+
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_setting
+from federation.utils.request import ParsedRequest
+from federation.utils.text import encode_if_text
+
+logger = logging.getLogger("federation")
+
+REDIS_KEY_PREFIX = "federation:inbound_seen:"
+
+# Sender id and protocol name of the processed activities, by dedupe key
+seen_activities = TTLCache(maxsize=get_setting("inbound_dedupe_cache_size", 4096))
+
+
+def get_dedupe_ttl() -> int:
+    """
+    Time in seconds processed activities are remembered, 0 disables the deduplication.
+    """
+    return get_setting("inbound_dedupe_ttl", int(timedelta(days=1).total_seconds()))
+
+
+def _get_redis():
+    try:
+        from federation.utils.django import get_redis  # Circulars
+        return get_redis()
+    except Exception:
+        return None
+
+
+def get_dedupe_key(request: ParsedRequest) -> Optional[str]:
+    """
+    Get the key shared by the copies of an inbound activity, received in several inboxes, relayed or
+    retried: a digest of the activity ``id`` and of the request body.
+
+    Returns None for payloads without an id (ie Diaspora payloads), which are not deduplicated.
+    """
+    if not get_dedupe_ttl():
+        return None
+    document = request.json
+    if not isinstance(document, dict) or not isinstance(document.get("id"), str):
+        return None
+    body_digest = sha256(encode_if_text(request.body)).hexdigest()
+    return sha256(f"{document['id']}\n{body_digest}".encode("utf-8")).hexdigest()
+
+
+def get_seen_activity(key: str) -> Optional[Tuple[str, str]]:
+    """
+    Get the sender id and protocol name of an already processed activity, from the process-local LRU
+    then from Redis if configured.
+    """
+    seen = seen_activities.get(key)
+    if seen:
+        return seen
+    redis = _get_redis()
+    if not redis:
+        return None
+    try:
+        value = redis.get(REDIS_KEY_PREFIX + key)
+    except Exception as ex:
+        logger.warning("get_seen_activity - redis lookup failed: %s", ex)
+        return None
+    if not value:
+        return None
+    seen = tuple(json.loads(value))
+    seen_activities.set(key, seen, ttl=get_dedupe_ttl())
+    return seen
+
+
+def remember_activity(key: str, sender: str, protocol_name: str) -> None:
+    """
+    Remember a successfully processed activity. Only call it once the request was verified: remembering
+    a forged or unverified copy would prevent the processing of the genuine one.
+    """
+    ttl = get_dedupe_ttl()
+    seen_activities.set(key, (sender, protocol_name), ttl=ttl)
+    redis = _get_redis()
+    if not redis:
+        return
+    try:
+        redis.set(REDIS_KEY_PREFIX + key, json.dumps([sender, protocol_name]), ex=ttl)
+    except Exception as ex:
+        logger.warning("remember_activity - redis update failed: %s", ex)
@@ -7,6 +7,10 @@ from django.core.exceptions import ImproperlyConfigured
 from federation.types import UserType
 
 
+# Redis clients by connection settings
+_redis_clients = {}
+
+
 def get_configuration():
     """
     Combine defaults with the Django configuration.
@@ -36,6 +40,18 @@ def get_configuration():
     return configuration
 
 
+def get_setting(name, default=None):
+    """
+    Get a FEDERATION setting when it is used, so that changes to the Django settings apply.
+
+    Returns the default if Django is not configured.
+    """
+    try:
+        return get_configuration().get(name, default)
+    except ImproperlyConfigured:
+        return default
+
+
 def get_function_from_config(item):
     """
     Import the function to get profile by handle.
@@ -64,11 +80,17 @@ def get_federation_user():
 def get_redis():
     """
     Returns a connected redis object if available
+
+    The client, and its connection pool, is shared by the callers using the same settings.
     """
     config = get_configuration()
     if not config.get('redis'): return None
 
-    return redis.Redis(**config['redis'])
+    key = repr(sorted(config['redis'].items()))
+    client = _redis_clients.get(key)
+    if client is None:
+        client = _redis_clients.setdefault(key, redis.Redis(**config['redis']))
+    return client
 
 def get_requests_cache_backend(namespace):
     """
@@ -0,0 +1,176 @@
+import logging
+from datetime import timedelta
+from hashlib import sha256
+from typing import Optional, Union
+
+from cryptography.exceptions import UnsupportedAlgorithm
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, PublicFormat, load_pem_private_key, load_pem_public_key,
+)
+# noinspection PyPackageRequirements
+from Crypto.PublicKey import RSA
+# noinspection PyPackageRequirements
+from Crypto.PublicKey.RSA import RsaKey
+
+from federation.utils.cache import TTLCache
+from federation.utils.django import get_setting
+from federation.utils.text import encode_if_text
+
+logger = logging.getLogger("federation")
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+# Multicodec prefix of the Ed25519 public keys in Multikey documents
+MULTICODEC_ED25519_PUB = b"\xed\x01"
+ED25519_KEY_FRAGMENT = "ed25519-key"
+
+# Parsed RSA keys by digest of their encoded form, shared by the signature verifiers
+rsa_key_cache = TTLCache(maxsize=get_setting("rsa_key_cache_size", 1024))
+
+# Remote public keys (PublicKeyType) by signature keyId
+key_cache = TTLCache(
+    maxsize=get_setting("public_key_cache_size", 1024),
+    ttl=get_setting("public_key_cache_ttl", int(timedelta(hours=1).total_seconds())),
+)
+
+# keyIds whose document is gone (404 or 410), ie of deleted actors, by keyId
+gone_keys = TTLCache(
+    maxsize=get_setting("public_key_cache_size", 1024),
+    ttl=get_setting("public_key_gone_ttl", int(timedelta(days=1).total_seconds())),
+)
+
+# keyIds refetched recently after a verification failure
+refetch_cooldowns = TTLCache(
+    maxsize=get_setting("public_key_cache_size", 1024),
+    ttl=get_setting("public_key_refetch_cooldown", int(timedelta(minutes=10).total_seconds())),
+)
+
+
+def get_key_fingerprint(key: Union[str, bytes]) -> str:
+    return sha256(encode_if_text(key).strip()).hexdigest()
+
+
+def import_rsa_key(key: Union[str, bytes, RsaKey]) -> RsaKey:
+    """
+    Parse a PEM encoded RSA key, reusing the key object parsed previously for the same key.
+
+    Raises the same exceptions as ``RSA.import_key`` for invalid keys.
+    """
+    if isinstance(key, RsaKey):
+        return key
+    if not isinstance(key, (str, bytes)):
+        return RSA.import_key(key)
+    fingerprint = get_key_fingerprint(key)
+    parsed = rsa_key_cache.get(fingerprint)
+    if parsed is None:
+        parsed = RSA.import_key(key)
+        rsa_key_cache.set(fingerprint, parsed)
+    return parsed
+
+
+def invalidate_public_key(key_id: Optional[str] = None, key: Optional[Union[str, bytes]] = None) -> None:
+    """
+    Forget a remote public key, ie when the remote actor rotated it.
+
+    :arg key_id: The signature keyId of the key.
+    :arg key: The PEM encoded key.
+    """
+    public_key = key_cache.pop(key_id) if key_id else None
+    if key_id:
+        gone_keys.pop(key_id)
+    for pem in (key, getattr(public_key, "pem", None)):
+        if pem:
+            rsa_key_cache.pop(get_key_fingerprint(pem))
+    logger.debug("invalidate_public_key - %s", key_id or "key")
+
+
+def allow_key_refetch(key_id: str) -> bool:
+    """
+    Rate limit key refetches: a keyId can be refetched once per cooldown period.
+    """
+    return refetch_cooldowns.add(key_id, True)
+
+
+def base58_encode(data: bytes) -> str:
+    number = int.from_bytes(data, "big")
+    encoded = ""
+    while number:
+        number, remainder = divmod(number, 58)
+        encoded = BASE58_ALPHABET[remainder] + encoded
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + encoded
+
+
+def base58_decode(text: str) -> bytes:
+    number = 0
+    for char in text:
+        index = BASE58_ALPHABET.find(char)
+        if index < 0:
+            raise ValueError(f"Invalid base58 character {char!r}")
+        number = number * 58 + index
+    return b"\0" * (len(text) - len(text.lstrip("1"))) + number.to_bytes((number.bit_length() + 7) // 8, "big")
+
+
+def encode_multikey(key: Union[Ed25519PrivateKey, Ed25519PublicKey]) -> str:
+    """
+    Encode an Ed25519 public key as a Multikey ``publicKeyMultibase`` value.
+    """
+    if isinstance(key, Ed25519PrivateKey):
+        key = key.public_key()
+    return "z" + base58_encode(MULTICODEC_ED25519_PUB + key.public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+
+def decode_multikey(value: str) -> Ed25519PublicKey:
+    """
+    Parse the ``publicKeyMultibase`` value of an Ed25519 Multikey.
+
+    Raises ValueError for other encodings and key types.
+    """
+    if not isinstance(value, str) or not value.startswith("z"):
+        raise ValueError("Only base58btc encoded Multikeys are supported")
+    decoded = base58_decode(value[1:])
+    if not decoded.startswith(MULTICODEC_ED25519_PUB) or len(decoded) != 34:
+        raise ValueError("Not an Ed25519 Multikey")
+    return Ed25519PublicKey.from_public_bytes(decoded[2:])
+
+
+def get_multikey(controller: str, key: Union[Ed25519PrivateKey, Ed25519PublicKey]) -> dict:
+    """
+    Get the Multikey to add to the ``assertionMethod`` of an actor document, so that remote
+    servers can verify the Ed25519 proofs created for this actor.
+    """
+    return {
+        "id": f"{controller}#{ED25519_KEY_FRAGMENT}",
+        "type": "Multikey",
+        "controller": controller,
+        "publicKeyMultibase": encode_multikey(key),
+    }
+
+
+def import_ed25519_key(
+        key: Union[str, bytes, Ed25519PrivateKey, Ed25519PublicKey]) -> Union[Ed25519PrivateKey, Ed25519PublicKey]:
+    """
+    Parse a PEM encoded Ed25519 private or public key, or a Multikey encoded Ed25519 public key.
+
+    Raises ValueError for invalid keys and other key types.
+    """
+    if isinstance(key, (Ed25519PrivateKey, Ed25519PublicKey)):
+        return key
+    if isinstance(key, str) and key.startswith("z"):
+        return decode_multikey(key)
+    data = encode_if_text(key)
+    try:
+        parsed = load_pem_private_key(data, password=None) if b"PRIVATE KEY" in data else load_pem_public_key(data)
+    except UnsupportedAlgorithm as exc:
+        raise ValueError(str(exc))
+    if not isinstance(parsed, (Ed25519PrivateKey, Ed25519PublicKey)):
+        raise ValueError(f"Not an Ed25519 key: {type(parsed).__name__}")
+    return parsed
+
+
+def import_public_key(key: Union[str, bytes, RsaKey, Ed25519PublicKey]) -> Union[RsaKey, Ed25519PublicKey]:
+    """
+    Parse a remote public key: a PEM encoded RSA key or an Ed25519 Multikey.
+    """
+    if isinstance(key, Ed25519PublicKey) or isinstance(key, str) and key.startswith("z"):
+        return import_ed25519_key(key)
+    return import_rsa_key(key)
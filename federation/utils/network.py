@@ -8,13 +8,19 @@ from urllib.parse import quote, urlparse
 from uuid import uuid4
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests_cache import CachedSession, DO_NOT_CACHE
 from requests.exceptions import RequestException, HTTPError, SSLError
 from requests.exceptions import ConnectionError
 from requests.structures import CaseInsensitiveDict
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 from federation import __version__
+from federation.exceptions import BlockedDomainError
+from federation.utils.cache import MISSING, TTLCache
 from federation.utils.django import disable_outbound_federation, get_requests_cache_backend
+from federation.utils.policy import is_domain_allowed
 
 logger = logging.getLogger("federation")
 
@@ -49,11 +55,15 @@ def fetch_document(url=None, host=None, path="/", timeout=10, raise_ssl_errors=T
     :arg raise_ssl_errors: Pass False if you want to try HTTP even for sites with SSL errors (default True)
     :arg extra_headers: Optional extra headers dictionary to add to requests
     :arg kwargs holds extra args passed to requests.get
-    :returns: Tuple of document (str or None), status code (int or None) and error (an exception class instance or None)
+    :returns: Tuple of document (str or None), status code (int or None) and error (an exception class instance or None).
+        URLs and hosts of domains blocked by the domain policy are not fetched, the error is a BlockedDomainError.
     :raises ValueError: If neither url nor host are given as parameters
     """
     if not url and not host:
         raise ValueError("Need url or host.")
+    if not is_domain_allowed(url or host):
+        logger.debug("fetch_document: domain of %s is blocked", url or host)
+        return None, None, BlockedDomainError(f"Domain of {url or host} is blocked")
 
     logger.debug("fetch_document: url=%s, host=%s, path=%s, timeout=%s, raise_ssl_errors=%s",
                  url, host, path, timeout, raise_ssl_errors)
@@ -104,16 +114,117 @@ def fetch_document(url=None, host=None, path="/", timeout=10, raise_ssl_errors=T
         return None, getattr(response, 'status_code', None), ex
 
 
-def fetch_host_ip(host: str) -> str:
+class DNSCache:
     """
-    Fetch ip by host
+    Process-local DNS resolution cache.
+
+    Successful lookups are kept for ``ttl`` seconds, failed lookups for ``negative_ttl`` seconds.
+    Resolution is IPv4 only, as done by ``socket.gethostbyname``.
     """
-    try:
-        ip = socket.gethostbyname(host)
-    except socket.gaierror:
-        return ''
+    def __init__(self, ttl: float = 300, negative_ttl: float = 60, maxsize: int = 4096):
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.negative_hits = 0
+
+    def resolve(self, host: str) -> str:
+        """
+        Return the ip for host or an empty string if it can't be resolved.
+        """
+        ip = self._cache.get(host, MISSING)
+        if ip is not MISSING:
+            if not ip:
+                self.negative_hits += 1
+            return ip
+        try:
+            ip = socket.gethostbyname(host)
+        except socket.gaierror:
+            self._cache.set(host, '', ttl=self.negative_ttl)
+            return ''
+        self._cache.set(host, ip)
+        return ip
+
+    def invalidate(self, host: str = None):
+        """
+        Remove host from the cache, or clear the whole cache if no host is given.
+        """
+        if host:
+            self._cache.pop(host)
+        else:
+            self._cache.clear()
+            self.negative_hits = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self._cache.stats(), negative_hits=self.negative_hits)
+
+
+dns_cache = DNSCache()
+
+
+class CachedDNSConnectionMixin:
+    """
+    Open the connection socket to the address found in ``dns_cache``.
+
+    Only the address used for the TCP connection is swapped, the Host header
+    and TLS server name still use the original host name.
+    """
+    def _new_conn(self):
+        host = self._dns_host
+        address = dns_cache.resolve(host.rstrip("."))
+        if not address:
+            # Let urllib3 do the lookup and raise its usual errors
+            return super()._new_conn()
+        self._dns_host = address
+        try:
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
 
-    return ip
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(HTTPAdapter):
+    """
+    Transport adapter resolving hosts through ``dns_cache``.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CachedDNSHTTPConnectionPool,
+            "https": CachedDNSHTTPSConnectionPool,
+        }
+
+
+def install_dns_cache(target_session: requests.Session = None) -> None:
+    """
+    Install ``dns_cache`` as the resolver for a session.
+
+    :arg target_session: Session to install the resolver on (defaults to the shared ``session``)
+    """
+    target_session = target_session or session
+    adapter = CachedDNSAdapter()
+    target_session.mount("http://", adapter)
+    target_session.mount("https://", adapter)
+
+
+def fetch_host_ip(host: str) -> str:
+    """
+    Fetch ip by host, using the process-local DNS cache.
+    """
+    return dns_cache.resolve(host)
 
 
 def fetch_file(url: str, timeout: int = 30, extra_headers: Dict = None) -> str:
@@ -0,0 +1,98 @@
+import logging
+import threading
+from typing import Iterable, Optional
+from urllib.parse import urlsplit
+
+from federation.utils.django import get_setting
+
+logger = logging.getLogger("federation")
+
+
+def get_domain(value: str) -> Optional[str]:
+    """
+    Get the lower case domain of an URL, a handle (user@domain.tld) or a domain.
+    """
+    if not isinstance(value, str) or not value:
+        return None
+    if "://" in value:
+        try:
+            domain = urlsplit(value).hostname
+        except ValueError:
+            return None
+    else:
+        domain = value.rsplit("@", 1)[-1].split("/", 1)[0].split(":", 1)[0].lower()
+    return domain.rstrip(".") if domain else None
+
+
+class DomainPolicy:
+    """
+    Domain blocklist and allowlist. A listed domain matches its subdomains too.
+
+    Lookups are done with one set membership test per label of the checked domain.
+
+    :arg blocklist: Domains to reject.
+    :arg allowlist: If given, only these domains are accepted, the blocklist still applies to their subdomains.
+    """
+    def __init__(self, blocklist: Iterable[str] = (), allowlist: Optional[Iterable[str]] = None):
+        self.blocklist = frozenset(filter(None, (get_domain(domain) for domain in blocklist)))
+        self.allowlist = frozenset(filter(None, (get_domain(domain) for domain in allowlist))) \
+            if allowlist is not None else None
+
+    @staticmethod
+    def matches(domain: str, domains: frozenset) -> bool:
+        labels = domain.split(".")
+        return any(".".join(labels[index:]) in domains for index in range(len(labels)))
+
+    def is_allowed(self, value: str) -> bool:
+        """
+        Check the domain of an URL, a handle or a domain. Values without a domain are allowed.
+        """
+        domain = get_domain(value)
+        if not domain:
+            return True
+        if self.blocklist and self.matches(domain, self.blocklist):
+            return False
+        return self.allowlist is None or self.matches(domain, self.allowlist)
+
+
+_policy = None
+# The settings the policy was built from, None once replaced with set_domain_policy
+_policy_settings = None
+_policy_lock = threading.Lock()
+
+
+def get_domain_policy() -> DomainPolicy:
+    """
+    Get the domain policy, built from the ``domain_blocklist`` and ``domain_allowlist`` settings
+    unless replaced with ``set_domain_policy``. The policy is built again when the settings change.
+    """
+    global _policy, _policy_settings
+    with _policy_lock:
+        if _policy is None or _policy_settings is not None:
+            settings = (get_setting("domain_blocklist"), get_setting("domain_allowlist"))
+            if _policy is None or any(value is not built for value, built in zip(settings, _policy_settings)):
+                _policy = DomainPolicy(settings[0] or (), settings[1])
+                _policy_settings = settings
+        return _policy
+
+
+def set_domain_policy(blocklist: Iterable[str] = (), allowlist: Optional[Iterable[str]] = None) -> DomainPolicy:
+    """
+    Replace the domain policy, ie when the client app loads its blocked domains from its database or
+    defederates from a domain.
+    """
+    global _policy, _policy_settings
+    policy = DomainPolicy(blocklist, allowlist)
+    with _policy_lock:
+        _policy = policy
+        _policy_settings = None
+    logger.info("set_domain_policy - %s blocked domains, %s allowed domains", len(policy.blocklist),
+                "all" if policy.allowlist is None else len(policy.allowlist))
+    return policy
+
+
+def is_domain_allowed(value: str) -> bool:
+    """
+    Check the domain of an URL, a handle or a domain against the domain policy.
+    """
+    return get_domain_policy().is_allowed(value)
@@ -0,0 +1,239 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from base64 import b64decode, b64encode
+from collections import deque
+from typing import Optional
+
+import attr
+from requests.structures import CaseInsensitiveDict
+
+from federation.types import RequestType
+from federation.utils.django import get_setting
+from federation.utils.request import ParsedRequest
+
+logger = logging.getLogger("federation")
+
+
+@attr.s
+class QueuedRequest:
+    """
+    An inbound request waiting to be processed by ``handle_receive``.
+
+    ``recipient`` is the id of the local user receiving a private payload, if any.
+    """
+    request: RequestType = attr.ib()
+    recipient: Optional[str] = attr.ib(default=None)
+    received_at: float = attr.ib(factory=time.time)
+
+
+def serialize_request(item: QueuedRequest) -> str:
+    request = item.request.request if isinstance(item.request, ParsedRequest) else item.request
+    body = request.body
+    return json.dumps({
+        "body": b64encode(body).decode("ascii") if isinstance(body, bytes) else body,
+        "binary": isinstance(body, bytes),
+        "headers": dict(request.headers or {}),
+        "method": request.method,
+        "url": request.url,
+        "recipient": item.recipient,
+        "received_at": item.received_at,
+    })
+
+
+def deserialize_request(data: str) -> QueuedRequest:
+    data = json.loads(data)
+    body = b64decode(data["body"]) if data["binary"] else data["body"]
+    # Header lookups are case-insensitive, like on the received request
+    headers = CaseInsensitiveDict(data["headers"])
+    return QueuedRequest(
+        request=RequestType(body=body, headers=headers, method=data["method"], url=data["url"]),
+        recipient=data["recipient"],
+        received_at=data["received_at"],
+    )
+
+
+class InboundQueue:
+    """
+    Queue of the inbound requests accepted by ``enqueue_receive``.
+    """
+    def put(self, item: QueuedRequest) -> bool:
+        """
+        Add a request to the queue. Returns False if the queue is full.
+        """
+        raise NotImplementedError
+
+    def get(self, timeout: float = 0) -> Optional[QueuedRequest]:
+        """
+        Take the oldest request from the queue, waiting up to ``timeout`` seconds for one.
+
+        The request is removed from the queue when taken, it is lost if its processing is interrupted.
+        """
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryQueue(InboundQueue):
+    """
+    Process-local queue, requests are lost when the process exits.
+    """
+    def __init__(self, maxsize: Optional[int] = None):
+        self.maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item: QueuedRequest) -> bool:
+        with self._condition:
+            if self.maxsize and len(self._items) >= self.maxsize:
+                return False
+            self._items.append(item)
+            self._condition.notify()
+        return True
+
+    def get(self, timeout: float = 0) -> Optional[QueuedRequest]:
+        with self._condition:
+            if not self._items and timeout:
+                self._condition.wait_for(lambda: self._items, timeout=timeout)
+            return self._items.popleft() if self._items else None
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class SQLiteQueue(InboundQueue):
+    """
+    Queue stored in a SQLite database, shared by the processes of a host.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, path: str, maxsize: Optional[int] = None):
+        self.path = path
+        self.maxsize = maxsize
+        connection = self._connect()
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS inbound_queue (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)")
+        finally:
+            connection.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def put(self, item: QueuedRequest) -> bool:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            if self.maxsize and connection.execute("SELECT COUNT(*) FROM inbound_queue").fetchone()[0] >= self.maxsize:
+                connection.execute("ROLLBACK")
+                return False
+            connection.execute("INSERT INTO inbound_queue (data) VALUES (?)", (serialize_request(item),))
+            connection.execute("COMMIT")
+            return True
+        finally:
+            connection.close()
+
+    def _pop(self) -> Optional[QueuedRequest]:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id, data FROM inbound_queue ORDER BY id LIMIT 1").fetchone()
+            if row:
+                connection.execute("DELETE FROM inbound_queue WHERE id = ?", (row[0],))
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+        return deserialize_request(row[1]) if row else None
+
+    def get(self, timeout: float = 0) -> Optional[QueuedRequest]:
+        deadline = time.monotonic() + timeout
+        while True:
+            item = self._pop()
+            if item or time.monotonic() >= deadline:
+                return item
+            time.sleep(min(self.poll_interval, max(deadline - time.monotonic(), 0)))
+
+    def __len__(self) -> int:
+        connection = self._connect()
+        try:
+            return connection.execute("SELECT COUNT(*) FROM inbound_queue").fetchone()[0]
+        finally:
+            connection.close()
+
+
+# Checks the length and pushes in one step, concurrent puts can't overflow the queue
+REDIS_PUT_SCRIPT = """
+if redis.call("LLEN", KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("LPUSH", KEYS[1], ARGV[1])
+return 1
+"""
+
+
+class RedisQueue(InboundQueue):
+    """
+    Queue stored in a Redis list, shared by the hosts using the same Redis server.
+    """
+    def __init__(self, redis, key: str = "federation:inbound_queue", maxsize: Optional[int] = None):
+        self.redis = redis
+        self.key = key
+        self.maxsize = maxsize
+
+    def put(self, item: QueuedRequest) -> bool:
+        data = serialize_request(item)
+        if self.maxsize:
+            return bool(self.redis.eval(REDIS_PUT_SCRIPT, 1, self.key, data, self.maxsize))
+        self.redis.lpush(self.key, data)
+        return True
+
+    def get(self, timeout: float = 0) -> Optional[QueuedRequest]:
+        if timeout:
+            # BRPOP waits forever with a 0 timeout
+            result = self.redis.brpop(self.key, timeout=max(timeout, 1))
+            data = result[1] if result else None
+        else:
+            data = self.redis.rpop(self.key)
+        return deserialize_request(data) if data else None
+
+    def __len__(self) -> int:
+        return self.redis.llen(self.key)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_inbound_queue() -> InboundQueue:
+    """
+    Get the inbound queue configured by the ``inbound_queue_backend`` setting: ``memory``, ``sqlite``
+    (``inbound_queue_path`` setting, required) or ``redis``. Defaults to Redis if configured, else memory.
+    """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            maxsize = get_setting("inbound_queue_size")
+            redis = None
+            backend = get_setting("inbound_queue_backend")
+            if backend in (None, "redis"):
+                try:
+                    from federation.utils.django import get_redis  # Circulars
+                    redis = get_redis()
+                except Exception:
+                    pass
+            if redis:
+                _queue = RedisQueue(redis, maxsize=maxsize)
+            elif backend == "sqlite":
+                path = get_setting("inbound_queue_path")
+                if not path:
+                    # A default relative to the working directory would give each process its own queue
+                    raise ValueError("The inbound_queue_path setting is required by the sqlite inbound queue")
+                _queue = SQLiteQueue(path, maxsize=maxsize)
+            else:
+                if backend == "redis":
+                    logger.warning("get_inbound_queue - redis is not configured, using an in-memory queue")
+                _queue = MemoryQueue(maxsize=maxsize)
+        return _queue
@@ -0,0 +1,82 @@
+import json
+from typing import Any, Optional, Union
+from urllib.parse import unquote
+
+from lxml import etree
+
+from federation.types import RequestType
+from federation.utils.text import decode_if_bytes
+
+_MISSING = object()
+
+
+class ParsedRequest:
+    """
+    Wraps an inbound request so that its body is decoded and parsed at most once, by the
+    protocol identification and then by the receiving protocol.
+
+    The ``Content-Type`` header decides if JSON or XML is parsed first. The other format is
+    only tried when the first one fails. Other attributes are read from the wrapped request.
+    """
+    def __init__(self, request: RequestType):
+        self.request = request
+        self._text = _MISSING
+        self._json = _MISSING
+        self._xml = _MISSING
+        self.json_error = None
+        self.xml_error = None
+
+    def __getattr__(self, name):
+        if name == "request":
+            raise AttributeError(name)
+        return getattr(self.request, name)
+
+    def __repr__(self):
+        return f"ParsedRequest({self.request!r})"
+
+    @property
+    def content_type(self) -> str:
+        headers = getattr(self.request, "headers", None) or {}
+        value = headers.get("Content-Type") or headers.get("content-type") or ""
+        return value.split(";")[0].strip().lower()
+
+    @property
+    def text(self) -> str:
+        if self._text is _MISSING:
+            self._text = decode_if_bytes(self.request.body)
+        return self._text
+
+    @property
+    def json(self) -> Optional[Any]:
+        """
+        The parsed JSON body, or None if the body is not JSON.
+        """
+        if self._json is _MISSING:
+            self._json = None
+            if not (self.content_type.endswith("xml") and self.xml is not None):
+                try:
+                    self._json = json.loads(self.text)
+                except (ValueError, TypeError) as ex:
+                    self.json_error = ex
+        return self._json
+
+    @property
+    def xml(self) -> Optional[etree._Element]:
+        """
+        The parsed XML body, or None if the body is not XML. Like Diaspora payloads, the body can be URL encoded.
+        """
+        if self._xml is _MISSING:
+            self._xml = None
+            if self.content_type.endswith("xml") or self.json is None:
+                try:
+                    self._xml = etree.fromstring(unquote(self.text).lstrip().encode("utf-8"))
+                except (etree.XMLSyntaxError, ValueError, TypeError) as ex:
+                    self.xml_error = ex
+        return self._xml
+
+
+def parse_request(request: Union[RequestType, ParsedRequest]) -> ParsedRequest:
+    """
+    Wrap a request in a ParsedRequest, unless it is one already.
+    """
+    return request if isinstance(request, ParsedRequest) else ParsedRequest(request)
@@ -0,0 +1,130 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, List, Optional, Union
+
+import attr
+# noinspection PyPackageRequirements
+from Crypto.Hash import SHA1, SHA256, SHA512
+# noinspection PyPackageRequirements
+from Crypto.Signature import pkcs1_15
+
+from federation.utils.django import get_setting
+from federation.utils.keys import import_rsa_key
+from federation.utils.text import encode_if_text
+
+logger = logging.getLogger("federation")
+
+HASHES = {
+    "sha1": SHA1,
+    "sha256": SHA256,
+    "sha512": SHA512,
+}
+
+
+@attr.s(frozen=True)
+class VerificationJob:
+    """
+    A RSA PKCS#1 v1.5 signature verification, sent to the worker processes of a VerificationService.
+
+    The message is hashed by the caller, only its digest crosses the process boundary.
+    """
+    key = attr.ib(converter=encode_if_text)
+    digest = attr.ib()
+    signature = attr.ib()
+    hash_name = attr.ib(default="sha256")
+
+    @classmethod
+    def from_message(cls, key: Union[str, bytes], message: Union[str, bytes], signature: bytes,
+                     hash_name: str = "sha256") -> "VerificationJob":
+        return cls(key, HASHES[hash_name].new(encode_if_text(message)).digest(), signature, hash_name)
+
+
+class PrehashedMessage:
+    """
+    Stand-in for a PyCryptodome hash object, the PKCS#1 v1.5 verifier only reads the digest and the OID.
+    """
+    def __init__(self, hash_name: str, digest: bytes):
+        self.oid = HASHES[hash_name].new().oid
+        self.digest_size = len(digest)
+        self._digest = digest
+
+    def digest(self) -> bytes:
+        return self._digest
+
+
+def verify_job(job: VerificationJob) -> bool:
+    """
+    Run one verification. Worker processes keep their own parsed key cache.
+    """
+    try:
+        pkcs1_15.new(import_rsa_key(job.key)).verify(PrehashedMessage(job.hash_name, job.digest), job.signature)
+    except (ValueError, TypeError, IndexError, KeyError):
+        return False
+    return True
+
+
+class VerificationService:
+    """
+    Runs batches of signature verifications on a pool of worker processes.
+
+    The RSA operations hold the GIL, a process pool lets a batch use all the cores. The pool is
+    started on the first batch large enough to be worth it. With ``max_workers=0`` the jobs are
+    run in the calling process.
+
+    :arg max_workers: Size of the process pool, defaults to the number of CPUs.
+    :arg min_batch_size: Smaller batches are verified in the calling process.
+    :arg chunksize: Number of jobs sent to a worker at once.
+    """
+    def __init__(self, max_workers: Optional[int] = None, min_batch_size: int = 2, chunksize: int = 16):
+        self.max_workers = max_workers
+        self.min_batch_size = min_batch_size
+        self.chunksize = chunksize
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def verify(self, jobs: Iterable[VerificationJob]) -> List[bool]:
+        """
+        Verify a batch of jobs.
+
+        :returns: The result of each job, in order.
+        """
+        jobs = list(jobs)
+        if self.max_workers == 0 or len(jobs) < self.min_batch_size:
+            return [verify_job(job) for job in jobs]
+        chunksize = max(1, min(self.chunksize, len(jobs) // (self.max_workers or 4)))
+        try:
+            return list(self.executor.map(verify_job, jobs, chunksize=chunksize))
+        except BrokenProcessPool as ex:
+            logger.warning("VerificationService - process pool failed, verifying in process: %s", ex)
+            self.shutdown()
+            return [verify_job(job) for job in jobs]
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=wait)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_verification_service() -> VerificationService:
+    """
+    Get the process wide verification service, sized by the ``signature_verification_workers`` setting.
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = VerificationService(max_workers=get_setting("signature_verification_workers"))
+        return _service
@@ -34,6 +34,7 @@ setup(
         "cssselect>=0.9.2",
         "dirty-validators>=0.3.0",
         "enum-properties",
+        "frozendict",
         "funcy",
         "lxml>=3.4.0",
         "iteration_utilities",